@@ -82,8 +82,49 @@ scripts = [fname for fname in glob.glob(os.path.join('scripts', '*'))
 randomkit_files = ['tardis/randomkit/rk_isaac.c', 'tardis/randomkit/rk_mt.c', 'tardis/randomkit/rk_primitive.c',
                    'tardis/randomkit/rk_sobol.c']
 
+
+def get_openmp_flags():
+    """
+    Compile and link flags for OpenMP if the compiler supports it (checked by building a small test program), or no
+    flags. Without OpenMP the MonteCarlo packet loop runs on one thread. Setting the environment variable
+    TARDIS_DISABLE_OPENMP skips the check.
+    """
+    import shutil
+    import tempfile
+    from distutils.ccompiler import new_compiler
+    from distutils.errors import CompileError, LinkError
+    from distutils.sysconfig import customize_compiler
+
+    if os.environ.get('TARDIS_DISABLE_OPENMP'):
+        return [], []
+
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    if compiler.compiler_type == 'msvc':
+        compile_flags, link_flags = ['/openmp'], []
+    else:
+        compile_flags, link_flags = ['-fopenmp'], ['-fopenmp']
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        test_fname = os.path.join(tmp_dir, 'test_openmp.c')
+        with open(test_fname, 'w') as test_file:
+            test_file.write('#include <omp.h>\nint main(void) { return omp_get_max_threads() < 1; }\n')
+        objects = compiler.compile([test_fname], output_dir=tmp_dir, extra_postargs=compile_flags)
+        compiler.link_executable(objects, os.path.join(tmp_dir, 'test_openmp'), extra_postargs=link_flags)
+    except (CompileError, LinkError):
+        sys.stderr.write('The compiler does not support OpenMP - the MonteCarlo packet loop will run on one thread\n')
+        return [], []
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return compile_flags, link_flags
+
+openmp_compile_flags, openmp_link_flags = get_openmp_flags()
+
 extensions = [Extension('tardis.montecarlo_multizone',
-                        ['tardis/montecarlo_multizone.pyx'] + randomkit_files)]
+                        ['tardis/montecarlo_multizone.pyx'] + randomkit_files,
+                        extra_compile_args=openmp_compile_flags, extra_link_args=openmp_link_flags)]
 
 # A dictionary to keep track of all package data to install
 package_data = {PACKAGENAME: ['data/*']}
@@ -2,6 +2,7 @@
 
 from astropy import units as u
 import numpy as np
+import pandas as pd
 from matplotlib.widgets import Lasso
 from matplotlib import path
 
@@ -29,6 +30,81 @@ def get_last_line_interaction(wavelength_start, wavelength_end, model):
     return last_line_in_ids, last_line_out_ids
 
 
+class LineInteractionTallies(object):
+    """
+    Line interaction tallies of the last MonteCarlo run of `model` (needs the 'line_tallies' estimator): the number
+    and the (lab frame) energy of the interactions in every shell, once for the line that absorbed the packet and
+    once for the line it was emitted through. Unlike `LastLineInteraction` every line interaction of every packet is
+    counted, not just the last one, and nothing has to be looked up per packet.
+
+    Parameters
+    ----------
+
+    model : `tardis.model_radial_oned.Radial1DModel`
+    """
+
+    def __init__(self, model):
+        if model.line_interaction_counts is None:
+            raise ValueError('The model was run without the "line_tallies" estimator')
+        self.model = model
+        #line ids of the columns of the tallies (the kernel only sees the lines of the line window)
+        self.line_ids = model.atom_data.lines_index.index.values[model.line_window]
+        self.counts = model.line_interaction_counts
+        self.energies = model.line_interaction_energies
+
+    def to_sparse(self):
+        """
+        Sparse form of the tallies: a DataFrame indexed by line id and shell with one row for every pair with
+        interactions and the columns absorbed_count, absorbed_energy, emitted_count and emitted_energy.
+        """
+        shell_ids, line_columns = np.nonzero(self.counts.sum(axis=0))
+        index = pd.MultiIndex.from_arrays([self.line_ids[line_columns], shell_ids], names=['line_id', 'shell'])
+        return pd.DataFrame(dict(absorbed_count=self.counts[0, shell_ids, line_columns],
+                                 absorbed_energy=self.energies[0, shell_ids, line_columns],
+                                 emitted_count=self.counts[1, shell_ids, line_columns],
+                                 emitted_energy=self.energies[1, shell_ids, line_columns]),
+                            index=index, columns=['absorbed_count', 'absorbed_energy', 'emitted_count',
+                                                  'emitted_energy'])
+
+    def line_table(self, shell=None):
+        """
+        Tallies of the lines with interactions (summed over the shells, or of `shell` only) together with the atomic
+        number, ion number and wavelength of the lines.
+        """
+        if shell is None:
+            counts = self.counts.sum(axis=1)
+            energies = self.energies.sum(axis=1)
+        else:
+            counts = self.counts[:, shell]
+            energies = self.energies[:, shell]
+
+        line_columns = np.nonzero(counts.sum(axis=0))[0]
+        line_table = self.model.atom_data.lines[['atomic_number', 'ion_number', 'wavelength']].reindex(
+            self.line_ids[line_columns])
+        line_table['absorbed_count'] = counts[0, line_columns]
+        line_table['absorbed_energy'] = energies[0, line_columns]
+        line_table['emitted_count'] = counts[1, line_columns]
+        line_table['emitted_energy'] = energies[1, line_columns]
+        return line_table
+
+    def species_contributions(self, mode='emitted', wavelength_start=None, wavelength_end=None):
+        """
+        Fraction of the energy absorbed or emitted (`mode`) by the lines of every species (atomic number, ion number),
+        optionally only for the lines between `wavelength_start` and `wavelength_end` (`astropy.units.Quantity`).
+        """
+        if mode not in ('absorbed', 'emitted'):
+            raise ValueError('mode needs to be "absorbed" or "emitted"')
+
+        line_table = self.line_table()
+        if wavelength_start is not None:
+            line_table = line_table[line_table.wavelength >= wavelength_start.to('angstrom').value]
+        if wavelength_end is not None:
+            line_table = line_table[line_table.wavelength <= wavelength_end.to('angstrom').value]
+
+        contributions = line_table.groupby(['atomic_number', 'ion_number'])['%s_energy' % mode].sum()
+        return contributions / contributions.sum()
+
+
 class LastLineInteraction(object):
     def __init__(self, model):
         self.model = model
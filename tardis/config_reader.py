@@ -511,6 +511,150 @@ class TardisConfiguration(object):
         if 'no_of_virtual_packets' not in montecarlo_section:
             montecarlo_section['no_of_virtual_packets'] = 0
 
+        if 'virtual_packet_tau_cutoff' not in montecarlo_section:
+            montecarlo_section['virtual_packet_tau_cutoff'] = 10.0
+
+        if 'virtual_packet_survival_probability' not in montecarlo_section:
+            montecarlo_section['virtual_packet_survival_probability'] = 0.0
+
+        if not 0 <= montecarlo_section['virtual_packet_survival_probability'] <= 1:
+            raise TardisConfigError('virtual_packet_survival_probability must be between 0 and 1')
+
+        if 'no_of_threads' not in montecarlo_section:
+            montecarlo_section['no_of_threads'] = 1
+
+        if 'no_of_processes' not in montecarlo_section:
+            montecarlo_section['no_of_processes'] = 1
+
+        if 'packet_sampling' not in montecarlo_section:
+            montecarlo_section['packet_sampling'] = 'random'
+
+        if montecarlo_section['packet_sampling'] not in ('random', 'sobol'):
+            raise TardisConfigError('packet_sampling must be either "random" or "sobol"')
+
+        if 'backend' not in montecarlo_section:
+            montecarlo_section['backend'] = 'cython'
+
+        if montecarlo_section['backend'] not in ('cython', 'vectorized'):
+            raise TardisConfigError('backend must be either "cython" or "vectorized"')
+
+        if montecarlo_section['backend'] == 'vectorized' and montecarlo_section['no_of_virtual_packets'] > 0:
+            raise TardisConfigError('the vectorized backend does not support virtual packets')
+
+        if 'line_skip_tau_threshold' not in montecarlo_section:
+            montecarlo_section['line_skip_tau_threshold'] = 0.0
+
+        montecarlo_section['line_skip_tau_threshold'] = float(montecarlo_section['line_skip_tau_threshold'])
+        if montecarlo_section['line_skip_tau_threshold'] < 0:
+            raise TardisConfigError('line_skip_tau_threshold must not be negative')
+
+        if 'diffusion_tau_threshold' not in montecarlo_section:
+            montecarlo_section['diffusion_tau_threshold'] = 0.0
+
+        montecarlo_section['diffusion_tau_threshold'] = float(montecarlo_section['diffusion_tau_threshold'])
+        if montecarlo_section['diffusion_tau_threshold'] < 0:
+            raise TardisConfigError('diffusion_tau_threshold must not be negative')
+
+        if montecarlo_section['backend'] == 'vectorized' and montecarlo_section['diffusion_tau_threshold'] > 0:
+            raise TardisConfigError('the vectorized backend does not support the diffusion approximation')
+
+        if 'formal_integral' not in montecarlo_section:
+            montecarlo_section['formal_integral'] = False
+
+        if 'trim_line_list' not in montecarlo_section:
+            montecarlo_section['trim_line_list'] = False
+
+        if 'packet_chunk_size' not in montecarlo_section:
+            montecarlo_section['packet_chunk_size'] = None
+
+        if montecarlo_section['packet_chunk_size'] is not None:
+            montecarlo_section['packet_chunk_size'] = int(float(montecarlo_section['packet_chunk_size']))
+            if montecarlo_section['packet_chunk_size'] < 1:
+                raise TardisConfigError('packet_chunk_size must be at least 1')
+
+        if 'packet_output_fname' not in montecarlo_section:
+            montecarlo_section['packet_output_fname'] = None
+
+        if 'noise_target' not in montecarlo_section:
+            montecarlo_section['noise_target'] = None
+
+        if montecarlo_section['noise_target'] is not None:
+            noise_target = montecarlo_section['noise_target']
+            unknown_noise_target_keys = set(noise_target) - set(['relative_error', 'batch_size', 'min_batches',
+                                                                 'max_time'])
+            if unknown_noise_target_keys:
+                raise TardisConfigError('noise_target only knows relative_error, batch_size, min_batches and max_time '
+                                        '(given %s)' % ', '.join(sorted(unknown_noise_target_keys)))
+            if 'relative_error' not in noise_target:
+                raise TardisConfigError('noise_target needs a relative_error')
+            noise_target['relative_error'] = float(noise_target['relative_error'])
+            if noise_target['relative_error'] <= 0:
+                raise TardisConfigError('noise_target relative_error must be positive')
+            noise_target['batch_size'] = int(float(noise_target.get('batch_size', 1e4)))
+            if noise_target['batch_size'] < 1:
+                raise TardisConfigError('noise_target batch_size must be at least 1')
+            noise_target['min_batches'] = int(noise_target.get('min_batches', 4))
+            if noise_target['min_batches'] < 2:
+                raise TardisConfigError('noise_target min_batches must be at least 2')
+            if noise_target.get('max_time', None) is not None:
+                noise_target['max_time'] = parse2quantity(noise_target['max_time']).to('s').value
+            else:
+                noise_target['max_time'] = None
+
+        if 'packet_schedule' not in montecarlo_section:
+            montecarlo_section['packet_schedule'] = None
+
+        if montecarlo_section['packet_schedule'] is not None:
+            packet_schedule = montecarlo_section['packet_schedule']
+            unknown_schedule_keys = set(packet_schedule) - set(['min_no_of_packets', 'threshold', 'max_growth'])
+            if unknown_schedule_keys:
+                raise TardisConfigError('packet_schedule only knows min_no_of_packets, threshold and max_growth '
+                                        '(given %s)' % ', '.join(sorted(unknown_schedule_keys)))
+            no_of_packets = int(float(montecarlo_section['no_of_packets']))
+            packet_schedule['min_no_of_packets'] = int(float(packet_schedule.get('min_no_of_packets',
+                                                                                 max(1, no_of_packets // 10))))
+            if not 1 <= packet_schedule['min_no_of_packets'] <= no_of_packets:
+                raise TardisConfigError('packet_schedule min_no_of_packets must be between 1 and no_of_packets')
+            packet_schedule['threshold'] = float(packet_schedule.get('threshold', 0.05))
+            if packet_schedule['threshold'] <= 0:
+                raise TardisConfigError('packet_schedule threshold must be positive')
+            packet_schedule['max_growth'] = float(packet_schedule.get('max_growth', 2.0))
+            if packet_schedule['max_growth'] < 1:
+                raise TardisConfigError('packet_schedule max_growth must be at least 1')
+
+        if 'estimators' not in montecarlo_section:
+            montecarlo_section['estimators'] = ['j_blues', 'last_interaction']
+
+        unknown_estimators = set(montecarlo_section['estimators']) - set(['j_blues', 'last_interaction',
+                                                                          'line_tallies'])
+        if unknown_estimators:
+            raise TardisConfigError('estimators can only contain "j_blues", "last_interaction" and "line_tallies" '
+                                    '(given %s)' % ', '.join(sorted(unknown_estimators)))
+
+        if 'j_blues' not in montecarlo_section['estimators']:
+            if config_dict['radiative_rates_type'] == 'detailed':
+                raise TardisConfigError('the "detailed" radiative_rates_type needs the "j_blues" estimators')
+            if montecarlo_section['formal_integral']:
+                raise TardisConfigError('formal_integral needs the "j_blues" estimators')
+
+        if 'storage_precision' not in montecarlo_section:
+            montecarlo_section['storage_precision'] = 'double'
+
+        if montecarlo_section['storage_precision'] not in ('double', 'single'):
+            raise TardisConfigError('storage_precision must be either "double" or "single"')
+
+        if 'packet_tracer' not in montecarlo_section:
+            montecarlo_section['packet_tracer'] = None
+
+        if montecarlo_section['packet_tracer'] is not None:
+            unknown_tracer_keys = set(montecarlo_section['packet_tracer']) - set(['capacity', 'sampling', 'fname'])
+            if unknown_tracer_keys:
+                raise TardisConfigError('packet_tracer only knows capacity, sampling and fname (given %s)' %
+                                        ', '.join(sorted(unknown_tracer_keys)))
+
+        if 'seed' not in montecarlo_section:
+            montecarlo_section['seed'] = 250819801106
+
         config_dict.update(montecarlo_section)
 
         disable_electron_scattering = plasma_section['disable_electron_scattering']
@@ -622,6 +766,37 @@ class TardisConfiguration(object):
         config_dict['spectrum_start_nu'] = spectrum_end.to('Hz', units.spectral())
         config_dict['spectrum_end_nu'] = spectrum_start.to('Hz', units.spectral())
 
+        #additional grids the packets are binned into (see `tardis.spectrum_grid.SpectrumGrid.from_config_dict`)
+        spectrum_grids = spectrum_section.pop('grids', None) or []
+        spectrum_grid_names = set(['default'])
+        for grid_dict in spectrum_grids:
+            if 'name' not in grid_dict:
+                raise TardisConfigError('Every spectrum grid needs a name')
+            if grid_dict['name'] in spectrum_grid_names:
+                raise TardisConfigError('Spectrum grid name %s is used twice (or is reserved)' % grid_dict['name'])
+            spectrum_grid_names.add(grid_dict['name'])
+
+            grid_type = grid_dict.get('type', 'linear')
+            if grid_type == 'edges':
+                if set(grid_dict) - set(['name', 'type', 'fname']) or 'fname' not in grid_dict:
+                    raise TardisConfigError('Spectrum grid %s of type edges needs (only) a fname' % grid_dict['name'])
+            elif grid_type in ('linear', 'log_wavelength'):
+                if set(grid_dict) - set(['name', 'type', 'start', 'end', 'bins']):
+                    raise TardisConfigError('Spectrum grid %s only knows start, end and bins' % grid_dict['name'])
+                grid_start = parse2quantity(grid_dict.get('start', spectrum_section['start'])).to(
+                    'angstrom', units.spectral()).value
+                grid_end = parse2quantity(grid_dict.get('end', spectrum_section['end'])).to(
+                    'angstrom', units.spectral()).value
+                grid_dict['start'], grid_dict['end'] = min(grid_start, grid_end), max(grid_start, grid_end)
+                grid_dict['bins'] = int(grid_dict.get('bins', spectrum_bins))
+                if grid_dict['bins'] < 1:
+                    raise TardisConfigError('Spectrum grid %s needs at least one bin' % grid_dict['name'])
+            else:
+                raise TardisConfigError('Spectrum grid type must be linear, log_wavelength or edges (given %s)' %
+                                        grid_type)
+            grid_dict['type'] = grid_type
+        config_dict['spectrum_grids'] = spectrum_grids
+
         sn_distance = spectrum_section.pop('sn_distance', None)
 
         if sn_distance is not None:
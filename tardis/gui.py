@@ -47,6 +47,7 @@ class ModelViewer(QtGui.QWidget):
         self.spectrum_button.setMenu(QtGui.QMenu(self.spectrum_button))
         self.spectrum_button.menu().addAction('spec_flux_angstrom').triggered.connect(self.change_to_spec_flux_angstrom)
         self.spectrum_button.menu().addAction('spec_virtual_flux_angstrom').triggered.connect(self.change_to_spec_virtual_flux_angstrom)
+        self.spectrum_button.menu().addAction('spec_formal_flux_angstrom').triggered.connect(self.change_to_spec_formal_flux_angstrom)
         self.layout.addWidget(self.tableview)
         self.layout.addWidget(self.graph)
         self.sublayout.addWidget(self.spectrum_button)
@@ -69,6 +70,8 @@ class ModelViewer(QtGui.QWidget):
         self.plot_spectrum()
         if self.spectrum_button.text == 'spec_virtual_flux_angstrom':
             self.change_to_spec_virtual_flux_angstrom()
+        elif self.spectrum_button.text == 'spec_formal_flux_angstrom':
+            self.change_to_spec_formal_flux_angstrom()
         self.show()
         
     def change_model(self, model):
@@ -85,6 +88,11 @@ class ModelViewer(QtGui.QWidget):
         self.spectrum.data_plot[0].set_ydata(self.model.spec_virtual_flux_angstrom)
         self.spectrum.draw()
         
+    def change_to_spec_formal_flux_angstrom(self):
+        self.spectrum_button.setText('spec_formal_flux_angstrom')
+        self.spectrum.data_plot[0].set_ydata(self.model.spec_formal_flux_angstrom)
+        self.spectrum.draw()
+        
     def change_to_spec_flux_angstrom(self):
         self.spectrum_button.setText('spec_flux_angstrom')
         self.spectrum.data_plot[0].set_ydata(self.model.spec_flux_angstrom)
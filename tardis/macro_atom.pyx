@@ -67,3 +67,35 @@ def normalize_transition_probabilities(np.ndarray[double, ndim=1] p_transition,
             continue
         for j in range(reference_levels[i], reference_levels[i + 1]):
             p_transition[j] /= norm_factor
+
+def calculate_cumulative_transition_probabilities(np.ndarray[double, ndim=2] p_transition,
+                                                  np.ndarray[int_type_t, ndim=1] reference_levels):
+    """
+    Running sums of the (normalized) transition probabilities within every macro atom block, for every shell. The
+    MonteCarlo kernel picks a transition by a binary search in these instead of summing up the block for every jump.
+
+    Parameters
+    ----------
+
+    p_transition : `numpy.ndarray` (shells x transitions)
+        normalized transition probabilities
+
+    reference_levels : `numpy.ndarray`
+        start of every block in the transitions and the total number of transitions as last element
+
+    Returns
+    -------
+
+    cumulative_p_transition : `numpy.ndarray` (shells x transitions)
+    """
+    cdef int i, j, k
+    cdef double cumulative_p
+    cdef np.ndarray[double, ndim=2] cumulative_p_transition = np.zeros_like(p_transition)
+
+    for k in range(p_transition.shape[0]):
+        for i in range(len(reference_levels) - 1):
+            cumulative_p = 0.0
+            for j in range(reference_levels[i], reference_levels[i + 1]):
+                cumulative_p += p_transition[k, j]
+                cumulative_p_transition[k, j] = cumulative_p
+    return cumulative_p_transition
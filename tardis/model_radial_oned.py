@@ -1,14 +1,19 @@
 # building of radial_oned_model
 
 import numpy as np
-import plasma, packet_source
+import plasma, packet_source, macro_atom
 import logging
 
 import pandas as pd
 from pandas.io.pytables import HDFStore
 from astropy import constants, units
 import montecarlo_multizone
+import montecarlo_pool
+import montecarlo_vectorized
+import packet_tracer
+import spectrum_grid
 import os
+import time
 import yaml
 
 import itertools
@@ -26,6 +31,79 @@ w_estimator_constant = (c ** 2 / (2 * h)) * (15 / np.pi ** 4) * (h / kb) ** 4 /
 synpp_default_yaml_fname = os.path.join(os.path.dirname(__file__), 'data', 'synpp_default.yaml')
 
 
+def batch_relative_standard_errors(batch_sums, batch_square_sums, no_of_batches):
+    """
+    Relative standard errors of the mean of equally sized batch estimates from their sums and square sums (the spread
+    of the batch estimates is used as the noise of a single batch). Estimates that are 0 in every batch have an error
+    of 0.
+    """
+    batch_means = batch_sums / no_of_batches
+    batch_variances = np.maximum(batch_square_sums / no_of_batches - batch_means ** 2, 0.0) * \
+                      no_of_batches / (no_of_batches - 1.0)
+    standard_errors = np.sqrt(batch_variances / no_of_batches)
+    relative_errors = np.zeros_like(batch_means)
+    nonzero_means = batch_means != 0
+    relative_errors[nonzero_means] = standard_errors[nonzero_means] / np.abs(batch_means[nonzero_means])
+    relative_errors[~nonzero_means & (standard_errors > 0)] = np.inf
+    return relative_errors
+
+
+def calculate_emission_line_ids(activating_lines, line2macro_level_upper, block_references, transition_type,
+                                destination_level_id, transition_line_id):
+    """
+    Line ids (of `transition_line_id`) of all emission transitions of the macro atoms that can be activated by the
+    lines selected by the boolean mask `activating_lines`, following the internal transitions (only present for the
+    macro atom) to every level they reach.
+    """
+    no_of_levels = len(block_references)
+    transition_source_level = np.repeat(np.arange(no_of_levels),
+                                        np.diff(np.hstack((block_references, len(transition_type)))))
+    emission = transition_type == -1
+    internal = ~emission & (destination_level_id >= 0)
+
+    active_levels = np.zeros(no_of_levels, dtype=bool)
+    active_levels[line2macro_level_upper[activating_lines]] = True
+    #internal jumps can reach further levels, which all have to be followed
+    while True:
+        reachable_levels = active_levels.copy()
+        reachable_levels[destination_level_id[internal & active_levels[transition_source_level]]] = True
+        if np.array_equal(reachable_levels, active_levels):
+            break
+        active_levels = reachable_levels
+
+    return transition_line_id[emission & active_levels[transition_source_level]]
+
+
+def calculate_line_window(line_nus, nu_min, nu_max, line2macro_level_upper=None, block_references=None,
+                          transition_type=None, destination_level_id=None, transition_line_id=None,
+                          beta_outer=0.0):
+    """
+    Range of the line list (sorted by decreasing frequency) that the MonteCarlo packets need, as a `slice`: all lines
+    between `nu_min` and `nu_max`. With the macro atom data (`line2macro_level_upper` and the transitions of the
+    levels, the internal transitions only for the macro atom) the range is widened until it also contains every line
+    the macro atoms that can be activated by the lines in the range can emit through. Below the lowest emission line the
+    range keeps a Doppler margin down to `nu_emission * (1 - 2 * beta_outer)`, the lowest comoving frequency a packet
+    emitted there can reach.
+    """
+    nu_min, nu_max = float(nu_min), float(nu_max)
+
+    if line2macro_level_upper is not None and len(line_nus) > 0:
+        while True:
+            in_window = (line_nus >= nu_min) & (line_nus <= nu_max)
+            emission_nus = line_nus[calculate_emission_line_ids(in_window, line2macro_level_upper, block_references,
+                                                                transition_type, destination_level_id,
+                                                                transition_line_id)]
+            if len(emission_nus) == 0:
+                break
+            new_nu_min = min(nu_min, emission_nus.min() * (1 - 2 * beta_outer))
+            new_nu_max = max(nu_max, emission_nus.max())
+            if new_nu_min == nu_min and new_nu_max == nu_max:
+                break
+            nu_min, nu_max = new_nu_min, new_nu_max
+
+    return slice(np.searchsorted(-line_nus, -nu_max, side='left'), np.searchsorted(-line_nus, -nu_min, side='right'))
+
+
 class Radial1DModel(object):
     """
         Class to hold the states of the individual shells (the state of the plasma (as a `~plasma.BasePlasma`-object or one of its subclasses),
@@ -81,7 +159,8 @@ class Radial1DModel(object):
         self.atom_data = tardis_config.atom_data
 
         self.packet_src = packet_source.SimplePacketSource.from_wavelength(tardis_config.spectrum_start,
-                                                                           tardis_config.spectrum_end)
+                                                                           tardis_config.spectrum_end,
+                                                                           packet_sampling=tardis_config.packet_sampling)
 
         self.no_of_shells = tardis_config.no_of_shells
 
@@ -106,6 +185,47 @@ class Radial1DModel(object):
 
         self.no_of_packets = tardis_config.no_of_packets
         self.current_no_of_packets = tardis_config.no_of_packets
+        self.no_of_threads = tardis_config.no_of_threads
+        self.seed = tardis_config.seed
+        self.no_of_processes = tardis_config.no_of_processes
+        self.montecarlo_pool = None
+        #reused by every MonteCarlo run of this model (refilled in place)
+        self.montecarlo_storage = None
+        self.packet_chunk_size = tardis_config.packet_chunk_size
+        #called as callback(no_of_packets_done, no_of_packets, elapsed_time, packets_per_second) during every
+        #MonteCarlo run (every `montecarlo_progress_interval` packets, a fifth of the packets if 0)
+        self.montecarlo_progress_callback = None
+        self.montecarlo_progress_interval = 0
+        self.packet_output_fname = tardis_config.packet_output_fname
+        #stop the iterations that update the radiation field once the estimators are good enough (see
+        #`run_montecarlo_chunks`)
+        self.noise_target = tardis_config.noise_target
+        self.montecarlo_backend = tardis_config.backend
+        #optional estimators filled by the MonteCarlo kernel
+        self.estimators = tardis_config.estimators
+        #dtype of tau_sobolevs, j_blues and the transition probabilities (estimators are always float64)
+        if tardis_config.storage_precision == 'single':
+            self.storage_dtype = np.float32
+        else:
+            self.storage_dtype = np.float64
+        self.line_skip_tau_threshold = tardis_config.line_skip_tau_threshold
+        self.diffusion_tau_threshold = tardis_config.diffusion_tau_threshold
+        self.virtual_packet_tau_cutoff = tardis_config.virtual_packet_tau_cutoff
+        self.virtual_packet_survival_probability = tardis_config.virtual_packet_survival_probability
+        self.next_significant_line = None
+        self.tau_skipped_cumulative = None
+        #hand only the lines the packets can reach to the MonteCarlo kernel (see `calculate_line_window`)
+        self.trim_line_list = tardis_config.trim_line_list
+        self.line_window = slice(None)
+        #number and energy of the line interactions of the last run (estimator 'line_tallies', see
+        #`analysis.LineInteractionTallies`)
+        self.line_interaction_counts = None
+        self.line_interaction_energies = None
+
+        if tardis_config.packet_tracer is None:
+            self.packet_tracer = None
+        else:
+            self.packet_tracer = packet_tracer.PacketTracer(**tardis_config.packet_tracer)
 
         self.iterations_max_requested = tardis_config.iterations
         self.iterations_remaining = self.iterations_max_requested - 1
@@ -119,14 +239,22 @@ class Radial1DModel(object):
 
         self.spec_virtual_flux_nu = np.zeros_like(self.spec_nu)
 
+        #the kernel bins the packets into these grids during transport, the first one is the grid of the spectrum above
+        self.spectrum_grids = [spectrum_grid.SpectrumGrid('default', self.spec_nu_bins, spectrum_grid.SPACING_LINEAR)]
+        self.spectrum_grids += [spectrum_grid.SpectrumGrid.from_config_dict(grid_dict)
+                                for grid_dict in tardis_config.spectrum_grids]
+        self.spectrum_grid_fluxes = {}
+
         self.spec_angstrom = units.Unit('Hz').to('angstrom', self.spec_nu, units.spectral())
 
         self.spec_flux_angstrom = np.ones_like(self.spec_angstrom)
         self.spec_virtual_flux_angstrom = np.ones_like(self.spec_angstrom)
+        self.spec_formal_flux_angstrom = np.ones_like(self.spec_angstrom)
 
         self.gui = None
         #reading the convergence criteria
         self.converged = False
+        self.convergence_ratios = None
         self.convergence_type = tardis_config.convergence_type
         self.t_inner_convergence_parameters = tardis_config.t_inner_convergence_parameters
         self.t_rad_convergence_parameters = tardis_config.t_rad_convergence_parameters
@@ -220,18 +348,19 @@ class Radial1DModel(object):
         self.time_of_simulation = 1 / self.luminosity_inner
 
 
-    def create_packets(self):
+    def create_packets(self, no_of_packets=None, total_no_of_packets=None):
         #Energy emitted from the inner boundary
         self.emitted_inner_energy = 4 * np.pi * constants.sigma_sb.cgs.value * self.r_inner[0] ** 2 * (
             self.t_inner) ** 4
 
-        no_of_packets = self.current_no_of_packets
-        self.packet_src.create_packets(no_of_packets, self.t_inner)
+        if no_of_packets is None:
+            no_of_packets = self.current_no_of_packets
+        self.packet_src.create_packets(no_of_packets, self.t_inner, total_number_of_packets=total_no_of_packets)
 
     def initialize_plasmas(self, plasma_class):
         self.plasmas = []
-        self.tau_sobolevs = np.zeros((self.no_of_shells, len(self.atom_data.lines)))
-        self.line_list_nu = self.atom_data.lines['nu']
+        self.setup_line_window()
+        self.tau_sobolevs = np.zeros((self.no_of_shells, len(self.line_list_nu)), dtype=self.storage_dtype)
 
         if self.line_interaction_id in (1, 2):
             if self.line_interaction_id == 1:
@@ -259,18 +388,83 @@ class Radial1DModel(object):
                                           nlte_species=self.tardis_config.nlte_species,
                                           nlte_options=self.tardis_config.nlte_options, zone_id=i, j_blues=j_blues)
 
-            self.tau_sobolevs[i] = current_plasma.tau_sobolevs
+            self.tau_sobolevs[i] = current_plasma.tau_sobolevs[self.line_window]
+            if not self.trim_line_list:
+                #the plasma keeps a view on its row instead of its own float64 copy
+                current_plasma.tau_sobolevs = self.tau_sobolevs[i]
 
             self.plasmas.append(current_plasma)
 
-        self.tau_sobolevs = np.array(self.tau_sobolevs, dtype=float)
-        self.j_blues = np.zeros_like(self.tau_sobolevs)
+        if 'j_blues' in self.estimators:
+            self.j_blues = np.zeros_like(self.tau_sobolevs)
+        else:
+            #the J_blue estimators are switched off - nothing reads them
+            self.j_blues = np.zeros((self.no_of_shells, 0), dtype=self.storage_dtype)
+
+        if 'line_tallies' in self.estimators:
+            #rows absorbed and emitted, the kernel resets them at the start of every run
+            self.line_interaction_counts = np.zeros((2,) + self.tau_sobolevs.shape, dtype=np.int64)
+            self.line_interaction_energies = np.zeros((2,) + self.tau_sobolevs.shape)
 
         if self.line_interaction_id in (1, 2):
             self.calculate_transition_probabilities()
 
+        self.calculate_line_skipping_index()
+
             # update plasmas
 
+    def setup_line_window(self):
+        """
+        Select the lines that are handed to the MonteCarlo kernel (`line_window` of the lines of the atom data) and
+        set `line_list_nu` and the line references of the macro atom (`line2macro_level_upper` and
+        `transition_line_id`) for it. `tau_sobolevs` and `j_blues` only have columns for these lines.
+
+        Without `trim_line_list` all lines are used. Otherwise the window holds the lines between the packet
+        frequencies Doppler shifted by the outer velocity (comoving frequencies of the packets below
+        `nu_start * (1 - v_outer / c)` can not be observed in the spectrum range again, and those above
+        `nu_end * (1 + v_outer / c)` are only needed by the formal integral), widened for downbranch and macro atom
+        until every line the activated macro atoms can emit through is kept, with the Doppler margin below the lowest
+        emission line (see `calculate_line_window`). The lines outside the window get the same J_blues as lines without
+        packets.
+        """
+        lines_nu = self.atom_data.lines['nu']
+        macro_atom_arrays = {}
+        if self.line_interaction_id in (1, 2):
+            macro_atom_arrays = dict(
+                line2macro_level_upper=self.atom_data.lines_upper2macro_reference_idx,
+                block_references=self.atom_data.macro_atom_references['block_references'].values,
+                transition_type=self.atom_data.macro_atom_data['transition_type'].values,
+                destination_level_id=self.atom_data.macro_atom_data['destination_level_idx'].values,
+                transition_line_id=self.atom_data.macro_atom_data['lines_idx'].values)
+
+        if self.trim_line_list:
+            beta_outer = self.v_outer[-1] / c
+            self.line_window = calculate_line_window(lines_nu.values, self.packet_src.nu_start * (1 - beta_outer),
+                                                     self.packet_src.nu_end * (1 + beta_outer), beta_outer=beta_outer,
+                                                     **macro_atom_arrays)
+            logger.info('Trimmed the line list to %d of %d lines', self.line_window.stop - self.line_window.start,
+                        len(lines_nu))
+        else:
+            self.line_window = slice(0, len(lines_nu))
+
+        self.line_list_nu = lines_nu.iloc[self.line_window]
+        if macro_atom_arrays:
+            self.line2macro_level_upper = macro_atom_arrays['line2macro_level_upper'][self.line_window]
+            #transitions through lines outside the window belong to macro atoms that are never activated
+            transition_line_id = macro_atom_arrays['transition_line_id'] - self.line_window.start
+            transition_line_id[(transition_line_id < 0) | (transition_line_id >= len(self.line_list_nu))] = -1
+            self.transition_line_id = transition_line_id.astype(np.int64)
+            #the kernel indexes the line list with these ids without any check
+            emission_line_ids = calculate_emission_line_ids(np.ones(len(self.line_list_nu), dtype=bool),
+                                                            self.line2macro_level_upper,
+                                                            macro_atom_arrays['block_references'],
+                                                            macro_atom_arrays['transition_type'],
+                                                            macro_atom_arrays['destination_level_id'],
+                                                            self.transition_line_id)
+            if np.any(emission_line_ids < 0):
+                raise ValueError('The macro atoms activated by the lines of the line window emit through %d lines '
+                                 'outside of it' % np.sum(emission_line_ids < 0))
+
     def calculate_transition_probabilities(self):
         self.transition_probabilities = []
 
@@ -279,6 +473,13 @@ class Radial1DModel(object):
 
         self.transition_probabilities = np.array(self.transition_probabilities, dtype=np.float64)
 
+        block_references = np.hstack((self.atom_data.macro_atom_references['block_references'].values,
+                                      self.transition_probabilities.shape[1])).astype(np.int64)
+        #the running sums are always calculated in double precision
+        self.transition_cumulative_probabilities = macro_atom.calculate_cumulative_transition_probabilities(
+            self.transition_probabilities, block_references).astype(self.storage_dtype, copy=False)
+        self.transition_probabilities = self.transition_probabilities.astype(self.storage_dtype, copy=False)
+
     def calculate_updated_radiationfield(self, nubar_estimator, j_estimator):
         """
         Calculate an updated radiation field from the :math:`\\bar{nu}_\\textrm{estimator}` and :math:`\\J_\\textrm{estimator}`
@@ -312,7 +513,7 @@ class Radial1DModel(object):
                        (4 * np.pi * self.time_of_simulation * self.volumes)).reshape((self.volumes.shape[0], 1))
         self.j_blues *= norm_factor
         for i, current_j_blue in enumerate(self.j_blues):
-            nus = self.atom_data.lines.nu[current_j_blue == 0.0].values
+            nus = self.line_list_nu[current_j_blue == 0.0].values
             self.j_blues[i][self.j_blues[i] == 0.0] = self.tardis_config.w_epsilon * intensity_black_body(nus,
                                                                                                           self.plasmas[
                                                                                                               i].t_rad)
@@ -326,7 +527,13 @@ class Radial1DModel(object):
                 j_blues = new_ws * plasma.intensity_black_body(self.atom_data.lines.nu.values, new_trad)
 
             elif self.radiative_rates_type == 'detailed':
-                j_blues = self.j_blues[i]
+                if self.trim_line_list:
+                    #no packet reaches the lines outside the window (see `normalize_j_blues`)
+                    j_blues = self.tardis_config.w_epsilon * intensity_black_body(self.atom_data.lines.nu.values,
+                                                                                  current_plasma.t_rad)
+                    j_blues[self.line_window] = self.j_blues[i]
+                else:
+                    j_blues = self.j_blues[i]
             else:
                 raise ValueError('For the current plasma_type (%s) the radiative_rates_type can only'
                                  ' be "lte" or "detailed" or "nebular"' % (self.plasma_type))
@@ -335,11 +542,62 @@ class Radial1DModel(object):
             if self.plasma_type == 'lte':
                 new_ws = 1.0
             current_plasma.update_radiationfield(new_trad, w=new_ws)
-            self.tau_sobolevs[i] = current_plasma.tau_sobolevs
+            self.tau_sobolevs[i] = current_plasma.tau_sobolevs[self.line_window]
+            if not self.trim_line_list:
+                current_plasma.tau_sobolevs = self.tau_sobolevs[i]
 
         if self.line_interaction_id in (1, 2):
             self.calculate_transition_probabilities()
 
+        self.calculate_line_skipping_index()
+
+    def calculate_line_skipping_index(self):
+        """
+        Build the per-shell index that lets the MonteCarlo kernel jump over optically thin lines.
+
+        `next_significant_line[shell, line]` is the id of the first line at or after `line` with a Sobolev optical depth
+        of at least `line_skip_tau_threshold` (the number of lines if there is none). `tau_skipped_cumulative` holds the
+        cumulative optical depth of the thin lines per shell, so the summed optical depth of a run of skipped lines is a
+        single difference. A threshold of 0 switches line skipping off.
+        """
+        if self.line_skip_tau_threshold <= 0:
+            self.next_significant_line = None
+            self.tau_skipped_cumulative = None
+            return
+
+        no_of_lines = self.tau_sobolevs.shape[1]
+        significant_lines = self.tau_sobolevs >= self.line_skip_tau_threshold
+
+        significant_line_ids = np.where(significant_lines, np.arange(no_of_lines), no_of_lines)
+        self.next_significant_line = np.empty((self.no_of_shells, no_of_lines + 1), dtype=np.int64)
+        self.next_significant_line[:, :-1] = np.minimum.accumulate(significant_line_ids[:, ::-1], axis=1)[:, ::-1]
+        self.next_significant_line[:, -1] = no_of_lines
+
+        self.tau_skipped_cumulative = np.zeros((self.no_of_shells, no_of_lines + 1), dtype=np.float64)
+        np.cumsum(np.where(significant_lines, 0.0, self.tau_sobolevs), axis=1, dtype=np.float64,
+                  out=self.tau_skipped_cumulative[:, 1:])
+
+        logger.debug('Line skipping: %.1f%% of the line optical depths are below %g',
+                     100. * (1 - significant_lines.mean()), self.line_skip_tau_threshold)
+
+
+    def reset_packet_tallies(self):
+        """
+        Reset the histograms of the spectrum grids and the energy sums of the emitted and reabsorbed packets (see
+        `tally_packets`).
+        """
+        for grid in self.spectrum_grids:
+            grid.reset()
+        self.emitted_packet_energy = 0.0
+        self.reabsorbed_packet_energy = 0.0
+
+    def tally_packets(self, montecarlo_nu, montecarlo_energies):
+        """
+        Add the output of a MonteCarlo run (negative for reabsorbed packets) to the energy sums from which the inner
+        boundary luminosity is calculated. The spectra are binned by the backends themselves (see `spectrum_grids`).
+        """
+        self.emitted_packet_energy += np.sum(montecarlo_energies[montecarlo_energies >= 0])
+        self.reabsorbed_packet_energy += -np.sum(montecarlo_energies[montecarlo_energies < 0])
 
     def calculate_spectrum(self):
 
@@ -348,20 +606,15 @@ class Radial1DModel(object):
             distance = units.Quantity(10, 'pc').to('cm').value
         else:
             distance = self.tardis_config.sn_distance
-        self.spec_flux_nu = np.histogram(self.montecarlo_nu[self.montecarlo_nu > 0],
-                                         weights=self.montecarlo_energies[self.montecarlo_energies > 0],
-                                         bins=self.spec_nu_bins)[0]
+        default_grid = self.spectrum_grids[0]
 
         flux_scale = (self.time_of_simulation * (self.spec_nu[1] - self.spec_nu[0]) * (4 * np.pi * distance ** 2))
 
-        self.spec_flux_nu /= flux_scale
+        self.spec_flux_nu = default_grid.histograms[spectrum_grid.SPECTRUM_EMITTED] / flux_scale
 
-        self.spec_virtual_flux_nu /= flux_scale
+        self.spec_virtual_flux_nu = default_grid.histograms[spectrum_grid.SPECTRUM_VIRTUAL] / flux_scale
 
-        self.spec_reabsorbed_nu = \
-            np.histogram(self.montecarlo_nu[self.montecarlo_nu < 0],
-                         weights=self.montecarlo_energies[self.montecarlo_nu < 0], bins=self.spec_nu_bins)[0]
-        self.spec_reabsorbed_nu /= flux_scale
+        self.spec_reabsorbed_nu = default_grid.histograms[spectrum_grid.SPECTRUM_REABSORBED] / flux_scale
 
         self.spec_angstrom = units.Unit('Hz').to('angstrom', self.spec_nu, units.spectral())
 
@@ -369,28 +622,172 @@ class Radial1DModel(object):
         self.spec_reabsorbed_angstrom = (self.spec_reabsorbed_nu * self.spec_nu ** 2 / constants.c.cgs.value / 1e8)
         self.spec_virtual_flux_angstrom = (self.spec_virtual_flux_nu * self.spec_nu ** 2 / constants.c.cgs.value / 1e8)
 
+        #fluxes per angstrom on the additional grids
+        self.spectrum_grid_fluxes = {}
+        for grid in self.spectrum_grids[1:]:
+            spectrum_grid_flux = pd.DataFrame(index=np.arange(grid.no_of_bins))
+            spectrum_grid_flux['wave'] = grid.wavelength
+            for spectrum, column in (('emitted', 'flux'), ('virtual', 'flux_virtual'),
+                                     ('reabsorbed', 'flux_reabsorbed')):
+                spectrum_grid_flux[column] = grid.luminosity_density_wavelength(self.time_of_simulation, spectrum) / \
+                                             (4 * np.pi * distance ** 2)
+            self.spectrum_grid_fluxes[grid.name] = spectrum_grid_flux
 
-    def simulate(self, update_radiation_field=True, enable_virtual=False):
-        self.create_packets()
-        self.spec_virtual_flux_nu[:] = 0.0
+
+    def calculate_formal_spectrum(self, no_of_impact_parameters=100):
+        """
+        Calculate the noise-free spectrum `spec_formal_flux_nu` (and `spec_formal_flux_angstrom`) with a formal integral
+        over the current `tau_sobolevs` and the normalized `j_blues` (see `montecarlo_multizone.formal_integral`).
+
+        Parameters
+        ----------
+
+        no_of_impact_parameters : `int`
+            number of rays (impact parameters) used for the integration over the disk
+        """
+        if self.tardis_config.sn_distance is None:
+            distance = units.Quantity(10, 'pc').to('cm').value
+        else:
+            distance = self.tardis_config.sn_distance
+
+        luminosity_density = montecarlo_multizone.formal_integral(self, self.spec_nu,
+                                                                  no_of_impact_parameters=no_of_impact_parameters,
+                                                                  no_of_threads=self.no_of_threads)
+        self.spec_formal_flux_nu = luminosity_density / (4 * np.pi * distance ** 2)
+        self.spec_formal_flux_angstrom = (self.spec_formal_flux_nu * self.spec_nu ** 2 / constants.c.cgs.value / 1e8)
+
+
+    def simulate(self, update_radiation_field=True, enable_virtual=False, backend=None):
+        """
+        Run one MonteCarlo iteration
+
+        Parameters
+        ----------
+
+        update_radiation_field : `bool`
+            update the radiation field and the plasmas from the estimators of this iteration
+
+        enable_virtual : `bool`
+            spawn virtual packets (`no_of_virtual_packets` from the configuration)
+
+        backend : `None` or `str`
+            transport backend: 'cython' (packet by packet) or 'vectorized' (event-based numpy engine). `None` uses the
+            backend from the configuration.
+        """
+        if backend is None:
+            backend = self.montecarlo_backend
+
+        if enable_virtual:
+            no_of_virtual_packets = self.tardis_config.no_of_virtual_packets
+        else:
+            no_of_virtual_packets = 0
+
+        no_of_packets = int(self.current_no_of_packets)
+        #the last run (without update of the radiation field) is for the spectrum and always runs all packets
+        noise_target = self.noise_target if update_radiation_field else None
+        if noise_target is None and (self.packet_chunk_size is None or no_of_packets <= self.packet_chunk_size):
+            self.prepare_montecarlo_run()
+            montecarlo_output = self.run_montecarlo(no_of_virtual_packets, backend)
+            self.finish_montecarlo_run(montecarlo_output, update_radiation_field=update_radiation_field,
+                                       enable_virtual=enable_virtual)
+        else:
+            self.reset_packet_tallies()
+            event_counters = self.run_montecarlo_chunks(no_of_packets, no_of_virtual_packets, backend,
+                                                        noise_target=noise_target)
+
+            #the last interactions are not kept when streaming
+            self.last_interaction_type = np.zeros(0, dtype=np.int64)
+            self.last_line_interaction_shell_id = np.zeros(0, dtype=np.int64)
+            self.finish_iteration(event_counters, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                                  update_radiation_field=update_radiation_field, enable_virtual=enable_virtual)
+
+    def simulate_batch(self, other_models, update_radiation_field=True, enable_virtual=False):
+        """
+        Run one MonteCarlo iteration of this model and `other_models` (models with the same line list, e.g. a grid of
+        models of one atomic dataset) in one call of `montecarlo_multizone.montecarlo_radial1d_batch`. Every model ends
+        up in the same state as after its own `simulate`. The batch uses the threads and the number of virtual packets
+        of this model and always runs the cython kernel in one piece (no processes, chunks or noise target).
+
+        Parameters
+        ----------
+
+        other_models : `list` of `Radial1DModel`
+            models that are run together with this one
+
+        update_radiation_field : `bool`
+            update the radiation fields and the plasmas of all models
+
+        enable_virtual : `bool`
+            spawn virtual packets (`no_of_virtual_packets` from the configuration of this model)
+        """
+        models = [self] + list(other_models)
 
         if enable_virtual:
             no_of_virtual_packets = self.tardis_config.no_of_virtual_packets
         else:
             no_of_virtual_packets = 0
 
+        for model in models:
+            if model.montecarlo_storage is None or model.montecarlo_storage.no_of_threads != max(1, self.no_of_threads):
+                model.montecarlo_storage = montecarlo_multizone.StorageModel(no_of_threads=self.no_of_threads)
+            model.prepare_montecarlo_run()
+
+        montecarlo_outputs = montecarlo_multizone.montecarlo_radial1d_batch(
+            models, virtual_packet_flag=no_of_virtual_packets,
+            storages=[model.montecarlo_storage for model in models],
+            progress_callback=self.montecarlo_progress_callback, progress_interval=self.montecarlo_progress_interval)
+
+        for model, montecarlo_output in zip(models, montecarlo_outputs):
+            model.finish_montecarlo_run(montecarlo_output, update_radiation_field=update_radiation_field,
+                                        enable_virtual=enable_virtual)
+
+    def prepare_montecarlo_run(self):
+        """
+        Reset the packet tallies and create the `current_no_of_packets` packets of an iteration that is run in one
+        piece (see `finish_montecarlo_run`).
+        """
+        self.reset_packet_tallies()
+        self.create_packets()
+
+    def finish_montecarlo_run(self, montecarlo_output, update_radiation_field=True, enable_virtual=False):
+        """
+        Take over the output tuple of a MonteCarlo run of the packets created by `prepare_montecarlo_run` (e.g. one
+        entry of `montecarlo_multizone.montecarlo_radial1d_batch`) and finish the iteration.
+        """
         self.montecarlo_nu, self.montecarlo_energies, self.j_estimators, self.nubar_estimators, \
         last_line_interaction_in_id, last_line_interaction_out_id, \
-        self.last_interaction_type, self.last_line_interaction_shell_id = \
-            montecarlo_multizone.montecarlo_radial1d(self,
-                                                     virtual_packet_flag=no_of_virtual_packets)
+        self.last_interaction_type, self.last_line_interaction_shell_id, event_counters = montecarlo_output
+        self.no_of_packets_executed = len(self.montecarlo_nu)
+
+        self.tally_packets(self.montecarlo_nu, self.montecarlo_energies)
+        self.finish_iteration(event_counters, last_line_interaction_in_id, last_line_interaction_out_id,
+                              update_radiation_field=update_radiation_field, enable_virtual=enable_virtual)
+
+    def finish_iteration(self, event_counters, last_line_interaction_in_id, last_line_interaction_out_id,
+                         update_radiation_field=True, enable_virtual=False):
+        """
+        Calculate the spectra from the packet tallies, update the radiation field and the plasmas (if
+        `update_radiation_field` is set) and advance the iteration counters.
+        """
+        self.event_counters = pd.DataFrame(event_counters.T, columns=montecarlo_multizone.event_counter_names)
+        self.event_counters.index.name = 'Shell'
+        logger.debug('%.1f transport steps and %.1f line interactions per packet',
+                     self.event_counters['steps'].sum() / float(self.no_of_packets_executed),
+                     self.event_counters['line_interactions'].sum() / float(self.no_of_packets_executed))
 
-        self.normalize_j_blues()
+        if 'j_blues' in self.estimators:
+            self.normalize_j_blues()
 
         self.calculate_spectrum()
-        self.last_line_interaction_in_id = self.atom_data.lines_index.index.values[last_line_interaction_in_id]
+        if enable_virtual and self.tardis_config.formal_integral:
+            self.calculate_formal_spectrum()
+
+        #the kernel counts the lines from the start of the line window
+        self.last_line_interaction_in_id = self.atom_data.lines_index.index.values[
+            last_line_interaction_in_id + self.line_window.start]
         self.last_line_interaction_in_id[last_line_interaction_in_id == -1] = -1
-        self.last_line_interaction_out_id = self.atom_data.lines_index.index.values[last_line_interaction_out_id]
+        self.last_line_interaction_out_id = self.atom_data.lines_index.index.values[
+            last_line_interaction_out_id + self.line_window.start]
         self.last_line_interaction_out_id[last_line_interaction_out_id == -1] = -1
 
         self.iterations_executed += 1
@@ -405,6 +802,145 @@ class Radial1DModel(object):
             self.update_plasmas()
 
 
+    def run_montecarlo(self, no_of_virtual_packets, backend, packet_id_offset=0, reset_estimators=True,
+                       progress_callback=None):
+        """
+        Run the packets of `packet_src` with the selected backend and return the output tuple of
+        `montecarlo_multizone.montecarlo_radial1d`. `progress_callback` defaults to `montecarlo_progress_callback`.
+        """
+        if progress_callback is None:
+            progress_callback = self.montecarlo_progress_callback
+
+        if backend == 'vectorized':
+            return montecarlo_vectorized.montecarlo_radial1d(self, virtual_packet_flag=no_of_virtual_packets,
+                                                             packet_id_offset=packet_id_offset,
+                                                             reset_estimators=reset_estimators,
+                                                             progress_callback=progress_callback,
+                                                             progress_interval=self.montecarlo_progress_interval)
+        elif self.no_of_processes > 1:
+            if self.montecarlo_pool is None:
+                self.montecarlo_pool = montecarlo_pool.MonteCarloPool(self, self.no_of_processes,
+                                                                      no_of_threads=self.no_of_threads)
+            return self.montecarlo_pool.run(self, virtual_packet_flag=no_of_virtual_packets,
+                                            packet_id_offset=packet_id_offset, reset_estimators=reset_estimators,
+                                            progress_callback=progress_callback)
+        else:
+            if self.montecarlo_storage is None:
+                self.montecarlo_storage = montecarlo_multizone.StorageModel(no_of_threads=self.no_of_threads)
+            return montecarlo_multizone.montecarlo_radial1d(self, virtual_packet_flag=no_of_virtual_packets,
+                                                            packet_id_offset=packet_id_offset,
+                                                            packet_tracer=self.packet_tracer,
+                                                            storage=self.montecarlo_storage,
+                                                            reset_estimators=reset_estimators,
+                                                            progress_callback=progress_callback,
+                                                            progress_interval=self.montecarlo_progress_interval)
+
+    def run_montecarlo_chunks(self, no_of_packets, no_of_virtual_packets, backend, noise_target=None):
+        """
+        Create and run the packets of one iteration in chunks of `packet_chunk_size`. The output of every chunk is
+        folded into the histograms of the spectrum grids and the estimators right away, so the memory does not grow with the number
+        of packets. The raw packet output (`montecarlo_nu` and `montecarlo_energies`) is only kept if
+        `packet_output_fname` is set, in a memory-mapped file; otherwise both are `None`. Returns the summed event
+        counters of all chunks. The progress reports of the chunks are passed on to `montecarlo_progress_callback` as
+        progress of the whole iteration.
+
+        With a `noise_target` (the parsed configuration subsection) the chunks are batches of its `batch_size` and the
+        run stops as soon as the relative standard errors of `j_estimators` and `nubar_estimators` (from the spread of
+        the batch estimates, see `batch_relative_standard_errors`) are below its `relative_error` in every shell, or
+        once `max_time` seconds are over. `no_of_packets` is then the upper limit. The estimators and tallies of a run
+        stopped early are rescaled as if the packets that were run had shared the energy.
+        """
+        if self.packet_output_fname is None:
+            self.montecarlo_nu = None
+            self.montecarlo_energies = None
+        else:
+            packet_output = np.memmap(self.packet_output_fname, dtype=np.float64, mode='w+', shape=(2, no_of_packets))
+            self.montecarlo_nu = packet_output[0]
+            self.montecarlo_energies = packet_output[1]
+
+        self.j_estimators = np.zeros(self.no_of_shells)
+        self.nubar_estimators = np.zeros(self.no_of_shells)
+        event_counters = np.zeros((len(montecarlo_multizone.event_counter_names), self.no_of_shells), dtype=np.int64)
+
+        start_time = time.time()
+        if self.montecarlo_progress_callback is None:
+            chunk_progress_callback = None
+        else:
+            def chunk_progress_callback(no_of_chunk_packets_done, no_of_chunk_packets, chunk_elapsed_time,
+                                        chunk_packets_per_second):
+                no_of_packets_done = chunk_start + no_of_chunk_packets_done
+                elapsed_time = time.time() - start_time
+                self.montecarlo_progress_callback(no_of_packets_done, no_of_packets, elapsed_time,
+                                                  no_of_packets_done / elapsed_time if elapsed_time > 0 else 0.0)
+
+        if noise_target is None:
+            chunk_size = self.packet_chunk_size
+        else:
+            chunk_size = noise_target['batch_size']
+            #sums and square sums of the batch estimates (per packet) of js and nubars
+            batch_sums = np.zeros((2, self.no_of_shells))
+            batch_square_sums = np.zeros((2, self.no_of_shells))
+            no_of_batches = 0
+
+        chunk_end = 0
+        for chunk_start in xrange(0, no_of_packets, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, no_of_packets)
+            logger.debug('Running packets %d to %d of %d', chunk_start, chunk_end, no_of_packets)
+            self.create_packets(chunk_end - chunk_start, total_no_of_packets=no_of_packets)
+            montecarlo_output = self.run_montecarlo(no_of_virtual_packets, backend, packet_id_offset=chunk_start,
+                                                    reset_estimators=chunk_start == 0,
+                                                    progress_callback=chunk_progress_callback)
+            output_nus, output_energies, js, nubars = montecarlo_output[:4]
+
+            self.j_estimators += js
+            self.nubar_estimators += nubars
+            event_counters += montecarlo_output[-1]
+            self.tally_packets(output_nus, output_energies)
+            if self.montecarlo_nu is not None:
+                self.montecarlo_nu[chunk_start:chunk_end] = output_nus
+                self.montecarlo_energies[chunk_start:chunk_end] = output_energies
+
+            if noise_target is not None:
+                batch_estimates = np.array((js, nubars)) / (chunk_end - chunk_start)
+                batch_sums += batch_estimates
+                batch_square_sums += batch_estimates ** 2
+                no_of_batches += 1
+                if no_of_batches >= noise_target['min_batches']:
+                    max_relative_error = batch_relative_standard_errors(batch_sums, batch_square_sums,
+                                                                        no_of_batches).max()
+                    if max_relative_error < noise_target['relative_error']:
+                        logger.info('Noise target reached after %d of %d packets (relative error %.3g)', chunk_end,
+                                    no_of_packets, max_relative_error)
+                        break
+                if noise_target['max_time'] is not None and time.time() - start_time > noise_target['max_time']:
+                    logger.warning('Stopping after %d of %d packets because of the time limit', chunk_end,
+                                   no_of_packets)
+                    break
+
+        self.no_of_packets_executed = chunk_end
+        if chunk_end < no_of_packets:
+            #the packets were created with 1 / no_of_packets of the energy each
+            energy_scale = float(no_of_packets) / chunk_end
+            self.j_estimators *= energy_scale
+            self.nubar_estimators *= energy_scale
+            for grid in self.spectrum_grids:
+                grid.histograms *= energy_scale
+            self.emitted_packet_energy *= energy_scale
+            self.reabsorbed_packet_energy *= energy_scale
+            if 'j_blues' in self.estimators:
+                self.j_blues *= energy_scale
+            if 'line_tallies' in self.estimators:
+                self.line_interaction_energies *= energy_scale
+            if self.montecarlo_nu is not None:
+                self.montecarlo_nu = self.montecarlo_nu[:chunk_end]
+                self.montecarlo_energies = self.montecarlo_energies[:chunk_end]
+                self.montecarlo_energies *= energy_scale
+
+        if self.montecarlo_nu is not None:
+            packet_output.flush()
+
+        return event_counters
+
     def update_radiationfield(self, log_sampling=5):
         """
         Updating radiation field
@@ -415,15 +951,15 @@ class Radial1DModel(object):
         old_ws = self.ws.copy()
         old_t_inner = self.t_inner
 
-        emitted_energy = self.emitted_inner_energy * \
-                         np.sum(self.montecarlo_energies[self.montecarlo_energies >= 0]) / 1.
-        absorbed_energy = self.emitted_inner_energy * \
-                          np.sum(self.montecarlo_energies[self.montecarlo_energies < 0]) / -1.
+        emitted_energy = self.emitted_inner_energy * self.emitted_packet_energy
+        absorbed_energy = self.emitted_inner_energy * self.reabsorbed_packet_energy
         updated_t_inner = self.t_inner * (emitted_energy / self.luminosity_outer) ** -.25
 
         convergence_t_rads = abs(old_t_rads - updated_t_rads) / updated_t_rads
         convergence_ws = abs(old_ws - updated_ws) / updated_ws
         convergence_t_inner = abs(old_t_inner - updated_t_inner) / updated_t_inner
+        #relative changes of this update (before damping), e.g. for `simulation.AdaptivePacketSchedule`
+        self.convergence_ratios = {'t_rad': convergence_t_rads, 'w': convergence_ws, 't_inner': convergence_t_inner}
 
         if self.convergence_type == 'damped':
             self.t_rads += self.t_rad_convergence_parameters['damping_constant'] * (updated_t_rads - self.t_rads)
@@ -553,6 +1089,12 @@ class Radial1DModel(object):
         spectrum_virtual = pd.DataFrame.from_dict(dict(wave=self.spec_angstrom, flux=self.spec_virtual_flux_angstrom))
         spectrum_virtual.to_hdf(hdf_store, os.path.join(path, 'spectrum_virtual'))
 
+        spectrum_formal = pd.DataFrame.from_dict(dict(wave=self.spec_angstrom, flux=self.spec_formal_flux_angstrom))
+        spectrum_formal.to_hdf(hdf_store, os.path.join(path, 'spectrum_formal'))
+
+        for name, spectrum_grid_flux in self.spectrum_grid_fluxes.items():
+            spectrum_grid_flux.to_hdf(hdf_store, os.path.join(path, 'spectrum_grids', name))
+
         hdf_store.flush()
         return hdf_store
 
@@ -577,6 +1119,8 @@ class Radial1DModel(object):
     def save_spectrum(self, prefix):
         np.savetxt(prefix + '_virtual_spec.dat', zip(self.spec_angstrom, self.spec_virtual_flux_angstrom))
         np.savetxt(prefix + '_spec.dat', zip(self.spec_angstrom, self.spec_flux_angstrom))
+        if self.tardis_config.formal_integral:
+            np.savetxt(prefix + '_formal_spec.dat', zip(self.spec_angstrom, self.spec_formal_flux_angstrom))
 
 
 class ModelHistory(object):
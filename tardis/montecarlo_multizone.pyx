@@ -1,4 +1,4 @@
-# cython: profile=True
+# cython: profile=False
 # cython: boundscheck=False
 # cython: wraparound=False
 # cython: cdivision=True
@@ -18,12 +18,15 @@ from cython.parallel import *
 
 ctypedef np.float64_t float_type_t
 ctypedef np.int64_t int_type_t
+#element type of the large line arrays in the single precision storage mode
+ctypedef np.float32_t single_float_type_t
 
 
-cdef extern from "math.h":
+cdef extern from "math.h" nogil:
     float_type_t log(float_type_t)
     float_type_t sqrt(float_type_t)
     float_type_t exp(float_type_t)
+    float_type_t cos(float_type_t)
     int_type_t floor(float_type_t)
     bint isnan(double x)
 
@@ -41,247 +44,804 @@ cdef extern from "randomkit/randomkit.h":
         RK_ENODEV = 1
         RK_ERR_MAX = 2
 
-    void rk_seed(unsigned long seed, rk_state *state)
-    float_type_t rk_double(rk_state *state)
-cdef rk_state mt_state
+    void rk_seed(unsigned long seed, rk_state *state) nogil
+    float_type_t rk_double(rk_state *state) nogil
+
+cdef extern from "randomkit/rk_sobol.h":
+    ctypedef struct rk_sobol_state:
+        size_t dimension
+        unsigned long *direction
+        unsigned long *numerator
+        unsigned long count
+        unsigned long gcount
+
+    ctypedef enum rk_sobol_error:
+        RK_SOBOL_OK = 0
+        RK_SOBOL_EINVAL = 1
+        RK_SOBOL_EXHAUST = 2
+        RK_SOBOL_ENOMEM = 3
+
+    char *rk_sobol_strerror[]
+    unsigned long rk_sobol_Ldirections[]
+
+    rk_sobol_error rk_sobol_init(size_t dimension, rk_sobol_state *s, rk_state *rs_dir, unsigned long *directions,
+                                 unsigned long *polynomials)
+    void rk_sobol_randomshift(rk_sobol_state *s, rk_state *rs_num)
+    rk_sobol_error rk_sobol_double(rk_sobol_state *s, double *x)
+    void rk_sobol_free(rk_sobol_state *s)
+
+cdef extern from "stdlib.h":
+    void *malloc(size_t size) nogil
+    void free(void *ptr) nogil
+
+cdef extern from "stdint.h":
+    ctypedef unsigned int uint32_t
+    ctypedef unsigned long long uint64_t
+
+
+#one record of the packet tracer - needs to match packet_event_dtype in packet_tracer.py
+ctypedef struct packet_event_t:
+    int_type_t packet_id
+    int_type_t event_type
+    int_type_t shell_id
+    int_type_t line_id
+    float_type_t r
+    float_type_t mu
+    float_type_t nu
+    float_type_t energy
+
+#bits of the estimator mask - selects the optional outputs filled by the kernel
+DEF ESTIMATOR_J_BLUES = 1
+DEF ESTIMATOR_LAST_INTERACTION = 2
+DEF ESTIMATOR_LINE_TALLIES = 4
+
+estimator_flags = {'j_blues': ESTIMATOR_J_BLUES, 'last_interaction': ESTIMATOR_LAST_INTERACTION,
+                   'line_tallies': ESTIMATOR_LINE_TALLIES}
+#estimators filled if `model.estimators` is not given
+default_estimators = ('j_blues', 'last_interaction')
+
+#rows of the line interaction tallies (see `tardis.analysis.LineInteractionTallies`)
+DEF TALLY_ABSORBED = 0
+DEF TALLY_EMITTED = 1
+
+#spacings of the spectrum grids and rows of their histograms (see spectrum_grid.py)
+DEF GRID_SPACING_LINEAR = 0
+DEF GRID_SPACING_LOG = 1
+DEF GRID_SPACING_IRREGULAR = 2
+DEF SPECTRUM_EMITTED = 0
+DEF SPECTRUM_REABSORBED = 1
+DEF SPECTRUM_VIRTUAL = 2
+
+#event types of the packet tracer (see packet_tracer.py)
+DEF EVENT_START = 0
+DEF EVENT_OUTER_BOUNDARY = 1
+DEF EVENT_INNER_BOUNDARY = 2
+DEF EVENT_ELECTRON_SCATTERING = 3
+DEF EVENT_LINE_INTERACTION = 4
+DEF EVENT_ESCAPED = 5
+DEF EVENT_REABSORBED = 6
+DEF EVENT_DIFFUSION = 7
+
+#rows of the per-shell event counters (see `event_counter_names`)
+DEF COUNTER_LINE_INTERACTIONS = 0
+DEF COUNTER_ELECTRON_SCATTERINGS = 1
+DEF COUNTER_BOUNDARY_CROSSINGS = 2
+DEF COUNTER_MACRO_ATOM_JUMPS = 3
+DEF COUNTER_REABSORPTIONS = 4
+DEF COUNTER_STEPS = 5
+DEF COUNTER_VIRTUAL_STEPS = 6
+DEF COUNTER_DIFFUSION_STEPS = 7
+DEF NO_OF_EVENT_COUNTERS = 8
+
+event_counter_names = ['line_interactions', 'electron_scatterings', 'boundary_crossings', 'macro_atom_jumps',
+                       'reabsorptions', 'steps', 'virtual_steps', 'diffusion_steps']
+
+#numerical problems counted by the threads and logged after the packet loop (see `numerical_warning_messages`)
+DEF WARNING_MU_ZERO = 0
+DEF WARNING_COMOVING_NU_BELOW_LINE = 1
+DEF WARNING_NEGATIVE_ENERGY = 2
+DEF NO_OF_NUMERICAL_WARNINGS = 3
+
+numerical_warning_messages = ['the direction cosine of a packet turned 0 when it was moved',
+                              'the comoving frequency of a packet was below the frequency of its next line',
+                              'a packet finished with a negative energy']
+
+
+#Counter-based random numbers (Philox4x32-10, Salmon et al. 2011). Every packet gets its own stream keyed on the
+#seed and the iteration with the packet id in the counter, so a packet's random numbers do not depend on the order in
+#which packets are processed (or on which thread or process runs them).
+ctypedef struct packet_rng_state_t:
+    uint32_t counter[4]
+    uint32_t key[2]
+    uint32_t output[4]
+    int_type_t output_pos
+
+DEF PHILOX_M0 = 0xD2511F53
+DEF PHILOX_M1 = 0xCD9E8D57
+DEF PHILOX_W0 = 0x9E3779B9
+DEF PHILOX_W1 = 0xBB67AE85
+
+
+cdef inline void philox4x32_10(uint32_t*counter, uint32_t*key, uint32_t*output) nogil:
+    cdef uint32_t c0 = counter[0], c1 = counter[1], c2 = counter[2], c3 = counter[3]
+    cdef uint32_t k0 = key[0], k1 = key[1]
+    cdef uint64_t product0, product1
+    cdef int i
+    for i in range(10):
+        product0 = <uint64_t> PHILOX_M0 * c0
+        product1 = <uint64_t> PHILOX_M1 * c2
+        c0 = <uint32_t> (product1 >> 32) ^ c1 ^ k0
+        c1 = <uint32_t> product1
+        c2 = <uint32_t> (product0 >> 32) ^ c3 ^ k1
+        c3 = <uint32_t> product0
+        k0 = k0 + <uint32_t> PHILOX_W0
+        k1 = k1 + <uint32_t> PHILOX_W1
+    output[0] = c0
+    output[1] = c1
+    output[2] = c2
+    output[3] = c3
+
+
+cdef inline void packet_rng_seed(packet_rng_state_t*state, uint64_t seed, uint64_t iteration,
+                                 uint64_t packet_id) nogil:
+    state.key[0] = <uint32_t> seed
+    state.key[1] = <uint32_t> (seed >> 32)
+    state.counter[0] = 0
+    state.counter[1] = <uint32_t> packet_id
+    state.counter[2] = <uint32_t> (packet_id >> 32)
+    state.counter[3] = <uint32_t> iteration
+    state.output_pos = 4
+
+
+cdef inline float_type_t packet_rng_double(packet_rng_state_t*state) nogil:
+    """
+    Uniform double in [0, 1) with 53 random bits (same construction as rk_double)
+    """
+    cdef uint32_t a, b
+    if state.output_pos > 2:
+        philox4x32_10(state.counter, state.key, state.output)
+        state.counter[0] += 1
+        state.output_pos = 0
+    a = state.output[state.output_pos] >> 5
+    b = state.output[state.output_pos + 1] >> 6
+    state.output_pos += 2
+    return (a * 67108864.0 + b) / 9007199254740992.0
+
+
+ctypedef struct storage_model_t:
+    float_type_t*packet_nus
+    float_type_t*packet_mus
+    float_type_t*packet_energies
+    float_type_t*output_nus
+    float_type_t*output_energies
+    int_type_t*last_line_interaction_in_id
+    int_type_t*last_line_interaction_out_id
+    int_type_t*last_line_interaction_shell_id
+    int_type_t*last_interaction_type
+    int_type_t no_of_packets
+    int_type_t no_of_shells
+    float_type_t*r_inner
+    float_type_t*r_outer
+    float_type_t*v_inner
+    float_type_t time_explosion
+    float_type_t inverse_time_explosion
+    float_type_t*electron_densities
+    float_type_t*inverse_electron_densities
+    float_type_t*line_list_nu
+    #in the single precision storage mode the *_single pointers are set (and the double ones are NULL); the j_blues are
+    #always accumulated in double precision
+    float_type_t*line_lists_tau_sobolevs
+    single_float_type_t*line_lists_tau_sobolevs_single
+    int_type_t line_lists_tau_sobolevs_nd
+    int_type_t line_skipping
+    int_type_t*next_significant_line
+    float_type_t*tau_skipped_cumulative
+    float_type_t*line_lists_j_blues
+    int_type_t line_lists_j_blues_nd
+    int_type_t no_of_lines
+    int_type_t*line_bucket_line_ids
+    int_type_t no_of_line_buckets
+    float_type_t line_bucket_log_nu_min
+    float_type_t line_bucket_inverse_log_width
+    int_type_t line_interaction_id
+    float_type_t*transition_cumulative_probabilities
+    single_float_type_t*transition_cumulative_probabilities_single
+    int_type_t transition_probabilities_nd
+    int_type_t*line2macro_level_upper
+    int_type_t*macro_block_references
+    int_type_t*transition_type
+    int_type_t*destination_level_id
+    int_type_t*transition_line_id
+    float_type_t*js
+    float_type_t*nubars
+    #NO_OF_EVENT_COUNTERS rows of no_of_shells counters
+    int_type_t*event_counters
+    #NO_OF_NUMERICAL_WARNINGS counters
+    int_type_t*numerical_warnings
+    #number of line interactions and their energy (absorbed at the line / emitted by the line) in every shell: rows
+    #TALLY_ABSORBED and TALLY_EMITTED of no_of_shells x no_of_lines tallies
+    int_type_t*line_tally_counts
+    float_type_t*line_tally_energies
+    #spectrum grids (see `tardis.spectrum_grid.SpectrumGrid`), the bin edges of grid k start at
+    #spectrum_grid_nu_bins[spectrum_grid_offsets[k] + k]
+    int_type_t no_of_spectrum_grids
+    int_type_t*spectrum_grid_spacings
+    int_type_t*spectrum_grid_offsets
+    float_type_t*spectrum_grid_inverse_deltas
+    float_type_t*spectrum_grid_nu_bins
+    #emitted, reabsorbed and virtual histograms of all grids (3 rows of spectrum_grid_offsets[no_of_spectrum_grids])
+    float_type_t*spectrum_histograms
+    float_type_t sigma_thomson
+    float_type_t inverse_sigma_thomson
+    float_type_t virtual_packet_tau_cutoff
+    float_type_t virtual_packet_survival_probability
+    #shells with an electron scattering optical depth above this are crossed with random walk steps (0 is off)
+    float_type_t diffusion_tau_threshold
+    float_type_t*packet_tau_randoms
+    int_type_t current_packet_id
+    int_type_t packet_id_offset
+    int_type_t estimator_mask
+    packet_event_t*trace_events
+    int_type_t*trace_position
+    int_type_t trace_segment_size
+    int_type_t trace_sampling
+    int_type_t trace_current_packet
+    uint64_t seed
+    uint64_t iteration
+    packet_rng_state_t rng_state
+
+
+cdef object refill_array(object array, tuple shape, object dtype, object fill_value):
+    """
+    Fill `array` with `fill_value` in place, or allocate a new array if it does not exist yet or has a different
+    shape.
+    """
+    if array is None or array.shape != shape or array.dtype != dtype:
+        array = np.empty(shape, dtype=dtype)
+    array.fill(fill_value)
+    return array
+
+
+def calculate_estimator_mask(estimators):
+    """
+    Bit mask of the optional estimators named in `estimators` (see `estimator_flags`). `None` selects the
+    `default_estimators`.
+    """
+    if estimators is None:
+        estimators = default_estimators
+    unknown_estimators = set(estimators) - set(estimator_flags)
+    if unknown_estimators:
+        raise ValueError('Unknown estimators %s (known are %s)' % (', '.join(sorted(unknown_estimators)),
+                                                                  ', '.join(sorted(estimator_flags))))
+    return sum(estimator_flags[estimator] for estimator in set(estimators))
+
+
+cdef np.ndarray check_line_array(object array, str name, object dtype=None):
+    """
+    Check that one of the large line arrays is C-contiguous with a float64 or float32 (single precision storage) dtype,
+    which has to be `dtype` if given.
+    """
+    if array.dtype not in (np.float64, np.float32):
+        raise ValueError('%s has to be float64 or float32 (is %s)' % (name, array.dtype))
+    if dtype is not None and array.dtype != dtype:
+        raise ValueError('%s has to be %s like tau_sobolevs (is %s)' % (name, np.dtype(dtype), array.dtype))
+    if not array.flags['C_CONTIGUOUS']:
+        raise ValueError('%s has to be C-contiguous' % name)
+    return array
+
+
+cdef void*double_data(np.ndarray array):
+    return array.data if array.dtype == np.float64 else NULL
+
+
+cdef void*single_data(np.ndarray array):
+    return array.data if array.dtype == np.float32 else NULL
+
 
-cdef np.ndarray x
 cdef class StorageModel:
     """
     Class for storing the arrays in a cythonized way (as pointers). This ensures fast access during the calculations.
+
+    All pointers are collected in a `storage_model_t` struct so that the packet loop can run without the GIL. For a
+    multi-threaded run every thread gets its own copy of that struct, pointing to private `js`, `nubars`, j_blue and
+    virtual spectrum buffers. These are reduced by `reduce_thread_estimators` once all packets are done. The random
+    number state in the struct is reseeded for every packet from (seed, iteration, packet id).
+
+    A storage can be created empty (`StorageModel(no_of_threads=n)`) and be refilled with `update` before every run,
+    which keeps the allocations off the iteration loop (see `Radial1DModel.montecarlo_storage`).
     """
 
+    cdef storage_model_t storage
+    cdef storage_model_t*thread_storages
+    cdef readonly int_type_t no_of_threads
+    cdef bint single_precision
+
     cdef np.ndarray packet_nus_a
-    cdef float_type_t*packet_nus
     cdef np.ndarray packet_mus_a
-    cdef float_type_t*packet_mus
     cdef np.ndarray packet_energies_a
-    cdef float_type_t*packet_energies
+    cdef np.ndarray packet_tau_randoms_a
     ######## Setting up the output ########
     cdef np.ndarray output_nus_a
-    cdef float_type_t*output_nus
     cdef np.ndarray output_energies_a
-    cdef float_type_t*output_energies
 
     cdef np.ndarray last_line_interaction_in_id_a
-    cdef int_type_t*last_line_interaction_in_id
-
     cdef np.ndarray last_line_interaction_out_id_a
-    cdef int_type_t*last_line_interaction_out_id
-
     cdef np.ndarray last_line_interaction_shell_id_a
-    cdef int_type_t*last_line_interaction_shell_id
-
     cdef np.ndarray last_interaction_type_a
-    cdef int_type_t*last_interaction_type
 
-    cdef int_type_t no_of_packets
-    cdef int_type_t no_of_shells
     cdef np.ndarray r_inner_a
-    cdef float_type_t*r_inner
     cdef np.ndarray r_outer_a
-    cdef float_type_t*r_outer
     cdef np.ndarray v_inner_a
-    cdef float_type_t*v_inner
-    cdef float_type_t time_explosion
-    cdef float_type_t inverse_time_explosion
     cdef np.ndarray electron_densities_a
-    cdef float_type_t*electron_densities
     cdef np.ndarray inverse_electron_densities_a
-    cdef float_type_t*inverse_electron_densities
     cdef np.ndarray line_list_nu_a
-    cdef float_type_t*line_list_nu
     cdef np.ndarray line_lists_tau_sobolevs_a
-    cdef float_type_t*line_lists_tau_sobolevs
-    cdef int_type_t line_lists_tau_sobolevs_nd
 
     #J_BLUES initialize
     cdef np.ndarray line_lists_j_blues_a
-    cdef float_type_t*line_lists_j_blues
-    cdef int_type_t line_lists_j_blues_nd
-
-    cdef int_type_t no_of_lines
-    cdef int_type_t line_interaction_id
-    cdef np.ndarray transition_probabilities_a
-    cdef float_type_t*transition_probabilities
-    cdef int_type_t transition_probabilities_nd
+
+    cdef np.ndarray transition_cumulative_probabilities_a
     cdef np.ndarray line2macro_level_upper_a
-    cdef int_type_t*line2macro_level_upper
     cdef np.ndarray macro_block_references_a
-    cdef int_type_t*macro_block_references
     cdef np.ndarray transition_type_a
-    cdef int_type_t*transition_type
     cdef np.ndarray destination_level_id_a
-    cdef int_type_t*destination_level_id
     cdef np.ndarray transition_line_id_a
-    cdef int_type_t*transition_line_id
     cdef np.ndarray js_a
-    cdef float_type_t*js
     cdef np.ndarray nubars_a
-    cdef float_type_t*nubars
-    cdef float_type_t spectrum_start_nu
-    cdef float_type_t spectrum_delta_nu
-    cdef float_type_t spectrum_end_nu
-    cdef float_type_t*spectrum_virt_nu
-
-    cdef float_type_t sigma_thomson
-    cdef float_type_t inverse_sigma_thomson
-    cdef int_type_t current_packet_id
-
-    def __init__(self, model):
-
-        rk_seed(250819801106, &mt_state)
+    cdef np.ndarray event_counters_a
+    cdef np.ndarray numerical_warnings_a
+    cdef np.ndarray line_tally_counts_a
+    cdef np.ndarray line_tally_energies_a
+    cdef np.ndarray spectrum_grid_spacings_a
+    cdef np.ndarray spectrum_grid_offsets_a
+    cdef np.ndarray spectrum_grid_inverse_deltas_a
+    cdef np.ndarray spectrum_grid_nu_bins_a
+    cdef np.ndarray spectrum_histograms_a
+    cdef list spectrum_grids
+    cdef np.ndarray next_significant_line_a
+    cdef np.ndarray line_bucket_line_ids_a
+    cdef np.ndarray trace_buffer_a
+    cdef np.ndarray trace_positions_a
+    cdef np.ndarray tau_skipped_cumulative_a
+
+    #private estimators of the threads 1 ... no_of_threads - 1 (thread 0 writes straight into the model arrays)
+    cdef np.ndarray thread_line_lists_j_blues_a
+    cdef np.ndarray thread_line_tally_counts_a
+    cdef np.ndarray thread_line_tally_energies_a
+
+    def __cinit__(self, model=None, no_of_threads=1):
+        self.no_of_threads = max(1, no_of_threads)
+        self.thread_storages = <storage_model_t*> malloc(self.no_of_threads * sizeof(storage_model_t))
+        if self.thread_storages == NULL:
+            raise MemoryError('Could not allocate the thread storage for %d threads' % self.no_of_threads)
+
+    def __dealloc__(self):
+        free(self.thread_storages)
+
+    def __init__(self, model=None, no_of_threads=1):
+        if model is not None:
+            self.update(model)
+
+    def update(self, model, reset_estimators=True, StorageModel line_list_storage=None):
+        """
+        (Re)fill the storage from `model`. The model arrays are referenced, not copied. The arrays owned by the storage
+        (output arrays, estimators of the threads, inverse electron densities and the line lookup table) are only
+        allocated when their size changes and are otherwise reset in place, so a storage kept over the iterations of a
+        model does not allocate anything per iteration. The returned output arrays are therefore overwritten by the
+        next run. With `reset_estimators` set to `False` the j_blue estimators are added to the values already in
+        `model.j_blues` (for running the packets of an iteration in chunks). With a `line_list_storage` (updated before
+        from a model with the same line list) its line list and lookup table are used instead of building them again.
+        """
 
         cdef np.ndarray[float_type_t, ndim=1] packet_nus = model.packet_src.packet_nus
         self.packet_nus_a = packet_nus
-        self.packet_nus = <float_type_t*> self.packet_nus_a.data
+        self.storage.packet_nus = <float_type_t*> self.packet_nus_a.data
         #
         cdef np.ndarray[float_type_t, ndim=1] packet_mus = model.packet_src.packet_mus
         self.packet_mus_a = packet_mus
-        self.packet_mus = <float_type_t*> self.packet_mus_a.data
+        self.storage.packet_mus = <float_type_t*> self.packet_mus_a.data
         #
         cdef np.ndarray[float_type_t, ndim=1] packet_energies = model.packet_src.packet_energies
         self.packet_energies_a = packet_energies
-        self.packet_energies = <float_type_t*> self.packet_energies_a.data
+        self.storage.packet_energies = <float_type_t*> self.packet_energies_a.data
         #
-        self.no_of_packets = packet_nus.size
+        self.storage.no_of_packets = packet_nus.size
         #@@@ Setup of Geometry @@@
-        self.no_of_shells = model.no_of_shells
+        self.storage.no_of_shells = model.no_of_shells
         cdef np.ndarray[float_type_t, ndim=1] r_inner = model.r_inner
         self.r_inner_a = r_inner
-        self.r_inner = <float_type_t*> self.r_inner_a.data
+        self.storage.r_inner = <float_type_t*> self.r_inner_a.data
         #
         cdef np.ndarray[float_type_t, ndim=1] r_outer = model.r_outer
         self.r_outer_a = r_outer
-        self.r_outer = <float_type_t*> self.r_outer_a.data
+        self.storage.r_outer = <float_type_t*> self.r_outer_a.data
         #
         cdef np.ndarray[float_type_t, ndim=1] v_inner = model.v_inner
         self.v_inner_a = v_inner
-        self.v_inner = <float_type_t*> self.v_inner_a.data
+        self.storage.v_inner = <float_type_t*> self.v_inner_a.data
         #@@@ Setup the rest @@@
         #times
-        self.time_explosion = model.time_explosion
-        self.inverse_time_explosion = 1 / model.time_explosion
+        self.storage.time_explosion = model.time_explosion
+        self.storage.inverse_time_explosion = 1 / model.time_explosion
         #electron density
         cdef np.ndarray[float_type_t, ndim=1] electron_densities = model.electron_densities
         self.electron_densities_a = electron_densities
-        self.electron_densities = <float_type_t*> self.electron_densities_a.data
+        self.storage.electron_densities = <float_type_t*> self.electron_densities_a.data
         #
-        cdef np.ndarray[float_type_t, ndim=1] inverse_electron_densities = 1 / electron_densities
-        self.inverse_electron_densities_a = inverse_electron_densities
-        self.inverse_electron_densities = <float_type_t*> self.inverse_electron_densities_a.data
+        self.inverse_electron_densities_a = refill_array(self.inverse_electron_densities_a, (electron_densities.size,),
+                                                         np.float64, 0.0)
+        np.divide(1.0, electron_densities, out=self.inverse_electron_densities_a)
+        self.storage.inverse_electron_densities = <float_type_t*> self.inverse_electron_densities_a.data
         #Line lists
         cdef np.ndarray[float_type_t, ndim=1] line_list_nu = model.line_list_nu.values
-        self.line_list_nu_a = line_list_nu
-        self.line_list_nu = <float_type_t*> self.line_list_nu_a.data
-        #
-        self.no_of_lines = line_list_nu.size
-
-        cdef np.ndarray[float_type_t, ndim=2] line_lists_tau_sobolevs = model.tau_sobolevs
-        self.line_lists_tau_sobolevs_a = line_lists_tau_sobolevs
-        self.line_lists_tau_sobolevs = <float_type_t*> self.line_lists_tau_sobolevs_a.data
-        self.line_lists_tau_sobolevs_nd = self.line_lists_tau_sobolevs_a.shape[1]
-
-        cdef np.ndarray[float_type_t, ndim=2] line_lists_j_blues = model.j_blues
-        model.j_blues[:] = 0.0
-        self.line_lists_j_blues_a = line_lists_j_blues
-        self.line_lists_j_blues = <float_type_t*> self.line_lists_j_blues_a.data
-        self.line_lists_j_blues_nd = self.line_lists_j_blues_a.shape[1]
+        if line_list_storage is not None:
+            self.share_line_list(line_list_storage)
+        else:
+            #the lookup table only depends on the line list, which normally stays the same over the iterations
+            rebuild_line_buckets = line_list_nu is not self.line_list_nu_a
+            self.line_list_nu_a = line_list_nu
+            self.storage.line_list_nu = <float_type_t*> self.line_list_nu_a.data
+            #
+            self.storage.no_of_lines = line_list_nu.size
+            if rebuild_line_buckets:
+                self.setup_line_buckets()
+
+        #tau_sobolevs, j_blues and the transition probabilities are either all float64 or all float32 (float32 j_blues are
+        #accumulated in private float64 arrays, see `setup_thread_storages`)
+        self.line_lists_tau_sobolevs_a = check_line_array(model.tau_sobolevs, 'tau_sobolevs')
+        self.single_precision = self.line_lists_tau_sobolevs_a.dtype == np.float32
+        self.storage.line_lists_tau_sobolevs = <float_type_t*> double_data(self.line_lists_tau_sobolevs_a)
+        self.storage.line_lists_tau_sobolevs_single = <single_float_type_t*> single_data(self.line_lists_tau_sobolevs_a)
+        self.storage.line_lists_tau_sobolevs_nd = self.line_lists_tau_sobolevs_a.shape[1]
+
+        #optional outputs (`model.estimators`, all if not given)
+        self.storage.estimator_mask = calculate_estimator_mask(getattr(model, 'estimators', None))
+
+        if reset_estimators and self.storage.estimator_mask & ESTIMATOR_J_BLUES:
+            model.j_blues[:] = 0.0
+        self.line_lists_j_blues_a = check_line_array(model.j_blues, 'j_blues', self.line_lists_tau_sobolevs_a.dtype)
+        self.storage.line_lists_j_blues = <float_type_t*> double_data(self.line_lists_j_blues_a)
+        self.storage.line_lists_j_blues_nd = self.line_lists_j_blues_a.shape[1]
+
+        if self.storage.estimator_mask & ESTIMATOR_LINE_TALLIES:
+            self.line_tally_counts_a = model.line_interaction_counts
+            self.line_tally_energies_a = model.line_interaction_energies
+            tally_shape = (2, model.no_of_shells, self.storage.no_of_lines)
+            for tallies, dtype in ((model.line_interaction_counts, np.int64),
+                                   (model.line_interaction_energies, np.float64)):
+                if tallies.shape != tally_shape or tallies.dtype != dtype or not tallies.flags['C_CONTIGUOUS']:
+                    raise ValueError('The line interaction tallies need to be C-contiguous %s arrays of the shape %s' %
+                                     (np.dtype(dtype).name, tally_shape))
+            if reset_estimators:
+                self.line_tally_counts_a.fill(0)
+                self.line_tally_energies_a.fill(0.0)
+            self.storage.line_tally_counts = <int_type_t*> self.line_tally_counts_a.data
+            self.storage.line_tally_energies = <float_type_t*> self.line_tally_energies_a.data
+        else:
+            self.line_tally_counts_a = None
+            self.line_tally_energies_a = None
+            self.storage.line_tally_counts = NULL
+            self.storage.line_tally_energies = NULL
 
         #
-        self.line_interaction_id = model.line_interaction_id
+        self.storage.line_interaction_id = model.line_interaction_id
         #macro atom & downbranch
-        cdef np.ndarray[float_type_t, ndim=2] transition_probabilities
         cdef np.ndarray[int_type_t, ndim=1] line2macro_level_upper
         cdef np.ndarray[int_type_t, ndim=1] macro_block_references
         cdef np.ndarray[int_type_t, ndim=1] transition_type
         cdef np.ndarray[int_type_t, ndim=1] destination_level_id
         cdef np.ndarray[int_type_t, ndim=1] transition_line_id
         if model.line_interaction_id >= 1:
-            transition_probabilities = model.transition_probabilities
-            self.transition_probabilities_a = transition_probabilities
-            self.transition_probabilities = <float_type_t*> self.transition_probabilities_a.data
-            self.transition_probabilities_nd = self.transition_probabilities_a.shape[1]
+            self.transition_cumulative_probabilities_a = check_line_array(model.transition_cumulative_probabilities,
+                                                                          'transition_cumulative_probabilities',
+                                                                          self.line_lists_tau_sobolevs_a.dtype)
+            self.storage.transition_cumulative_probabilities = \
+                <float_type_t*> double_data(self.transition_cumulative_probabilities_a)
+            self.storage.transition_cumulative_probabilities_single = \
+                <single_float_type_t*> single_data(self.transition_cumulative_probabilities_a)
+            self.storage.transition_probabilities_nd = self.transition_cumulative_probabilities_a.shape[1]
             #
-            line2macro_level_upper = model.atom_data.lines_upper2macro_reference_idx
+            #line references of the macro atom relative to the line list of the model (see `Radial1DModel.line_window`)
+            line2macro_level_upper = model.line2macro_level_upper
             self.line2macro_level_upper_a = line2macro_level_upper
-            self.line2macro_level_upper = <int_type_t*> self.line2macro_level_upper_a.data
-            macro_block_references = model.atom_data.macro_atom_references['block_references'].values
+            self.storage.line2macro_level_upper = <int_type_t*> self.line2macro_level_upper_a.data
+            #the end of the last block is appended so every block has an upper bound
+            macro_block_references = np.hstack((model.atom_data.macro_atom_references['block_references'].values,
+                                                self.storage.transition_probabilities_nd)).astype(np.int64)
             self.macro_block_references_a = macro_block_references
-            self.macro_block_references = <int_type_t*> self.macro_block_references_a.data
+            self.storage.macro_block_references = <int_type_t*> self.macro_block_references_a.data
             transition_type = model.atom_data.macro_atom_data['transition_type'].values
             self.transition_type_a = transition_type
-            self.transition_type = <int_type_t*> self.transition_type_a.data
+            self.storage.transition_type = <int_type_t*> self.transition_type_a.data
 
             #Destination level is not needed and/or generated for downbranch
             destination_level_id = model.atom_data.macro_atom_data['destination_level_idx'].values
-            #print "preparing stuff " , destination_level_id[0], destination_level_id[5], destination_level_id[10]
             self.destination_level_id_a = destination_level_id
-            #print "preparing stuff(2) " , self.destination_level_id_a[0], self.destination_level_id_a[5], self.destination_level_id_a[10]
-            self.destination_level_id = <int_type_t*> self.destination_level_id_a.data
+            self.storage.destination_level_id = <int_type_t*> self.destination_level_id_a.data
 
-            #print "preparing stuff(3) " , self.destination_level_id[0], self.destination_level_id[5], self.destination_level_id[10]
-            transition_line_id = model.atom_data.macro_atom_data['lines_idx'].values
+            transition_line_id = model.transition_line_id
             self.transition_line_id_a = transition_line_id
-            self.transition_line_id = <int_type_t*> self.transition_line_id_a.data
-
-        cdef np.ndarray[float_type_t, ndim=1] output_nus = np.zeros(self.no_of_packets, dtype=np.float64)
-        cdef np.ndarray[float_type_t, ndim=1] output_energies = np.zeros(self.no_of_packets, dtype=np.float64)
-
-        self.output_nus_a = output_nus
-        self.output_nus = <float_type_t*> self.output_nus_a.data
-
-        self.output_energies_a = output_energies
-        self.output_energies = <float_type_t*> self.output_energies_a.data
-
-        cdef np.ndarray[int_type_t, ndim=1] last_line_interaction_in_id = -1 * np.ones(self.no_of_packets,
-                                                                                       dtype=np.int64)
-        cdef np.ndarray[int_type_t, ndim=1] last_line_interaction_out_id = -1 * np.ones(self.no_of_packets,
-                                                                                        dtype=np.int64)
-
-        cdef np.ndarray[int_type_t, ndim=1] last_line_interaction_shell_id = -1 * np.ones(self.no_of_packets,
-                                                                                          dtype=np.int64)
-
-        cdef np.ndarray[int_type_t, ndim=1] last_interaction_type = -1 * np.ones(self.no_of_packets,
-                                                                                 dtype=np.int64)
-
-        self.last_line_interaction_in_id_a = last_line_interaction_in_id
-        self.last_line_interaction_in_id = <int_type_t*> self.last_line_interaction_in_id_a.data
-
-        self.last_line_interaction_out_id_a = last_line_interaction_out_id
-        self.last_line_interaction_out_id = <int_type_t*> self.last_line_interaction_out_id_a.data
-
-        self.last_line_interaction_shell_id_a = last_line_interaction_shell_id
-        self.last_line_interaction_shell_id = <int_type_t*> last_line_interaction_shell_id.data
-
-        self.last_interaction_type_a = last_interaction_type
-        self.last_interaction_type = <int_type_t*> last_interaction_type.data
-
-        cdef np.ndarray[float_type_t, ndim=1] js = np.zeros(model.no_of_shells, dtype=np.float64)
-        cdef np.ndarray[float_type_t, ndim=1] nubars = np.zeros(model.no_of_shells, dtype=np.float64)
-
-        self.js_a = js
-        self.js = <float_type_t*> self.js_a.data
-        self.nubars_a = nubars
-        self.nubars = <float_type_t*> self.nubars_a.data
-        self.spectrum_start_nu = model.spec_nu_bins.min()
-        self.spectrum_end_nu = model.spec_nu_bins.max()
-        self.spectrum_delta_nu = model.spec_nu_bins[1] - model.spec_nu_bins[0]
-
-        cdef np.ndarray[float_type_t, ndim=1] spectrum_virt_nu = model.spec_virtual_flux_nu
-        self.spectrum_virt_nu = <float_type_t*> spectrum_virt_nu.data
+            self.storage.transition_line_id = <int_type_t*> self.transition_line_id_a.data
+
+        cdef int_type_t no_of_packets = self.storage.no_of_packets
+        #the last interaction arrays are empty if they are not selected
+        cdef int_type_t no_of_last_interactions = no_of_packets
+        if not self.storage.estimator_mask & ESTIMATOR_LAST_INTERACTION:
+            no_of_last_interactions = 0
+
+        self.output_nus_a = refill_array(self.output_nus_a, (no_of_packets,), np.float64, 0.0)
+        self.storage.output_nus = <float_type_t*> self.output_nus_a.data
+
+        self.output_energies_a = refill_array(self.output_energies_a, (no_of_packets,), np.float64, 0.0)
+        self.storage.output_energies = <float_type_t*> self.output_energies_a.data
+
+        self.last_line_interaction_in_id_a = refill_array(self.last_line_interaction_in_id_a, (no_of_last_interactions,),
+                                                          np.int64, -1)
+        self.storage.last_line_interaction_in_id = <int_type_t*> self.last_line_interaction_in_id_a.data
+
+        self.last_line_interaction_out_id_a = refill_array(self.last_line_interaction_out_id_a, (no_of_last_interactions,),
+                                                           np.int64, -1)
+        self.storage.last_line_interaction_out_id = <int_type_t*> self.last_line_interaction_out_id_a.data
+
+        self.last_line_interaction_shell_id_a = refill_array(self.last_line_interaction_shell_id_a, (no_of_last_interactions,),
+                                                             np.int64, -1)
+        self.storage.last_line_interaction_shell_id = <int_type_t*> self.last_line_interaction_shell_id_a.data
+
+        self.last_interaction_type_a = refill_array(self.last_interaction_type_a, (no_of_last_interactions,), np.int64, -1)
+        self.storage.last_interaction_type = <int_type_t*> self.last_interaction_type_a.data
+
+        #one row of js and nubars per thread - summed up in reduce_thread_estimators
+        self.js_a = refill_array(self.js_a, (self.no_of_threads, model.no_of_shells), np.float64, 0.0)
+        self.storage.js = <float_type_t*> self.js_a.data
+        self.nubars_a = refill_array(self.nubars_a, (self.no_of_threads, model.no_of_shells), np.float64, 0.0)
+        self.storage.nubars = <float_type_t*> self.nubars_a.data
+        self.event_counters_a = refill_array(self.event_counters_a,
+                                             (self.no_of_threads, NO_OF_EVENT_COUNTERS, model.no_of_shells), np.int64, 0)
+        self.storage.event_counters = <int_type_t*> self.event_counters_a.data
+        self.numerical_warnings_a = refill_array(self.numerical_warnings_a,
+                                                 (self.no_of_threads, NO_OF_NUMERICAL_WARNINGS), np.int64, 0)
+        self.storage.numerical_warnings = <int_type_t*> self.numerical_warnings_a.data
+        self.setup_spectrum_grids(getattr(model, 'spectrum_grids', None) or [])
 
         if model.sigma_thomson is None:
-            self.sigma_thomson = 6.652486e-25 #cm^(-2)
+            self.storage.sigma_thomson = 6.652486e-25 #cm^(-2)
         else:
-            self.sigma_thomson = model.sigma_thomson
+            self.storage.sigma_thomson = model.sigma_thomson
 
-        self.inverse_sigma_thomson = 1 / self.sigma_thomson
+        self.storage.inverse_sigma_thomson = 1 / self.storage.sigma_thomson
 
-        self.current_packet_id = -1
-        #
-        #
-        #
+        self.storage.virtual_packet_tau_cutoff = model.virtual_packet_tau_cutoff
+        self.storage.virtual_packet_survival_probability = model.virtual_packet_survival_probability
+        self.storage.diffusion_tau_threshold = getattr(model, 'diffusion_tau_threshold', 0.0)
+
+        #uniform numbers for the first optical depth of every packet (given by quasi-random packet sources)
+        cdef np.ndarray[float_type_t, ndim=1] packet_tau_randoms
+        if getattr(model.packet_src, 'packet_tau_randoms', None) is not None:
+            packet_tau_randoms = model.packet_src.packet_tau_randoms
+            self.packet_tau_randoms_a = packet_tau_randoms
+            self.storage.packet_tau_randoms = <float_type_t*> packet_tau_randoms.data
+        else:
+            self.storage.packet_tau_randoms = NULL
+
+        #line skipping index (see `Radial1DModel.calculate_line_skipping_index`)
+        cdef np.ndarray[int_type_t, ndim=2] next_significant_line
+        cdef np.ndarray[float_type_t, ndim=2] tau_skipped_cumulative
+        if getattr(model, 'next_significant_line', None) is not None:
+            next_significant_line = model.next_significant_line
+            self.next_significant_line_a = next_significant_line
+            self.storage.next_significant_line = <int_type_t*> next_significant_line.data
+            tau_skipped_cumulative = model.tau_skipped_cumulative
+            self.tau_skipped_cumulative_a = tau_skipped_cumulative
+            self.storage.tau_skipped_cumulative = <float_type_t*> tau_skipped_cumulative.data
+            self.storage.line_skipping = 1
+        else:
+            self.storage.next_significant_line = NULL
+            self.storage.tau_skipped_cumulative = NULL
+            self.storage.line_skipping = 0
+
+        self.storage.current_packet_id = -1
+        self.storage.packet_id_offset = 0
+        self.storage.trace_events = NULL
+        self.storage.trace_position = NULL
+        self.storage.trace_segment_size = 0
+        self.storage.trace_sampling = 1
+        self.storage.trace_current_packet = 0
+        self.storage.seed = model.seed
+        self.storage.iteration = model.iterations_executed
+
+        self.setup_thread_storages()
+
+    cdef setup_line_buckets(self):
+        """
+        Build the frequency bucket table for the line list lookup. The range of the line list is split into buckets of
+        equal width in log(nu) (about `lines_per_bucket` lines each). `line_bucket_line_ids[k]` is the id of the first
+        line with a frequency below the lower edge of bucket k, so all lines of bucket k lie between
+        `line_bucket_line_ids[k + 1]` and `line_bucket_line_ids[k]`.
+        """
+        cdef np.ndarray[float_type_t, ndim=1] line_list_nu = self.line_list_nu_a
+        cdef np.ndarray[int_type_t, ndim=1] line_bucket_line_ids
+        cdef int_type_t no_of_line_buckets = max(1, line_list_nu.size // lines_per_bucket)
+
+        if line_list_nu.size > 0:
+            log_nu_min = np.log(line_list_nu.min())
+            log_nu_max = np.log(line_list_nu.max()) + 1e-10
+        else:
+            log_nu_min, log_nu_max = 0.0, 1.0
+
+        bucket_edges = np.exp(np.linspace(log_nu_min, log_nu_max, no_of_line_buckets + 1))
+        #the line list is sorted by decreasing frequency
+        line_bucket_line_ids = np.searchsorted(-line_list_nu, -bucket_edges, side='right').astype(np.int64)
+
+        self.line_bucket_line_ids_a = line_bucket_line_ids
+        self.storage.line_bucket_line_ids = <int_type_t*> line_bucket_line_ids.data
+        self.storage.no_of_line_buckets = no_of_line_buckets
+        self.storage.line_bucket_log_nu_min = log_nu_min
+        self.storage.line_bucket_inverse_log_width = no_of_line_buckets / (log_nu_max - log_nu_min)
+
+    cdef share_line_list(self, StorageModel line_list_storage):
+        """
+        Point the line list and the line lookup table to those of `line_list_storage`.
+        """
+        self.line_list_nu_a = line_list_storage.line_list_nu_a
+        self.line_bucket_line_ids_a = line_list_storage.line_bucket_line_ids_a
+        self.storage.line_list_nu = line_list_storage.storage.line_list_nu
+        self.storage.no_of_lines = line_list_storage.storage.no_of_lines
+        self.storage.line_bucket_line_ids = line_list_storage.storage.line_bucket_line_ids
+        self.storage.no_of_line_buckets = line_list_storage.storage.no_of_line_buckets
+        self.storage.line_bucket_log_nu_min = line_list_storage.storage.line_bucket_log_nu_min
+        self.storage.line_bucket_inverse_log_width = line_list_storage.storage.line_bucket_inverse_log_width
+
+    cdef setup_spectrum_grids(self, list spectrum_grids):
+        """
+        Pack the bin edges of the spectrum grids into one array and allocate one set of histograms per thread. The
+        tables are only rebuilt when the grids change.
+        """
+        cdef np.ndarray[int_type_t, ndim=1] spectrum_grid_spacings
+        cdef np.ndarray[int_type_t, ndim=1] spectrum_grid_offsets
+        cdef np.ndarray[float_type_t, ndim=1] spectrum_grid_inverse_deltas
+        cdef np.ndarray[float_type_t, ndim=1] spectrum_grid_nu_bins
+
+        grids_changed = self.spectrum_grids is None or len(spectrum_grids) != len(self.spectrum_grids)
+        if not grids_changed:
+            for grid, old_grid in zip(spectrum_grids, self.spectrum_grids):
+                grids_changed = grids_changed or grid is not old_grid
+        if grids_changed:
+            self.spectrum_grids = list(spectrum_grids)
+            spectrum_grid_spacings = np.array([grid.spacing for grid in spectrum_grids], dtype=np.int64)
+            spectrum_grid_offsets = np.cumsum([0] + [grid.no_of_bins for grid in spectrum_grids]).astype(np.int64)
+            spectrum_grid_inverse_deltas = np.zeros(len(spectrum_grids))
+            for i, grid in enumerate(spectrum_grids):
+                nu_start, nu_end = grid.nu_bins[0], grid.nu_bins[grid.no_of_bins]
+                if grid.spacing == GRID_SPACING_LINEAR:
+                    spectrum_grid_inverse_deltas[i] = grid.no_of_bins / (nu_end - nu_start)
+                elif grid.spacing == GRID_SPACING_LOG:
+                    spectrum_grid_inverse_deltas[i] = grid.no_of_bins / np.log(nu_end / nu_start)
+            spectrum_grid_nu_bins = np.concatenate([np.zeros(0)] + [grid.nu_bins for grid in spectrum_grids])
+
+            self.spectrum_grid_spacings_a = spectrum_grid_spacings
+            self.spectrum_grid_offsets_a = spectrum_grid_offsets
+            self.spectrum_grid_inverse_deltas_a = spectrum_grid_inverse_deltas
+            self.spectrum_grid_nu_bins_a = spectrum_grid_nu_bins
+
+        self.storage.no_of_spectrum_grids = len(self.spectrum_grids)
+        self.storage.spectrum_grid_spacings = <int_type_t*> self.spectrum_grid_spacings_a.data
+        self.storage.spectrum_grid_offsets = <int_type_t*> self.spectrum_grid_offsets_a.data
+        self.storage.spectrum_grid_inverse_deltas = <float_type_t*> self.spectrum_grid_inverse_deltas_a.data
+        self.storage.spectrum_grid_nu_bins = <float_type_t*> self.spectrum_grid_nu_bins_a.data
+
+        no_of_spectrum_bins = self.spectrum_grid_offsets_a[self.storage.no_of_spectrum_grids]
+        self.spectrum_histograms_a = refill_array(self.spectrum_histograms_a, (self.no_of_threads, 3, no_of_spectrum_bins),
+                                                  np.float64, 0.0)
+        self.storage.spectrum_histograms = <float_type_t*> self.spectrum_histograms_a.data
+
+    cdef setup_thread_storages(self):
+        """
+        Copy the storage struct for every thread and point it to the private estimators of that thread. Thread 0 uses
+        the model arrays directly, so a single-threaded run does not allocate anything extra. The exception are float32
+        j_blues (single precision storage), which every thread accumulates in a private float64 array so that the
+        small increments are not rounded away.
+        """
+        cdef int_type_t i
+        cdef int_type_t no_of_shells = self.storage.no_of_shells
+        cdef int_type_t no_of_j_blues = self.line_lists_j_blues_a.size
+        cdef int_type_t no_of_spectrum_bins = self.spectrum_grid_offsets_a[self.storage.no_of_spectrum_grids]
+        cdef int_type_t no_of_line_tallies = 0
+
+        if self.line_tally_counts_a is None or self.no_of_threads == 1:
+            self.thread_line_tally_counts_a = None
+            self.thread_line_tally_energies_a = None
+        else:
+            no_of_line_tallies = self.line_tally_counts_a.size
+            self.thread_line_tally_counts_a = refill_array(self.thread_line_tally_counts_a,
+                                                           (self.no_of_threads - 1, no_of_line_tallies), np.int64, 0)
+            self.thread_line_tally_energies_a = refill_array(self.thread_line_tally_energies_a,
+                                                             (self.no_of_threads - 1, no_of_line_tallies),
+                                                             np.float64, 0.0)
+
+        if not self.storage.estimator_mask & ESTIMATOR_J_BLUES:
+            #nothing is written to the j_blues, so the threads share the (unused) model array
+            self.thread_line_lists_j_blues_a = None
+        elif self.single_precision:
+            self.thread_line_lists_j_blues_a = refill_array(self.thread_line_lists_j_blues_a,
+                                                            (self.no_of_threads, no_of_j_blues), np.float64, 0.0)
+        elif self.no_of_threads > 1:
+            self.thread_line_lists_j_blues_a = refill_array(self.thread_line_lists_j_blues_a,
+                                                            (self.no_of_threads - 1, no_of_j_blues), np.float64, 0.0)
+        else:
+            self.thread_line_lists_j_blues_a = None
+
+        for i in range(self.no_of_threads):
+            self.thread_storages[i] = self.storage
+            self.thread_storages[i].js = self.storage.js + i * no_of_shells
+            self.thread_storages[i].nubars = self.storage.nubars + i * no_of_shells
+            self.thread_storages[i].event_counters = self.storage.event_counters + \
+                                                     i * NO_OF_EVENT_COUNTERS * no_of_shells
+            self.thread_storages[i].numerical_warnings = self.storage.numerical_warnings + i * NO_OF_NUMERICAL_WARNINGS
+            self.thread_storages[i].spectrum_histograms = self.storage.spectrum_histograms + \
+                                                          i * 3 * no_of_spectrum_bins
+            if i > 0 and self.thread_line_tally_counts_a is not None:
+                self.thread_storages[i].line_tally_counts = \
+                    (<int_type_t*> self.thread_line_tally_counts_a.data) + (i - 1) * no_of_line_tallies
+                self.thread_storages[i].line_tally_energies = \
+                    (<float_type_t*> self.thread_line_tally_energies_a.data) + (i - 1) * no_of_line_tallies
+            if self.thread_line_lists_j_blues_a is None:
+                pass
+            elif self.single_precision:
+                self.thread_storages[i].line_lists_j_blues = \
+                    (<float_type_t*> self.thread_line_lists_j_blues_a.data) + i * no_of_j_blues
+            elif i > 0:
+                self.thread_storages[i].line_lists_j_blues = \
+                    (<float_type_t*> self.thread_line_lists_j_blues_a.data) + (i - 1) * no_of_j_blues
+
+    cdef set_packet_id_offset(self, int_type_t packet_id_offset):
+        cdef int_type_t i
+        self.storage.packet_id_offset = packet_id_offset
+        for i in range(self.no_of_threads):
+            self.thread_storages[i].packet_id_offset = packet_id_offset
+
+    cdef set_packet_tracer(self, packet_tracer):
+        """
+        Point every thread to its segment of the packet tracer buffer.
+        """
+        cdef int_type_t i
+        cdef int_type_t segment_size
+
+        packet_tracer.reset(self.no_of_threads)
+        segment_size = packet_tracer.segment_size
+        self.trace_buffer_a = packet_tracer.buffer
+        self.trace_positions_a = packet_tracer.positions
+        for i in range(self.no_of_threads):
+            self.thread_storages[i].trace_events = (<packet_event_t*> self.trace_buffer_a.data) + i * segment_size
+            self.thread_storages[i].trace_position = (<int_type_t*> self.trace_positions_a.data) + i
+            self.thread_storages[i].trace_segment_size = segment_size
+            self.thread_storages[i].trace_sampling = packet_tracer.sampling
+
+    def reduce_thread_estimators(self):
+        """
+        Sum the private estimators of all threads into the model arrays (j_blues, line interaction tallies and the
+        histograms of the spectrum grids) and return the total `js`, `nubars` and event counters.
+        """
+        cdef int_type_t i
+        if self.thread_line_lists_j_blues_a is not None:
+            #summed in double precision and only rounded once when stored in float32 j_blues
+            j_blues_shape = (self.line_lists_j_blues_a.shape[0], self.line_lists_j_blues_a.shape[1])
+            np.add(self.line_lists_j_blues_a, self.thread_line_lists_j_blues_a.sum(axis=0).reshape(j_blues_shape),
+                   out=self.line_lists_j_blues_a, casting='unsafe')
+        for i in range(self.no_of_threads - 1):
+            if self.thread_line_tally_counts_a is not None:
+                tally_shape = (2, self.storage.no_of_shells, self.storage.no_of_lines)
+                self.line_tally_counts_a += self.thread_line_tally_counts_a[i].reshape(tally_shape)
+                self.line_tally_energies_a += self.thread_line_tally_energies_a[i].reshape(tally_shape)
+
+        spectrum_histograms = self.spectrum_histograms_a.sum(axis=0)
+        for i, grid in enumerate(self.spectrum_grids):
+            grid.histograms += spectrum_histograms[:, self.spectrum_grid_offsets_a[i]:self.spectrum_grid_offsets_a[i + 1]]
+
+        for message, count in zip(numerical_warning_messages, self.numerical_warnings_a.sum(axis=0)):
+            if count > 0:
+                logger.warning('%d times %s', count, message)
+
+        return self.js_a.sum(axis=0), self.nubars_a.sum(axis=0), self.event_counters_a.sum(axis=0)
 
 DEF packet_logging = False
 IF packet_logging == True:
@@ -303,82 +863,339 @@ logger = logging.getLogger(__name__)
 cdef float_type_t miss_distance = 1e99
 cdef float_type_t c = constants.c.cgs.value # cm/s
 cdef float_type_t inverse_c = 1 / c
+#average number of lines per bucket of the line lookup table
+cdef int_type_t lines_per_bucket = 16
+cdef float_type_t pi = np.pi
+
+#random walk steps (see `diffusion_step`): the sphere has to be at least this many mean free paths in radius
+DEF DIFFUSION_MIN_TAU = 3.0
+DEF DIFFUSION_TABLE_SIZE = 1024
+#extrapolation length (in mean free paths) of the Milne problem - the walk behaves like diffusion in a larger sphere
+DEF DIFFUSION_EXTRAPOLATION_LENGTH = 0.7104
+#quantiles of the first passage time x = D t / R ** 2 of a random walk from the center of a sphere of radius R
+cdef float_type_t diffusion_time_quantiles[DIFFUSION_TABLE_SIZE + 1]
+
+
+def calculate_diffusion_time_quantiles(no_of_quantiles=DIFFUSION_TABLE_SIZE):
+    """
+    Quantiles (at `no_of_quantiles` + 1 equally spaced probabilities) of the first passage time x = D t / R ** 2 of
+    diffusion from the center to the surface of a sphere, with P(x' > x) = 2 sum_n (-1) ** (n + 1) exp(-(n pi) ** 2 x).
+    The mean is 1 / 6.
+    """
+    x = np.linspace(0, 3, 30001)[1:]
+    n = np.arange(1, 201)[:, np.newaxis]
+    survival = 2 * np.sum((-1.0) ** (n + 1) * np.exp(-(n * np.pi) ** 2 * x), axis=0)
+    cdf = np.maximum.accumulate(np.clip(1 - survival, 0.0, 1.0))
+    quantiles = np.interp(np.linspace(0, 1, no_of_quantiles + 1), cdf, x)
+    #the tail is exponential with rate pi ** 2 - the last (linearly interpolated) bin gets the mean of the tail
+    quantiles[no_of_quantiles] = quantiles[no_of_quantiles - 1] + 2 / np.pi ** 2
+    return quantiles
+
+
+for i, quantile in enumerate(calculate_diffusion_time_quantiles()):
+    diffusion_time_quantiles[i] = quantile
 #DEBUG STATEMENT TAKE OUT
 
 
 
 
-cdef int_type_t binary_search(float_type_t*nu, float_type_t nu_insert, int_type_t imin,
-                              int_type_t imax):
-    #continually narrow search until just one element remains
+cdef inline void trace_packet_event(storage_model_t*storage, int_type_t event_type, int_type_t shell_id,
+                                    int_type_t line_id, float_type_t r, float_type_t mu, float_type_t nu,
+                                    float_type_t energy) nogil:
+    """
+    Write a record to the packet tracer if the current packet is traced (a single branch otherwise).
+    """
+    cdef packet_event_t*event
+    if storage.trace_current_packet == 0:
+        return
+    event = storage.trace_events + (storage.trace_position[0] % storage.trace_segment_size)
+    storage.trace_position[0] += 1
+    event.packet_id = storage.current_packet_id + storage.packet_id_offset
+    event.event_type = event_type
+    event.shell_id = shell_id
+    event.line_id = line_id
+    event.r = r
+    event.mu = mu
+    event.nu = nu
+    event.energy = energy
+
+cdef inline void count_event(storage_model_t*storage, int_type_t counter, int_type_t shell_id,
+                             int_type_t count) nogil:
+    storage.event_counters[counter * storage.no_of_shells + shell_id] += count
+
+cdef inline void tally_line_interaction(storage_model_t*storage, int_type_t shell_id, int_type_t absorbed_line_id,
+                                        int_type_t emission_line_id, float_type_t absorbed_energy,
+                                        float_type_t emitted_energy) nogil:
+    """
+    Add a line interaction of a real packet to the line interaction tallies: the absorption to the line that was hit,
+    the emission to the line the packet leaves through (the same line for scatter). The energies are in the lab frame.
+    """
+    cdef int_type_t shell_offset = shell_id * storage.no_of_lines
+    cdef int_type_t emitted_offset = storage.no_of_shells * storage.no_of_lines
+    storage.line_tally_counts[shell_offset + absorbed_line_id] += 1
+    storage.line_tally_energies[shell_offset + absorbed_line_id] += absorbed_energy
+    storage.line_tally_counts[emitted_offset + shell_offset + emission_line_id] += 1
+    storage.line_tally_energies[emitted_offset + shell_offset + emission_line_id] += emitted_energy
+
+cdef void bin_packet(storage_model_t*storage, float_type_t nu, float_type_t energy, int_type_t spectrum) nogil:
+    """
+    Add a packet to the histogram `spectrum` (SPECTRUM_EMITTED, SPECTRUM_REABSORBED or SPECTRUM_VIRTUAL) of every
+    spectrum grid.
+    """
+    cdef int_type_t grid_id, bin_id, lower_bin_id, upper_bin_id, no_of_bins
+    cdef float_type_t*nu_bins
+    cdef float_type_t*histogram = storage.spectrum_histograms + \
+                                  spectrum * storage.spectrum_grid_offsets[storage.no_of_spectrum_grids]
+
+    for grid_id in range(storage.no_of_spectrum_grids):
+        no_of_bins = storage.spectrum_grid_offsets[grid_id + 1] - storage.spectrum_grid_offsets[grid_id]
+        nu_bins = storage.spectrum_grid_nu_bins + storage.spectrum_grid_offsets[grid_id] + grid_id
+        if nu < nu_bins[0] or nu >= nu_bins[no_of_bins]:
+            continue
+        if storage.spectrum_grid_spacings[grid_id] == GRID_SPACING_LINEAR:
+            bin_id = <int_type_t> ((nu - nu_bins[0]) * storage.spectrum_grid_inverse_deltas[grid_id])
+        elif storage.spectrum_grid_spacings[grid_id] == GRID_SPACING_LOG:
+            bin_id = <int_type_t> (log(nu / nu_bins[0]) * storage.spectrum_grid_inverse_deltas[grid_id])
+        else:
+            lower_bin_id = 0
+            upper_bin_id = no_of_bins
+            while upper_bin_id - lower_bin_id > 1:
+                bin_id = (lower_bin_id + upper_bin_id) / 2
+                if nu >= nu_bins[bin_id]:
+                    lower_bin_id = bin_id
+                else:
+                    upper_bin_id = bin_id
+            bin_id = lower_bin_id
+        #rounding of the direct calculation at the upper edge
+        if bin_id >= no_of_bins:
+            bin_id = no_of_bins - 1
+        histogram[storage.spectrum_grid_offsets[grid_id] + bin_id] += energy
+
+cdef int_type_t diffusion_step(storage_model_t*storage, float_type_t*current_r, float_type_t*current_mu,
+                               float_type_t*current_nu, float_type_t*current_energy, int_type_t current_shell_id,
+                               int_type_t current_line_id, int_type_t last_line) nogil:
+    """
+    Replace the electron scatterings of a real packet deep inside an optically thick shell by one step of a random walk
+    (modified random walk, Fleck & Canfield 1984; Min et al. 2009): the packet moves to a random point on the surface of
+    the largest sphere around it that lies inside the shell and leaves it in a direction drawn from the emergent
+    intensity of the Milne problem (p(cos theta) ~ cos theta (1 + 1.5 cos theta) relative to the surface normal). The
+    path length is drawn from the first passage time distribution of diffusion in the sphere widened by the
+    extrapolation length, which matches the mean path length of the discrete walk down to a few mean free paths.
+    In the homologous flow the comoving frequency falls by nu / (c t) per unit path length in any direction, so over
+    the whole walk the comoving frequency and energy are redshifted by (1 - path length / (c t)). The packet comes into
+    resonance with its next line once the path length reaches `d_line`, the distance to the line on a straight path.
+    The radius is therefore limited so that 3 (R + extrapolation length) ** 2 / mean free path (six times the mean path
+    length, exceeded with a probability of about 1e-4) stays below `d_line`, and a drawn path that still reaches it is
+    not taken. Returns 0 if no step is taken (the packet then moves on normally): the sphere would be smaller than
+    `DIFFUSION_MIN_TAU` mean free paths or the path would reach the next line.
+    """
+    cdef float_type_t mean_free_path = storage.inverse_electron_densities[current_shell_id] * \
+                                       storage.inverse_sigma_thomson
+    cdef float_type_t r = current_r[0]
+    cdef float_type_t doppler_factor = 1 - current_mu[0] * r * storage.inverse_time_explosion * inverse_c
+    cdef float_type_t comov_nu = current_nu[0] * doppler_factor
+    cdef float_type_t comov_energy = current_energy[0] * doppler_factor
+    cdef float_type_t d_line = miss_distance
+    cdef float_type_t radius, path_length, quantile_position, redshift
+    cdef float_type_t mu_normal, sin_normal, cos_out, sin_out, cos_phi, new_r
+    cdef int_type_t quantile_id
+
+    radius = min(r - storage.r_inner[current_shell_id], storage.r_outer[current_shell_id] - r)
+    if last_line == 0:
+        d_line = (comov_nu - storage.line_list_nu[current_line_id]) / comov_nu * c * storage.time_explosion
+        if d_line <= 0:
+            return 0
+        radius = min(radius, sqrt(d_line * mean_free_path / 3) - DIFFUSION_EXTRAPOLATION_LENGTH * mean_free_path)
+    if radius < DIFFUSION_MIN_TAU * mean_free_path:
+        return 0
+
+    #path length from the first passage time (D = mean_free_path * c / 3)
+    quantile_position = packet_rng_double(&storage.rng_state) * DIFFUSION_TABLE_SIZE
+    quantile_id = <int_type_t> quantile_position
+    path_length = diffusion_time_quantiles[quantile_id] + (quantile_position - quantile_id) * \
+                  (diffusion_time_quantiles[quantile_id + 1] - diffusion_time_quantiles[quantile_id])
+    path_length = 3 * (radius + DIFFUSION_EXTRAPOLATION_LENGTH * mean_free_path) ** 2 * path_length / mean_free_path
+    if path_length >= d_line:
+        return 0
+
+    #the estimators with the comoving frequency and energy halfway along the path
+    redshift = 1 - 0.5 * path_length * storage.inverse_time_explosion * inverse_c
+    storage.js[current_shell_id] += comov_energy * redshift * path_length
+    storage.nubars[current_shell_id] += comov_energy * redshift * path_length * comov_nu * redshift
+    redshift = 1 - path_length * storage.inverse_time_explosion * inverse_c
+    comov_nu *= redshift
+    comov_energy *= redshift
+
+    #exit point (normal of the sphere at angle mu_normal to the radius) and direction of the packet
+    mu_normal = 2 * packet_rng_double(&storage.rng_state) - 1
+    sin_normal = sqrt(1 - mu_normal ** 2)
+    if packet_rng_double(&storage.rng_state) < 0.5:
+        cos_out = sqrt(packet_rng_double(&storage.rng_state))
+    else:
+        cos_out = packet_rng_double(&storage.rng_state) ** (1. / 3.)
+    sin_out = sqrt(1 - cos_out ** 2)
+    cos_phi = cos(2 * pi * packet_rng_double(&storage.rng_state))
+    new_r = sqrt(r ** 2 + radius ** 2 + 2 * r * radius * mu_normal)
+    current_mu[0] = (r * (cos_out * mu_normal - sin_out * cos_phi * sin_normal) + radius * cos_out) / new_r
+    current_r[0] = new_r
+
+    doppler_factor = 1 - current_mu[0] * new_r * storage.inverse_time_explosion * inverse_c
+    current_nu[0] = comov_nu / doppler_factor
+    current_energy[0] = comov_energy / doppler_factor
+    return 1
+
+cdef inline int_type_t first_line_below(float_type_t*nu, float_type_t nu_insert, int_type_t imin,
+                                        int_type_t imax) nogil:
+    """
+    Index of the first line in [imin, imax) with a frequency below nu_insert (imax if there is none)
+    """
     cdef int_type_t imid
-    while imax - imin > 2:
+    while imin < imax:
         imid = (imin + imax) / 2
+        if nu[imid] < nu_insert:
+            imax = imid
+        else:
+            imin = imid + 1
+    return imin
 
-        #code must guarantee the interval is reduced at each iteration
-        #assert(imid < imax);
-        # note: 0 <= imin < imax implies imid will always be less than imax
+cdef inline int_type_t line_search(storage_model_t*storage, float_type_t nu_insert) nogil:
+    """
+    Id of the next line a packet with comoving frequency nu_insert will meet (the first line with a lower frequency,
+    `no_of_lines` if there is none). The bucket table narrows the search down to the lines of one bucket.
+    """
+    cdef int_type_t bucket_id
+    if nu_insert <= 0:
+        return storage.no_of_lines
+    bucket_id = floor((log(nu_insert) - storage.line_bucket_log_nu_min) * storage.line_bucket_inverse_log_width)
+    if bucket_id < 0:
+        return storage.no_of_lines
+    elif bucket_id >= storage.no_of_line_buckets:
+        return 0
+    #the neighbouring buckets are included to be safe against rounding at the bucket edges
+    return first_line_below(storage.line_list_nu, nu_insert,
+                            storage.line_bucket_line_ids[min(bucket_id + 2, storage.no_of_line_buckets)],
+                            storage.line_bucket_line_ids[max(bucket_id - 1, 0)])
+
+cdef float_type_t skip_thin_lines(storage_model_t*storage, int_type_t significant_line_id, float_type_t d_line,
+                                  float_type_t d_boundary, float_type_t nu, float_type_t comov_nu, float_type_t energy,
+                                  int_type_t cur_zone_id, int_type_t*current_line_id, int_type_t*last_line,
+                                  float_type_t*nu_line, float_type_t*tau_event, int_type_t virtual_packet) nogil:
+    """
+    Jump over the optically thin lines between `current_line_id` and the next significant line.
 
-        # reduce the search
-        if (nu[imid] < nu_insert):
-            imax = imid + 1
-        else:
-            imin = imid
-            #print imin, imax, imid, imax - imin
-    return imin + 1
+    Only the thin lines the packet reaches before the next shell boundary (`d_boundary`) are passed. Their summed
+    optical depth is taken from `tau_event` (added for virtual packets) in one step. A real packet stops at the first
+    thin line at which the electron optical depth up to the line plus the optical depth of the thin lines up to and
+    including it exceed `tau_event` (this combined optical depth grows along the path, so the line is found by
+    bisection). This is the line the packet would have interacted with, or in front of which it would have scattered
+    on an electron, without line skipping. The caller recomputes the electron distance from the reduced `tau_event`.
+    A real packet adds its J_blue estimators to the passed lines (as `increment_j_blue_estimator` would have done).
+
+    Returns the distance to the line the packet meets next.
+    """
+    cdef float_type_t*tau_cumulative = storage.tau_skipped_cumulative + cur_zone_id * (storage.no_of_lines + 1)
+    cdef int_type_t first_line_id = current_line_id[0]
+    cdef int_type_t passed_line_id, imin, imid, line_id
+    cdef float_type_t*j_blues
+    cdef float_type_t j_blue_factor
+    cdef float_type_t distance_factor = c * storage.time_explosion / nu
+    cdef float_type_t electron_opacity = storage.sigma_thomson * storage.electron_densities[cur_zone_id]
+
+    if d_line <= d_boundary:
+        passed_line_id = significant_line_id
+    else:
+        #comoving frequency at the shell boundary (the comoving frequency falls linearly along the path)
+        passed_line_id = first_line_below(storage.line_list_nu,
+                                          comov_nu - nu * d_boundary * storage.inverse_time_explosion * inverse_c,
+                                          first_line_id, significant_line_id)
+
+    if virtual_packet > 0:
+        tau_event[0] += tau_cumulative[passed_line_id] - tau_cumulative[first_line_id]
+    else:
+        if passed_line_id > first_line_id and \
+                electron_opacity * (comov_nu - storage.line_list_nu[passed_line_id - 1]) * distance_factor + \
+                tau_cumulative[passed_line_id] - tau_cumulative[first_line_id] > tau_event[0]:
+            imin = first_line_id
+            passed_line_id -= 1
+            while imin < passed_line_id:
+                imid = (imin + passed_line_id) / 2
+                if electron_opacity * (comov_nu - storage.line_list_nu[imid]) * distance_factor + \
+                        tau_cumulative[imid + 1] - tau_cumulative[first_line_id] > tau_event[0]:
+                    passed_line_id = imid
+                else:
+                    imin = imid + 1
+            d_line = (comov_nu - storage.line_list_nu[passed_line_id]) * distance_factor
+        tau_event[0] -= tau_cumulative[passed_line_id] - tau_cumulative[first_line_id]
+
+        if storage.estimator_mask & ESTIMATOR_J_BLUES:
+            #at a line the comoving energy is energy * nu_line / nu
+            j_blues = storage.line_lists_j_blues + cur_zone_id * storage.line_lists_j_blues_nd
+            j_blue_factor = energy / (nu * nu)
+            for line_id in range(first_line_id, passed_line_id):
+                j_blues[line_id] += storage.line_list_nu[line_id] * j_blue_factor
+
+    current_line_id[0] = passed_line_id
+    if passed_line_id == storage.no_of_lines:
+        last_line[0] = 1
+    else:
+        nu_line[0] = storage.line_list_nu[passed_line_id]
+
+    return d_line
 
 #variables are restframe if not specified by prefix comov_
 cdef inline int_type_t macro_atom(int_type_t activate_level,
-                                  float_type_t*p_transition,
+                                  float_type_t*cumulative_p_transition,
+                                  single_float_type_t*cumulative_p_transition_single,
                                   int_type_t p_transition_nd,
                                   int_type_t*type_transition,
                                   int_type_t*target_level_id,
                                   int_type_t*target_line_id,
                                   int_type_t*unroll_reference,
-                                  int_type_t cur_zone_id):
-    cdef int_type_t emit, i = 0
-    cdef float_type_t p, event_random = 0.0
-    #print "Activating Level %d" % activate_level
+                                  int_type_t cur_zone_id,
+                                  packet_rng_state_t*rng_state,
+                                  int_type_t*no_of_jumps) nogil:
+    """
+    Follow the internal transitions of the macro atom from `activate_level` until it de-activates and return the
+    emission line. The transition out of every level is found by a binary search in the cumulative transition
+    probabilities of its block (first transition with a cumulative probability above the random number). The
+    probabilities are read from `cumulative_p_transition_single` instead in the single precision storage mode. The
+    number of internal (non-emitting) transitions is added to `no_of_jumps`.
+    """
+    cdef int_type_t emit, i = 0, imin, imax, imid
+    cdef float_type_t event_random = 0.0
+    cdef float_type_t*cumulative_p_zone = NULL
+    cdef single_float_type_t*cumulative_p_zone_single = NULL
+    cdef float_type_t cumulative_p
+    if cumulative_p_transition_single != NULL:
+        cumulative_p_zone_single = cumulative_p_transition_single + cur_zone_id * p_transition_nd
+    else:
+        cumulative_p_zone = cumulative_p_transition + cur_zone_id * p_transition_nd
     while True:
-        event_random = rk_double(&mt_state)
-        #activate_level = 7
-        i = unroll_reference[activate_level]
-        #i_end = unroll_reference[activate_level + 1]
-        #print "checking tprops %.5g" % (p_transition[cur_zone_id * p_transition_nd +i: cur_zone_id * p_transition_nd +i_end)
-        #        print "jumping to block_references %d" % i
-        p = 0.0
-        #cur_zone_id=10
-
-        #print "bunch of numbers %g %g %g %g %g %g %g %g %g" % ( p_transition[i], p_transition[i+1], p_transition[i+2], p_transition[i+3], p_transition[i+4], p_transition[i+5], p_transition[i+6], p_transition[i+7], p_transition[i+8])
-        #print "new bunch of numbers %g %g %g %g %g %g %g %g %g" % ( p_transition[cur_zone_id * p_transition_nd + i], p_transition[cur_zone_id * p_transition_nd + i+1], p_transition[cur_zone_id * p_transition_nd + i+2], p_transition[cur_zone_id * p_transition_nd + i+3], p_transition[cur_zone_id * p_transition_nd + i+4], p_transition[cur_zone_id * p_transition_nd + i+5], p_transition[cur_zone_id * p_transition_nd + i+6], p_transition[cur_zone_id * p_transition_nd + i+7], p_transition[cur_zone_id * p_transition_nd + i+8])
-        #print "p_transition_nd %g" % p_transition_nd
-
-
-        while True:
-            p = p + p_transition[cur_zone_id * p_transition_nd + i]
-            #print " p %g %g %g" % (p, cur_zone_id, i)
-            if p > event_random:
-                emit = type_transition[i]
-                #                print "assuming transition_id %d" % emit
-                activate_level = target_level_id[i]
-                #print "reActivating Level %g %g" % (activate_level, i)
-                break
-            i += 1
-            if i == unroll_reference[activate_level + 1]:
-                logger.warn("overrolling!")
-                logger.warn(
-                    "activate level %g unroll_reference[activate_level] %g unroll_reference[activate_level+1] %g i=%g event_random=%g current_p=%g" % (
-                        activate_level, unroll_reference[activate_level], unroll_reference[activate_level + 1], i,
-                        event_random,
-                        p))
-                time.sleep(10000000)
-
-                #print "I just broke " , emit
+        event_random = packet_rng_double(rng_state)
+        imin = unroll_reference[activate_level]
+        imax = unroll_reference[activate_level + 1] - 1
+
+        #a random number above the (rounded) total of the block falls to the last transition
+        while imin < imax:
+            imid = (imin + imax) / 2
+            if cumulative_p_zone_single != NULL:
+                cumulative_p = cumulative_p_zone_single[imid]
+            else:
+                cumulative_p = cumulative_p_zone[imid]
+            if cumulative_p > event_random:
+                imax = imid
+            else:
+                imin = imid + 1
+        i = imin
+        emit = type_transition[i]
+        activate_level = target_level_id[i]
+
         if emit == -1:
             IF packet_logging == True:
                 packet_logger.debug('Emitting in level %d', activate_level + 1)
 
             return target_line_id[i]
+        no_of_jumps[0] += 1
 
 cdef float_type_t move_packet(float_type_t*r,
                               float_type_t*mu,
@@ -389,7 +1206,8 @@ cdef float_type_t move_packet(float_type_t*r,
                               float_type_t*nubars,
                               float_type_t inverse_t_exp,
                               int_type_t cur_zone_id,
-                              int_type_t virtual_packet):
+                              int_type_t virtual_packet,
+                              int_type_t*numerical_warnings) nogil:
     cdef float_type_t new_r, doppler_factor, comov_energy, comov_nu
     doppler_factor = (1 - (mu[0] * r[0] * inverse_t_exp * inverse_c))
     IF packet_logging == True:
@@ -403,10 +1221,7 @@ cdef float_type_t move_packet(float_type_t*r,
     mu[0] = (mu[0] * r[0] + distance) / new_r
 
     if mu[0] == 0.0:
-        print "-------- move packet: mu turned 0.0"
-        print distance, new_r, r[0], new_r, cur_zone_id
-        print distance / new_r
-        #print "move packet after mu", mu[0]
+        numerical_warnings[WARNING_MU_ZERO] += 1
     r[0] = new_r
 
     if (virtual_packet > 0):
@@ -427,7 +1242,7 @@ cdef float_type_t move_packet(float_type_t*r,
 
 cdef void increment_j_blue_estimator(int_type_t*current_line_id, float_type_t*current_nu, float_type_t*current_energy,
                                      float_type_t*mu, float_type_t*r, float_type_t d_line, int_type_t j_blue_idx,
-                                     StorageModel storage):
+                                     storage_model_t*storage) nogil:
     cdef float_type_t comov_energy, comov_nu, r_interaction, mu_interaction, distance, doppler_factor
 
     distance = d_line
@@ -443,12 +1258,12 @@ cdef void increment_j_blue_estimator(int_type_t*current_line_id, float_type_t*cu
     storage.line_lists_j_blues[j_blue_idx] += (comov_energy / current_nu[0])
     #print "incrementing j_blues = %g" % storage.line_lists_j_blues[j_blue_idx]
 
-cdef float_type_t compute_distance2outer(float_type_t r, float_type_t  mu, float_type_t r_outer):
+cdef float_type_t compute_distance2outer(float_type_t r, float_type_t  mu, float_type_t r_outer) nogil:
     cdef float_type_t d_outer
     d_outer = sqrt(r_outer ** 2 + ((mu ** 2 - 1.) * r ** 2)) - (r * mu)
     return d_outer
 
-cdef float_type_t compute_distance2inner(float_type_t r, float_type_t mu, float_type_t r_inner):
+cdef float_type_t compute_distance2inner(float_type_t r, float_type_t mu, float_type_t r_inner) nogil:
     #compute distance to the inner layer
     #check if intersection is possible?
     cdef float_type_t check, d_inner
@@ -465,48 +1280,207 @@ cdef float_type_t compute_distance2inner(float_type_t r, float_type_t mu, float_
 cdef float_type_t compute_distance2line(float_type_t r, float_type_t mu,
                                         float_type_t nu, float_type_t nu_line,
                                         float_type_t t_exp, float_type_t inverse_t_exp,
-                                        float_type_t last_line, float_type_t next_line, int_type_t cur_zone_id):
+                                        float_type_t last_line, float_type_t next_line, int_type_t cur_zone_id,
+                                        int_type_t*numerical_warnings) nogil:
     #computing distance to line
     cdef float_type_t comov_nu, doppler_factor
     doppler_factor = (1. - (mu * r * inverse_t_exp * inverse_c))
     comov_nu = nu * doppler_factor
 
     if comov_nu < nu_line:
-        #TODO raise exception
-        print "WARNING comoving nu less than nu_line shouldn't happen:"
-        print "comov_nu = ", comov_nu
-        print "nu_line", nu_line
-        print "(comov_nu - nu_line) nu_lines", (comov_nu - nu_line) / nu_line
-        print "last_line", last_line
-        print "next_line", next_line
-        print "r", r
-        print "mu", mu
-        print "nu", nu
-        print "doppler_factor", doppler_factor
-        print "cur_zone_id", cur_zone_id
-        #raise Exception('wrong')
+        numerical_warnings[WARNING_COMOVING_NU_BELOW_LINE] += 1
 
     return ((comov_nu - nu_line) / nu) * c * t_exp
 
 cdef float_type_t compute_distance2electron(float_type_t r, float_type_t mu, float_type_t tau_event,
-                                            float_type_t inverse_ne):
+                                            float_type_t inverse_ne) nogil:
     return tau_event * inverse_ne # * inverse_sigma_thomson folded into inverse_ne
 
-cdef inline float_type_t get_r_sobolev(float_type_t r, float_type_t mu, float_type_t d_line):
+cdef inline float_type_t get_r_sobolev(float_type_t r, float_type_t mu, float_type_t d_line) nogil:
     return sqrt(r ** 2 + d_line ** 2 + 2 * r * d_line * mu)
 
-def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
+def sobol_sequence(int_type_t number_of_points, int_type_t dimension, unsigned long seed):
+    """
+    Draw points of a scrambled (randomly shifted) Sobol low-discrepancy sequence using randomkit's rk_sobol.
+
+    Parameters
+    ----------
+
+    number_of_points : `int`
+        number of points. The sequence is best balanced for powers of two.
+
+    dimension : `int`
+        dimension of every point (up to 360 with the Lemieux direction numbers)
+
+    seed : `int`
+        seed for the random shift of the sequence
+
+    Returns
+    -------
+
+    points : `numpy.ndarray`
+        array of shape (number_of_points, dimension) with values in [0, 1)
+    """
+    cdef rk_sobol_state sobol_state
+    cdef rk_state shift_state
+    cdef rk_sobol_error error
+    cdef int_type_t i
+    cdef np.ndarray[float_type_t, ndim=2] points = np.empty((number_of_points, dimension), dtype=np.float64)
+
+    error = rk_sobol_init(dimension, &sobol_state, NULL, rk_sobol_Ldirections, NULL)
+    if error != RK_SOBOL_OK:
+        raise ValueError('Could not initialize the Sobol sequence: %s' % rk_sobol_strerror[<int> error])
+
+    rk_seed(seed, &shift_state)
+    rk_sobol_randomshift(&sobol_state, &shift_state)
+
+    for i in range(number_of_points):
+        error = rk_sobol_double(&sobol_state, &points[i, 0])
+        if error != RK_SOBOL_OK:
+            rk_sobol_free(&sobol_state)
+            raise ValueError('Could not draw from the Sobol sequence: %s' % rk_sobol_strerror[<int> error])
+
+    rk_sobol_free(&sobol_state)
+    return points
+
+
+def formal_integral(model, np.ndarray[float_type_t, ndim=1] nus, int_type_t no_of_impact_parameters=100,
+                    int_type_t no_of_threads=1):
+    """
+    Emergent spectrum from a formal integral of the transfer equation along rays of constant impact parameter p.
+
+    Every ray starts either on the photosphere (p < r_inner[0], blackbody intensity at `model.t_inner`) or at the back
+    of the outermost shell (no incoming intensity) and picks up the Sobolev lines it resonates with. At a line the
+    intensity changes as I = I exp(-tau) + S (1 - exp(-tau)), with tau from `model.tau_sobolevs` and the source
+    function approximated by the normalized j_blue estimator (exact for pure resonance scattering in the Sobolev
+    approximation). Electron scattering is not included along the rays.
+
+    Parameters
+    ----------
+
+    model : `tardis.model_radial_oned.Radial1DModel`
+        model with normalized `j_blues`
+
+    nus : `numpy.ndarray`
+        observer frame frequencies
+
+    no_of_impact_parameters : `int`
+        number of impact parameters between 0 and the outer radius
+
+    no_of_threads : `int`
+        number of OpenMP threads the frequencies are distributed over
+
+    Returns
+    -------
+
+    luminosity_density : `numpy.ndarray`
+        emergent luminosity density L_nu (erg s^-1 Hz^-1) for every frequency
+    """
+    cdef np.ndarray[float_type_t, ndim=1] r_inner = model.r_inner
+    cdef np.ndarray[float_type_t, ndim=1] r_outer = model.r_outer
+    cdef np.ndarray[float_type_t, ndim=1] line_list_nu = model.line_list_nu.values
+    cdef np.ndarray[float_type_t, ndim=2] tau_sobolevs = np.asarray(model.tau_sobolevs, dtype=np.float64)
+    cdef np.ndarray[float_type_t, ndim=2] j_blues = np.asarray(model.j_blues, dtype=np.float64)
+    cdef np.ndarray[float_type_t, ndim=1] impact_parameters = np.linspace(0, r_outer[r_outer.shape[0] - 1],
+                                                                          no_of_impact_parameters)
+    cdef np.ndarray[float_type_t, ndim=2] intensities = np.zeros((nus.size, no_of_impact_parameters))
+
+    cdef float_type_t ct = c * model.time_explosion
+    cdef float_type_t h_over_kt = constants.h.cgs.value / (constants.k_B.cgs.value * model.t_inner)
+    cdef float_type_t two_h_over_c2 = 2 * constants.h.cgs.value / c ** 2
+    cdef int_type_t no_of_shells = r_inner.size
+    cdef int_type_t no_of_lines = line_list_nu.size
+    cdef int_type_t no_of_nus = nus.size
+    cdef int_type_t i, j, line_id, shell_id
+    cdef float_type_t nu, p, z_start, z_end, nu_start, nu_end, z_line, r_line, intensity, tau
+
+    for i in prange(no_of_nus, nogil=True, schedule='dynamic', num_threads=no_of_threads):
+        nu = nus[i]
+        for j in range(no_of_impact_parameters):
+            p = impact_parameters[j]
+            z_end = sqrt(r_outer[no_of_shells - 1] ** 2 - p ** 2)
+            if p < r_inner[0]:
+                z_start = sqrt(r_inner[0] ** 2 - p ** 2)
+                nu_start = nu * (1 - z_start / ct)
+                intensity = two_h_over_c2 * nu_start ** 3 / (exp(h_over_kt * nu_start) - 1)
+                shell_id = 0
+            else:
+                z_start = -z_end
+                nu_start = nu * (1 - z_start / ct)
+                intensity = 0.0
+                shell_id = no_of_shells - 1
+
+            #the comoving frequency falls along the ray, so the lines are met in the order of the line list
+            nu_end = nu * (1 - z_end / ct)
+            line_id = first_line_below(&line_list_nu[0], nu_start, 0, no_of_lines)
+            while line_id < no_of_lines and line_list_nu[line_id] > nu_end:
+                z_line = ct * (1 - line_list_nu[line_id] / nu)
+                r_line = sqrt(p ** 2 + z_line ** 2)
+                while shell_id < no_of_shells - 1 and r_line > r_outer[shell_id]:
+                    shell_id = shell_id + 1
+                while shell_id > 0 and r_line < r_inner[shell_id]:
+                    shell_id = shell_id - 1
+
+                tau = tau_sobolevs[shell_id, line_id]
+                intensity = intensity * exp(-tau) + j_blues[shell_id, line_id] * (1 - exp(-tau))
+                line_id = line_id + 1
+
+            intensities[i, j] = intensity
+
+    #trapezoidal rule over the impact parameters
+    weighted_intensities = intensities * impact_parameters
+    return 8 * np.pi ** 2 * (impact_parameters[1] - impact_parameters[0]) * \
+           (weighted_intensities.sum(axis=1) - 0.5 * (weighted_intensities[:, 0] + weighted_intensities[:, -1]))
+
+
+def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0, int_type_t no_of_threads=1,
+                        int_type_t packet_id_offset=0, packet_tracer=None, StorageModel storage=None,
+                        reset_estimators=True, progress_callback=None, int_type_t progress_interval=0):
     """
     Parameters
     ---------
 
 
     model : `tardis.model_radial_oned.ModelRadial1D`
-        complete model
+        complete model. The optional estimators filled by the kernel are selected by `model.estimators` (see
+        `estimator_flags`): without 'j_blues' `model.j_blues` is left untouched, without 'last_interaction' the last
+        interaction arrays are returned empty. With 'line_tallies' the number and the energy of the line interactions
+        are added to `model.line_interaction_counts` and `model.line_interaction_energies` (int64 and float64 arrays of
+        the shape (2, no_of_shells, no_of_lines), rows absorbed and emitted).
 
     param photon_packets : PacketSource object
         photon packets
 
+    virtual_packet_flag : `int`
+        number of virtual packets spawned at every interaction (0 switches virtual packets off)
+
+    no_of_threads : `int`
+        number of OpenMP threads the packets are distributed over. Every thread keeps private estimators that are
+        summed up after the packet loop.
+
+    packet_id_offset : `int`
+        global id of the first packet in `model.packet_src`. The random number stream of a packet is keyed on its
+        global id, so a shard of the packets run on its own gives the same trajectories as in the full run.
+
+    packet_tracer : `None` or `tardis.packet_tracer.PacketTracer`
+        if given the events of the real packets selected by its sampling are written to its buffer
+
+    storage : `None` or `StorageModel`
+        storage that is refilled from `model` and reused (its `no_of_threads` replaces the argument). A new storage is
+        created if `None`.
+
+    reset_estimators : `bool`
+        if `False` the j_blue estimators and line interaction tallies of this run are added to the model arrays instead
+        of replacing them (the packets are always added to the histograms of the grids in `model.spectrum_grids`)
+
+    progress_callback : `None` or callable
+        called as `progress_callback(no_of_packets_done, no_of_packets, elapsed_time, packets_per_second)` after every
+        block of `progress_interval` packets
+
+    progress_interval : `int`
+        number of packets in a block of the packet loop (a fifth of the packets if 0). The GIL is released while the
+        threads work on a block and only taken between the blocks for the progress report.
+
     Returns
     -------
 
@@ -514,6 +1488,12 @@ def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
 
     output_energies : `numpy.ndarray`
 
+    event_counters : `numpy.ndarray`
+        int64 array with one row per entry of `event_counter_names` and one column per shell: the line interactions,
+        electron scatterings, boundary crossings, internal macro atom transitions, reabsorptions and transport loop
+        steps of the real packets and the loop steps of the virtual packets in every shell (the last element of the
+        returned tuple)
+
 
 
     TODO
@@ -532,15 +1512,171 @@ def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
 
     """
 
-    storage = StorageModel(model)
+    if storage is None:
+        storage = StorageModel(no_of_threads=no_of_threads)
+    storage.update(model, reset_estimators=reset_estimators)
+    cdef storage_model_t*thread_storages = storage.thread_storages
+    cdef int_type_t no_of_packets = storage.storage.no_of_packets
+    cdef int_type_t log_interval = max(1, no_of_packets / 5)
+    cdef int_type_t i = 0
+    cdef int_type_t block_start, block_end
+
+    storage.set_packet_id_offset(packet_id_offset)
+    if packet_tracer is not None:
+        storage.set_packet_tracer(packet_tracer)
+    no_of_threads = storage.no_of_threads
+    if progress_interval <= 0:
+        progress_interval = log_interval
+
+    start_time = time.time()
+    block_start = 0
+    while block_start < no_of_packets:
+        block_end = min(block_start + progress_interval, no_of_packets)
+        for i in prange(block_start, block_end, nogil=True, schedule='dynamic', num_threads=no_of_threads):
+            montecarlo_main_loop_packet(&thread_storages[threadid()], i, virtual_packet_flag)
+
+        elapsed_time = time.time() - start_time
+        packets_per_second = block_end / elapsed_time if elapsed_time > 0 else 0.0
+        if block_end / log_interval > block_start / log_interval:
+            logger.info("At packet %d of %d (%.0f packets/s)", block_end, no_of_packets, packets_per_second)
+        if progress_callback is not None:
+            progress_callback(block_end, no_of_packets, elapsed_time, packets_per_second)
+        block_start = block_end
+
+    js, nubars, event_counters = storage.reduce_thread_estimators()
+    if packet_tracer is not None:
+        packet_tracer.flush()
+
+    return storage.output_nus_a, storage.output_energies_a, js, nubars, \
+           storage.last_line_interaction_in_id_a, storage.last_line_interaction_out_id_a, storage.last_interaction_type_a, \
+           storage.last_line_interaction_shell_id_a, event_counters
 
 
-    ######## Setting up the output ########
-    cdef np.ndarray[float_type_t, ndim=1] output_nus = np.zeros(storage.no_of_packets, dtype=np.float64)
-    cdef np.ndarray[float_type_t, ndim=1] output_energies = np.zeros(storage.no_of_packets, dtype=np.float64)
+def montecarlo_radial1d_batch(models, int_type_t virtual_packet_flag=0, int_type_t no_of_threads=1, storages=None,
+                              progress_callback=None, int_type_t progress_interval=0):
+    """
+    Run the packets of several models that share one line list (e.g. the models of a parameter grid or the members of
+    an ensemble) in one packet loop. The models differ in their per-shell arrays (electron densities, tau_sobolevs,
+    transition probabilities, ...), so together they form a stack of K x shells inputs. The line list and its lookup
+    table are set up once and used by all models, and the threads pick the packets of all models from one loop (the
+    packets of the models are interleaved), so small models do not leave threads idle at the end of every model.
+
+    Every model is transported exactly as by `montecarlo_radial1d` (the random numbers of a packet only depend on the
+    seed and iteration of its model and on the packet id), so the outputs equal those of separate runs.
+
+    Parameters
+    ----------
+
+    models : `list` of `tardis.model_radial_oned.Radial1DModel`
+        models with packets and equal `line_list_nu`
+
+    virtual_packet_flag : `int`
+        number of virtual packets spawned at every interaction (0 switches virtual packets off)
+
+    no_of_threads : `int`
+        number of OpenMP threads
+
+    storages : `None` or `list` of `StorageModel`
+        one storage per model that is refilled and reused (all need the same `no_of_threads`, which replaces the
+        argument). New storages are created if `None`.
+
+    progress_callback : `None` or callable
+        called as `progress_callback(no_of_packets_done, no_of_packets, elapsed_time, packets_per_second)` with the
+        packets of all models after every block of `progress_interval` packets
+
+    progress_interval : `int`
+        number of packets in a block of the packet loop (a fifth of all packets if 0)
+
+    Returns
+    -------
 
+    outputs : `list`
+        output tuple of `montecarlo_radial1d` for every model
+    """
+    cdef int_type_t no_of_models = len(models)
+    cdef StorageModel storage
+    cdef StorageModel line_list_storage = None
+    cdef np.ndarray[int_type_t, ndim=1] no_of_packets_a = np.zeros(no_of_models, dtype=np.int64)
+    cdef int_type_t*no_of_packets = <int_type_t*> no_of_packets_a.data
+    cdef storage_model_t**batch_thread_storages
+    cdef int_type_t max_no_of_packets, total_no_of_packets, log_interval
+    cdef int_type_t global_id, block_start, block_end, model_id, i, k
+
+    if no_of_models == 0:
+        return []
+    if storages is None:
+        storages = [StorageModel(no_of_threads=no_of_threads) for k in range(no_of_models)]
+    if len(storages) != no_of_models:
+        raise ValueError('Got %d storages for %d models' % (len(storages), no_of_models))
+
+    for k in range(no_of_models):
+        storage = storages[k]
+        if storage.no_of_threads != (<StorageModel> storages[0]).no_of_threads:
+            raise ValueError('All storages of a batch need the same number of threads')
+        if line_list_storage is not None and models[k].line_list_nu.values is not line_list_storage.line_list_nu_a \
+                and not np.array_equal(models[k].line_list_nu.values, line_list_storage.line_list_nu_a):
+            raise ValueError('The models of a batch need to share one line list (model %d differs)' % k)
+        storage.update(models[k], line_list_storage=line_list_storage)
+        if line_list_storage is None:
+            line_list_storage = storage
+        no_of_packets[k] = storage.storage.no_of_packets
+    no_of_threads = line_list_storage.no_of_threads
+
+    max_no_of_packets = no_of_packets_a.max()
+    total_no_of_packets = no_of_packets_a.sum()
+    log_interval = max(1, total_no_of_packets / 5)
+    if progress_interval <= 0:
+        progress_interval = log_interval
+
+    batch_thread_storages = <storage_model_t**> malloc(no_of_models * sizeof(storage_model_t*))
+    if batch_thread_storages == NULL:
+        raise MemoryError('Could not allocate the thread storages of %d models' % no_of_models)
+    for k in range(no_of_models):
+        batch_thread_storages[k] = (<StorageModel> storages[k]).thread_storages
+
+    try:
+        start_time = time.time()
+        no_of_packets_done = 0
+        #packet i of model k has the global id i * no_of_models + k
+        block_start = 0
+        while block_start < max_no_of_packets * no_of_models:
+            block_end = min(block_start + progress_interval, max_no_of_packets * no_of_models)
+            for global_id in prange(block_start, block_end, nogil=True, schedule='dynamic',
+                                    num_threads=no_of_threads):
+                model_id = global_id % no_of_models
+                i = global_id / no_of_models
+                if i < no_of_packets[model_id]:
+                    montecarlo_main_loop_packet(&batch_thread_storages[model_id][threadid()], i, virtual_packet_flag)
+
+            previous_no_of_packets_done = no_of_packets_done
+            no_of_packets_done = int(np.minimum(no_of_packets_a, (block_end + no_of_models - 1 -
+                                                                  np.arange(no_of_models)) // no_of_models).sum())
+            elapsed_time = time.time() - start_time
+            packets_per_second = no_of_packets_done / elapsed_time if elapsed_time > 0 else 0.0
+            if no_of_packets_done / log_interval > previous_no_of_packets_done / log_interval:
+                logger.info("At packet %d of %d of %d models (%.0f packets/s)", no_of_packets_done,
+                            total_no_of_packets, no_of_models, packets_per_second)
+            if progress_callback is not None:
+                progress_callback(no_of_packets_done, total_no_of_packets, elapsed_time, packets_per_second)
+            block_start = block_end
+    finally:
+        free(batch_thread_storages)
+
+    outputs = []
+    for k in range(no_of_models):
+        storage = storages[k]
+        js, nubars, event_counters = storage.reduce_thread_estimators()
+        outputs.append((storage.output_nus_a, storage.output_energies_a, js, nubars,
+                        storage.last_line_interaction_in_id_a, storage.last_line_interaction_out_id_a,
+                        storage.last_interaction_type_a, storage.last_line_interaction_shell_id_a, event_counters))
+    return outputs
+
+
+cdef void montecarlo_main_loop_packet(storage_model_t*storage, int_type_t i, int_type_t virtual_packet_flag) nogil:
+    """
+    Transport the packet `i` (and its virtual packets) through the ejecta and record its fate in the output arrays.
+    """
     ######## Setting up the running variable ########
-    cdef float_type_t nu_line = 0.0
     cdef float_type_t current_r = 0.0
     cdef float_type_t current_mu = 0.0
     cdef float_type_t current_nu = 0.0
@@ -556,72 +1692,69 @@ def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
     cdef int_type_t close_line = 0
     cdef int_type_t reabsorbed = 0
     cdef int_type_t recently_crossed_boundary = 0
-    cdef int i = 0
 
-    for i in range(storage.no_of_packets):
-        if i % (storage.no_of_packets / 5) == 0:
-            logger.info("At packet %d of %d", i, storage.no_of_packets)
+    storage.current_packet_id = i
+    packet_rng_seed(&storage.rng_state, storage.seed, storage.iteration, i + storage.packet_id_offset)
+    #setting up the properties of the packet
+    current_nu = storage.packet_nus[i]
+    current_energy = storage.packet_energies[i]
+    current_mu = storage.packet_mus[i]
+
+    #these have been drawn for the comoving frame so we want to convert them
+    comov_current_nu = current_nu
 
-        storage.current_packet_id = i
-        #setting up the properties of the packet
-        current_nu = storage.packet_nus[i]
-        current_energy = storage.packet_energies[i]
-        current_mu = storage.packet_mus[i]
+    #Location of the packet
+    current_shell_id = 0
+    current_r = storage.r_inner[0]
+    current_nu = current_nu / (1 - (current_mu * current_r * storage.inverse_time_explosion * inverse_c))
+    current_energy = current_energy / (1 - (current_mu * current_r * storage.inverse_time_explosion * inverse_c))
 
-        #these have been drawn for the comoving frame so we want to convert them        
-        comov_current_nu = current_nu
+    #linelists
+    current_line_id = line_search(storage, comov_current_nu)
 
-        #Location of the packet
-        current_shell_id = 0
-        current_r = storage.r_inner[0]
-        current_nu = current_nu / (1 - (current_mu * current_r * storage.inverse_time_explosion * inverse_c))
-        current_energy = current_energy / (1 - (current_mu * current_r * storage.inverse_time_explosion * inverse_c))
+    if current_line_id == storage.no_of_lines:
+        #setting flag that the packet is off the red end of the line list
+        last_line = 1
+    else:
+        last_line = 0
 
-        #linelists
-        current_line_id = binary_search(storage.line_list_nu, comov_current_nu, 0, storage.no_of_lines)
+    #### FLAGS ####
+    #Packet recently crossed the inner boundary
+    recently_crossed_boundary = 1
 
-        if current_line_id == storage.no_of_lines:
-            #setting flag that the packet is off the red end of the line list
-            last_line = 1
-        else:
-            last_line = 0
-            #print "storage.no_of_lines %d" % (storage.no_of_lines)
-            #print "current_line_id %d" % (current_line_id)
-            #print "storage.line_list_nu[current_line_id] %g" % (storage.line_list_nu[current_line_id])
-            #print "current_nu %g comov_current_nu %g" % (current_nu, comov_current_nu)
-            #return
-
-        #### FLAGS ####
-        #Packet recently crossed the inner boundary
-        recently_crossed_boundary = 1
-
-        if (virtual_packet_flag > 0):
+    storage.trace_current_packet = (storage.trace_events != NULL) and \
+                                   ((i + storage.packet_id_offset) % storage.trace_sampling == 0)
+    trace_packet_event(storage, EVENT_START, current_shell_id, current_line_id, current_r, current_mu, current_nu,
+                       current_energy)
+
+    if (virtual_packet_flag > 0):
         #this is a run for which we want the virtual packet spectrum. So first thing we need to do is spawn virtual packets to track the input packet
-        #print "I'M STARTING A VIRTUAL FOR A NEW PACKET"
-            reabsorbed = montecarlo_one_packet(storage, &current_nu, &current_energy, &current_mu, &current_shell_id,
-                                               &current_r, &current_line_id, &last_line, &close_line,
-                                               &recently_crossed_boundary, virtual_packet_flag,
-                                               -1)
-
-            #print "I'M ABOUT TO START A REAL PACKET"
-        #Now can do the propagation of the real packet
         reabsorbed = montecarlo_one_packet(storage, &current_nu, &current_energy, &current_mu, &current_shell_id,
                                            &current_r, &current_line_id, &last_line, &close_line,
-                                           &recently_crossed_boundary, virtual_packet_flag, 0)
+                                           &recently_crossed_boundary, virtual_packet_flag,
+                                           -1)
 
-        if reabsorbed == 1: #reabsorbed
-            storage.output_nus[i] = -current_nu
-            storage.output_energies[i] = -current_energy
+    #Now can do the propagation of the real packet
+    reabsorbed = montecarlo_one_packet(storage, &current_nu, &current_energy, &current_mu, &current_shell_id,
+                                       &current_r, &current_line_id, &last_line, &close_line,
+                                       &recently_crossed_boundary, virtual_packet_flag, 0)
 
-        elif reabsorbed == 0: #emitted
-            storage.output_nus[i] = current_nu
-            storage.output_energies[i] = current_energy
+    if reabsorbed == 1: #reabsorbed
+        storage.output_nus[i] = -current_nu
+        storage.output_energies[i] = -current_energy
+        bin_packet(storage, current_nu, current_energy, SPECTRUM_REABSORBED)
+        count_event(storage, COUNTER_REABSORPTIONS, current_shell_id, 1)
+        trace_packet_event(storage, EVENT_REABSORBED, current_shell_id, current_line_id, current_r, current_mu,
+                           current_nu, current_energy)
 
-            #^^^^^^^^^^^^^^^^^^^^^^^^ RESTART MAINLOOP ^^^^^^^^^^^^^^^^^^^^^^^^^
+    elif reabsorbed == 0: #emitted
+        storage.output_nus[i] = current_nu
+        storage.output_energies[i] = current_energy
+        bin_packet(storage, current_nu, current_energy, SPECTRUM_EMITTED)
+        trace_packet_event(storage, EVENT_ESCAPED, current_shell_id, current_line_id, current_r, current_mu,
+                           current_nu, current_energy)
 
-    return storage.output_nus_a, storage.output_energies_a, storage.js_a, storage.nubars_a, \
-           storage.last_line_interaction_in_id_a, storage.last_line_interaction_out_id_a, storage.last_interaction_type_a, \
-           storage.last_line_interaction_shell_id_a
+        #^^^^^^^^^^^^^^^^^^^^^^^^ RESTART MAINLOOP ^^^^^^^^^^^^^^^^^^^^^^^^^
 
 
 #
@@ -633,12 +1766,13 @@ def montecarlo_radial1d(model, int_type_t virtual_packet_flag=0):
 #
 #When this routine is called, it is always sent properties of a REAL packet. The issue is whether we are extracting that packet or really propagating it.
 
-cdef int_type_t montecarlo_one_packet(StorageModel storage, float_type_t*current_nu, float_type_t*current_energy,
+cdef int_type_t montecarlo_one_packet(storage_model_t*storage, float_type_t*current_nu, float_type_t*current_energy,
                                       float_type_t*current_mu, int_type_t*current_shell_id, float_type_t*current_r,
                                       int_type_t*current_line_id, int_type_t*last_line, int_type_t*close_line,
                                       int_type_t*recently_crossed_boundary, int_type_t virtual_packet_flag,
-                                      int_type_t virtual_mode):
+                                      int_type_t virtual_mode) nogil:
     cdef int_type_t i
+    cdef int_type_t reabsorbed = 0
     cdef float_type_t current_nu_virt
     cdef float_type_t current_energy_virt
     cdef float_type_t current_mu_virt
@@ -672,7 +1806,7 @@ cdef int_type_t montecarlo_one_packet(StorageModel storage, float_type_t*current
             #choose a direction for the extract packet. We don't want any directions that will hit the inner boundary. So this sets a minimum value for the packet mu
             mu_min = -1. * sqrt(1.0 - ( storage.r_inner[0] / current_r_virt) ** 2)
             mu_bin = (1 - mu_min) / virtual_packet_flag
-            current_mu_virt = mu_min + ((i + rk_double(&mt_state)) * mu_bin)
+            current_mu_virt = mu_min + ((i + packet_rng_double(&storage.rng_state)) * mu_bin)
 
             if (virtual_mode < 0):
                 #this is a virtual packet calculation based on a newly born packet - so the weights are more subtle than for a isotropic emission process
@@ -699,11 +1833,8 @@ cdef int_type_t montecarlo_one_packet(StorageModel storage, float_type_t*current
                                                     &recently_crossed_boundary_virt, virtual_packet_flag, 1)
 
 
-            #Putting the virtual nu into the output spectrum
-            if (current_nu_virt < storage.spectrum_end_nu) and (current_nu_virt > storage.spectrum_start_nu):
-                virt_id_nu = floor(( current_nu_virt - storage.spectrum_start_nu) / storage.spectrum_delta_nu)
-                storage.spectrum_virt_nu[virt_id_nu] += current_energy_virt * weight
-                #
+            #Putting the virtual nu into the output spectra
+            bin_packet(storage, current_nu_virt, current_energy_virt * weight, SPECTRUM_VIRTUAL)
 
                 #print "I FINISHED DOING A VIRTUAL PACKET"
 
@@ -712,21 +1843,21 @@ cdef int_type_t montecarlo_one_packet(StorageModel storage, float_type_t*current
 
 #
 #
-cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*current_nu, float_type_t*current_energy,
+cdef int_type_t montecarlo_one_packet_loop(storage_model_t*storage, float_type_t*current_nu, float_type_t*current_energy,
                                            float_type_t*current_mu, int_type_t*current_shell_id, float_type_t*current_r,
                                            int_type_t*current_line_id, int_type_t*last_line, int_type_t*close_line,
                                            int_type_t*recently_crossed_boundary, int_type_t virtual_packet_flag,
-                                           int_type_t virtual_packet):
+                                           int_type_t virtual_packet) nogil:
     cdef float_type_t nu_electron = 0.0
     cdef float_type_t comov_nu = 0.0
     cdef float_type_t comov_energy = 0.0
     cdef float_type_t energy_electron = 0.0
     cdef int_type_t emission_line_id = 0
     cdef int_type_t activate_level_id = 0
+    cdef float_type_t absorbed_energy = 0.0
 
     #doppler factor definition
     cdef float_type_t doppler_factor = 0.0
-    cdef float_type_t old_doppler_factor = 0.0
     cdef float_type_t inverse_doppler_factor = 0.0
 
     cdef float_type_t tau_line = 0.0
@@ -746,10 +1877,17 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
 
     cdef int_type_t virtual_close_line = 0
     cdef int_type_t j_blue_idx = -1
+    cdef int_type_t significant_line_id = 0
+    cdef int_type_t no_of_jumps = 0
+    cdef int_type_t diffused = 0
+    cdef float_type_t tau_roulette = storage.virtual_packet_tau_cutoff
 
     #Initializing tau_event if it's a real packet
     if (virtual_packet == 0):
-        tau_event = -log(rk_double(&mt_state))
+        if storage.packet_tau_randoms != NULL:
+            tau_event = -log(1 - storage.packet_tau_randoms[storage.current_packet_id])
+        else:
+            tau_event = -log(packet_rng_double(&storage.rng_state))
 
     #For a virtual packet tau_event is the sum of all the tau's that the packet passes.
 
@@ -758,6 +1896,35 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
     #-----------------------
 
     while True:
+        if virtual_packet == 0:
+            count_event(storage, COUNTER_STEPS, current_shell_id[0], 1)
+        else:
+            count_event(storage, COUNTER_VIRTUAL_STEPS, current_shell_id[0], 1)
+
+        # ------------------ RANDOM WALK IN OPTICALLY THICK SHELLS ---------------------
+        #after a random walk step the packet first flies on in its (outward biased) direction like the discrete walk
+        if virtual_packet == 0 and storage.diffusion_tau_threshold > 0 and diffused == 0 and close_line[0] == 0 and \
+                storage.sigma_thomson * storage.electron_densities[current_shell_id[0]] * \
+                (storage.r_outer[current_shell_id[0]] - storage.r_inner[current_shell_id[0]]) > \
+                storage.diffusion_tau_threshold:
+            if diffusion_step(storage, current_r, current_mu, current_nu, current_energy, current_shell_id[0],
+                              current_line_id[0], last_line[0]) == 1:
+                count_event(storage, COUNTER_DIFFUSION_STEPS, current_shell_id[0], 1)
+                diffused = 1
+                tau_event = -log(packet_rng_double(&storage.rng_state))
+                recently_crossed_boundary[0] = 0
+                if storage.estimator_mask & ESTIMATOR_LAST_INTERACTION:
+                    storage.last_interaction_type[storage.current_packet_id] = 1
+                trace_packet_event(storage, EVENT_DIFFUSION, current_shell_id[0], current_line_id[0],
+                                   current_r[0], current_mu[0], current_nu[0], current_energy[0])
+                #the packet leaves the random walk like an electron scattering - a source of virtual packets
+                if (virtual_packet_flag > 0):
+                    montecarlo_one_packet(storage, current_nu, current_energy, current_mu, current_shell_id,
+                                          current_r, current_line_id, last_line, close_line,
+                                          recently_crossed_boundary, virtual_packet_flag, 1)
+                continue
+        diffused = 0
+
         #check if we are at the end of linelist
         if last_line[0] == 0:
             nu_line = storage.line_list_nu[current_line_id[0]]
@@ -789,17 +1956,31 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
             # ^^^^^^^^^^^^^^^^^^ OUTER DISTANCE CALCULATION ^^^^^^^^^^^^^^^^^^^^^
 
             # ------------------ LINE DISTANCE CALCULATION ---------------------
-            if last_line[0] == 1:
+            #with line skipping the distance is computed to the next line above the tau threshold
+            significant_line_id = current_line_id[0]
+            if storage.line_skipping == 1 and last_line[0] == 0:
+                significant_line_id = storage.next_significant_line[
+                    current_shell_id[0] * (storage.no_of_lines + 1) + current_line_id[0]]
+
+            if last_line[0] == 1 or significant_line_id == storage.no_of_lines:
                 d_line = miss_distance
             else:
-                d_line = compute_distance2line(current_r[0], current_mu[0], current_nu[0], nu_line,
+                d_line = compute_distance2line(current_r[0], current_mu[0], current_nu[0],
+                                               storage.line_list_nu[significant_line_id],
                                                storage.time_explosion,
                                                storage.inverse_time_explosion,
-                                               storage.line_list_nu[current_line_id[0] - 1],
-                                               storage.line_list_nu[current_line_id[0] + 1],
-                                               current_shell_id[0])
+                                               storage.line_list_nu[significant_line_id - 1],
+                                               storage.line_list_nu[significant_line_id + 1],
+                                               current_shell_id[0], storage.numerical_warnings)
                 # ^^^^^^^^^^^^^^^^^^ LINE DISTANCE CALCULATION ^^^^^^^^^^^^^^^^^^^^^
 
+            if significant_line_id > current_line_id[0]:
+                d_line = skip_thin_lines(storage, significant_line_id, d_line, min(d_inner, d_outer), current_nu[0],
+                                         current_nu[0] * (1 - current_mu[0] * current_r[0] *
+                                                          storage.inverse_time_explosion * inverse_c),
+                                         current_energy[0], current_shell_id[0], current_line_id, last_line, &nu_line,
+                                         &tau_event, virtual_packet)
+
             # ------------------ ELECTRON DISTANCE CALCULATION ---------------------
             # a virtual packet should never be stopped by continuum processes
             if (virtual_packet > 0):
@@ -854,16 +2035,20 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
             #and flag as an outwards propagating packet
             move_packet(current_r, current_mu, current_nu[0], current_energy[0], d_outer, storage.js, storage.nubars,
                         storage.inverse_time_explosion,
-                        current_shell_id[0], virtual_packet)
+                        current_shell_id[0], virtual_packet, storage.numerical_warnings)
             #for a virtual packet, add on the opacity contribution from the continuum
             if (virtual_packet > 0):
                 tau_event += (d_outer * storage.electron_densities[current_shell_id[0]] * storage.sigma_thomson)
             else:
-                tau_event = -log(rk_double(&mt_state))
+                tau_event = -log(packet_rng_double(&storage.rng_state))
+                count_event(storage, COUNTER_BOUNDARY_CROSSINGS, current_shell_id[0], 1)
 
             if (current_shell_id[0] < storage.no_of_shells - 1): # jump to next shell
                 current_shell_id[0] += 1
                 recently_crossed_boundary[0] = 1
+                if virtual_packet == 0:
+                    trace_packet_event(storage, EVENT_OUTER_BOUNDARY, current_shell_id[0], current_line_id[0],
+                                       current_r[0], current_mu[0], current_nu[0], current_energy[0])
 
 
 
@@ -888,17 +2073,21 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
             #moving one zone inwards. If it's already in the innermost zone this is a reabsorption
             move_packet(current_r, current_mu, current_nu[0], current_energy[0], d_inner, storage.js, storage.nubars,
                         storage.inverse_time_explosion,
-                        current_shell_id[0], virtual_packet)
+                        current_shell_id[0], virtual_packet, storage.numerical_warnings)
 
             #for a virtual packet, add on the opacity contribution from the continuum
             if (virtual_packet > 0):
                 tau_event += (d_inner * storage.electron_densities[current_shell_id[0]] * storage.sigma_thomson)
             else:
-                tau_event = -log(rk_double(&mt_state))
+                tau_event = -log(packet_rng_double(&storage.rng_state))
+                count_event(storage, COUNTER_BOUNDARY_CROSSINGS, current_shell_id[0], 1)
 
             if current_shell_id[0] > 0:
                 current_shell_id[0] -= 1
                 recently_crossed_boundary[0] = -1
+                if virtual_packet == 0:
+                    trace_packet_event(storage, EVENT_INNER_BOUNDARY, current_shell_id[0], current_line_id[0],
+                                       current_r[0], current_mu[0], current_nu[0], current_energy[0])
 
 
 
@@ -931,16 +2120,17 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
 
             # ^^^^^^^^^^^^^^^^^^^^^^^^^^^ LOGGING # ^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
-            doppler_factor = move_packet(current_r, current_mu, current_nu[0], current_energy[0], d_electron,
-                                         storage.js, storage.nubars
-                , storage.inverse_time_explosion, current_shell_id[0], virtual_packet)
+            move_packet(current_r, current_mu, current_nu[0], current_energy[0], d_electron, storage.js, storage.nubars,
+                        storage.inverse_time_explosion, current_shell_id[0], virtual_packet, storage.numerical_warnings)
 
+            #comoving frame at the scattering point (the comoving frequency falls along the flight)
+            doppler_factor = 1 - current_mu[0] * current_r[0] * storage.inverse_time_explosion * inverse_c
             comov_nu = current_nu[0] * doppler_factor
             comov_energy = current_energy[0] * doppler_factor
 
 
             #new mu chosen
-            current_mu[0] = 2 * rk_double(&mt_state) - 1
+            current_mu[0] = 2 * packet_rng_double(&storage.rng_state) - 1
             inverse_doppler_factor = 1 / (
                 1 - (current_mu[0] * current_r[0] * storage.inverse_time_explosion * inverse_c))
             current_nu[0] = comov_nu * inverse_doppler_factor
@@ -957,13 +2147,17 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
                                     '-' * 80)
                 # ^^^^^^^^^^^^^^^^^^^^^^^^^^^ LOGGING # ^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
-            tau_event = -log(rk_double(&mt_state))
+            tau_event = -log(packet_rng_double(&storage.rng_state))
 
             #scattered so can re-cross a boundary now
             recently_crossed_boundary[0] = 0
             #We've had an electron scattering event in the SN. This corresponds to a source term - we need to spawn virtual packets now
 
-            storage.last_interaction_type[storage.current_packet_id] = 1
+            if storage.estimator_mask & ESTIMATOR_LAST_INTERACTION:
+                storage.last_interaction_type[storage.current_packet_id] = 1
+            count_event(storage, COUNTER_ELECTRON_SCATTERINGS, current_shell_id[0], 1)
+            trace_packet_event(storage, EVENT_ELECTRON_SCATTERING, current_shell_id[0], current_line_id[0],
+                               current_r[0], current_mu[0], current_nu[0], current_energy[0])
 
             if (virtual_packet_flag > 0):
                 #print "AN ELECTRON SCATTERING HAPPENED: CALLING VIRTUAL PARTICLES!!!!!!"
@@ -977,13 +2171,17 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
         elif (d_line <= d_outer) and (d_line <= d_inner) and (d_line <= d_electron):
         #Line scattering
             #It has a chance to hit the line
-            if virtual_packet == 0:
+            if virtual_packet == 0 and (storage.estimator_mask & ESTIMATOR_J_BLUES):
                 j_blue_idx = current_shell_id[0] * storage.line_lists_j_blues_nd + current_line_id[0]
                 increment_j_blue_estimator(current_line_id, current_nu, current_energy, current_mu, current_r, d_line,
                                            j_blue_idx, storage)
 
-            tau_line = storage.line_lists_tau_sobolevs[
-                current_shell_id[0] * storage.line_lists_tau_sobolevs_nd + current_line_id[0]]
+            if storage.line_lists_tau_sobolevs_single != NULL:
+                tau_line = storage.line_lists_tau_sobolevs_single[
+                    current_shell_id[0] * storage.line_lists_tau_sobolevs_nd + current_line_id[0]]
+            else:
+                tau_line = storage.line_lists_tau_sobolevs[
+                    current_shell_id[0] * storage.line_lists_tau_sobolevs_nd + current_line_id[0]]
 
             tau_electron = storage.sigma_thomson * storage.electron_densities[current_shell_id[0]] * d_line
             tau_combined = tau_line + tau_electron
@@ -1030,18 +2228,22 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
 
 
 
-                    old_doppler_factor = move_packet(current_r, current_mu, current_nu[0], current_energy[0], d_line,
-                                                     storage.js,
-                                                     storage.nubars, storage.inverse_time_explosion,
-                                                     current_shell_id[0], virtual_packet)
+                    move_packet(current_r, current_mu, current_nu[0], current_energy[0], d_line, storage.js,
+                                storage.nubars, storage.inverse_time_explosion, current_shell_id[0], virtual_packet,
+                                storage.numerical_warnings)
+                    count_event(storage, COUNTER_LINE_INTERACTIONS, current_shell_id[0], 1)
+
+                    #comoving frame at the interaction point
+                    doppler_factor = 1 - current_mu[0] * current_r[0] * storage.inverse_time_explosion * inverse_c
 
-                    current_mu[0] = 2 * rk_double(&mt_state) - 1
+                    current_mu[0] = 2 * packet_rng_double(&storage.rng_state) - 1
 
                     inverse_doppler_factor = 1 / (
                         1 - (current_mu[0] * current_r[0] * storage.inverse_time_explosion * inverse_c))
 
-                    comov_nu = current_nu[0] * old_doppler_factor
-                    comov_energy = current_energy[0] * old_doppler_factor
+                    comov_nu = current_nu[0] * doppler_factor
+                    comov_energy = current_energy[0] * doppler_factor
+                    absorbed_energy = current_energy[0]
 
                     #new mu chosen
                     current_energy[0] = comov_energy * inverse_doppler_factor
@@ -1062,25 +2264,37 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
                     if storage.line_interaction_id == 0: #scatter
                         emission_line_id = current_line_id[0] - 1
                     elif storage.line_interaction_id >= 1:# downbranch & macro
-                        storage.last_line_interaction_in_id[storage.current_packet_id] = current_line_id[0] - 1
-                        storage.last_line_interaction_shell_id[storage.current_packet_id] = current_shell_id[0]
-                        storage.last_interaction_type[storage.current_packet_id] = 2
+                        if storage.estimator_mask & ESTIMATOR_LAST_INTERACTION:
+                            storage.last_line_interaction_in_id[storage.current_packet_id] = current_line_id[0] - 1
+                            storage.last_line_interaction_shell_id[storage.current_packet_id] = current_shell_id[0]
+                            storage.last_interaction_type[storage.current_packet_id] = 2
                         activate_level_id = storage.line2macro_level_upper[current_line_id[0] - 1]
                         #print "HERE %g %g" %(current_line_id[0], activate_level_id)
                         #print "DEST " , (storage.destination_level_id[0], storage.destination_level_id[5], storage.destination_level_id[10])
                         #print "DEST " , (storage.macro_block_references[0], storage.macro_block_references[5], storage.macro_block_references[10])
+                        no_of_jumps = 0
                         emission_line_id = macro_atom(activate_level_id,
-                                                      storage.transition_probabilities,
+                                                      storage.transition_cumulative_probabilities,
+                                                      storage.transition_cumulative_probabilities_single,
                                                       storage.transition_probabilities_nd,
                                                       storage.transition_type,
                                                       storage.destination_level_id,
                                                       storage.transition_line_id,
                                                       storage.macro_block_references,
-                                                      current_shell_id[0])
-                    storage.last_line_interaction_out_id[storage.current_packet_id] = emission_line_id
+                                                      current_shell_id[0],
+                                                      &storage.rng_state,
+                                                      &no_of_jumps)
+                        count_event(storage, COUNTER_MACRO_ATOM_JUMPS, current_shell_id[0], no_of_jumps)
+                    if storage.estimator_mask & ESTIMATOR_LAST_INTERACTION:
+                        storage.last_line_interaction_out_id[storage.current_packet_id] = emission_line_id
+                    if storage.estimator_mask & ESTIMATOR_LINE_TALLIES:
+                        tally_line_interaction(storage, current_shell_id[0], current_line_id[0] - 1, emission_line_id,
+                                               absorbed_energy, current_energy[0])
                     current_nu[0] = storage.line_list_nu[emission_line_id] * inverse_doppler_factor
                     nu_line = storage.line_list_nu[emission_line_id]
                     current_line_id[0] = emission_line_id + 1
+                    trace_packet_event(storage, EVENT_LINE_INTERACTION, current_shell_id[0], emission_line_id,
+                                       current_r[0], current_mu[0], current_nu[0], current_energy[0])
 
                     IF packet_logging == True:
                         packet_logger.debug('Line interaction over. New Line %d (nu=%s; rest)', emission_line_id + 1,
@@ -1090,7 +2304,7 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
 
 
                     # getting new tau_event
-                    tau_event = -log(rk_double(&mt_state))
+                    tau_event = -log(packet_rng_double(&storage.rng_state))
 
                     # reseting recently crossed boundary - can intersect with inner boundary again
                     recently_crossed_boundary[0] = 0
@@ -1137,11 +2351,18 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
                     #print "here %g %g %g" % (sqrt(2.), abs(-2.), log(2.7))
                     # ^^^^^^^^^^^^^^^^^^^^^^^^^ SCATTER EVENT LINE ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 
+        #virtual packets past the optical depth cutoff are either dropped or play Russian roulette: the survivors carry
+        #the energy of the killed packets and meet the next roulette one cutoff further on
         if (virtual_packet > 0):
-            if (tau_event > 10.0):
-                tau_event = 100.0
-                reabsorbed = 0
-                break
+            if (tau_event > tau_roulette):
+                if (storage.virtual_packet_survival_probability > 0) and \
+                        (packet_rng_double(&storage.rng_state) < storage.virtual_packet_survival_probability):
+                    current_energy[0] /= storage.virtual_packet_survival_probability
+                    tau_roulette += storage.virtual_packet_tau_cutoff
+                else:
+                    current_energy[0] = 0.0
+                    reabsorbed = 0
+                    break
 
 
     # ------------------------------ LOGGING ----------------------
@@ -1158,6 +2379,6 @@ cdef int_type_t montecarlo_one_packet_loop(StorageModel storage, float_type_t*cu
         #print "reabsorbed mu = %g" % (current_mu[0])
 
     if (current_energy[0] < 0):
-        print "negative energy"
+        storage.numerical_warnings[WARNING_NEGATIVE_ENERGY] += 1
 
     return reabsorbed
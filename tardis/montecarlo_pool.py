@@ -0,0 +1,287 @@
+#running the MonteCarlo packet loop on several processes
+
+import ctypes
+import logging
+import multiprocessing
+from multiprocessing import sharedctypes
+import time
+
+import numpy as np
+import pandas as pd
+
+import montecarlo_multizone
+import spectrum_grid
+
+logger = logging.getLogger(__name__)
+
+#model arrays mapped from shared memory in every worker (set by `_initialize_worker`)
+_worker_arrays = {}
+
+
+#positions of the per-packet and of the summed arrays in the output of `montecarlo_multizone.montecarlo_radial1d`
+_packet_outputs = (0, 1, 4, 5, 6, 7)
+_summed_outputs = (2, 3, 8)
+
+_ctypes_types = {np.dtype(np.float64): ctypes.c_double, np.dtype(np.float32): ctypes.c_float,
+                 np.dtype(np.int64): ctypes.c_int64}
+
+
+def _make_shared_array(shape, dtype=np.float64):
+    """
+    Allocate a float64 (or float32 or int64) array in shared memory. Returns the raw buffer (to be handed to the workers) and a
+    numpy view on it.
+    """
+    raw_array = sharedctypes.RawArray(_ctypes_types[np.dtype(dtype)], int(np.prod(shape)))
+    return raw_array, _view_shared_array(raw_array, shape, dtype)
+
+
+def _view_shared_array(raw_array, shape, dtype=np.float64):
+    return np.frombuffer(raw_array, dtype=dtype).reshape(shape)
+
+
+def _initialize_worker(shared_arrays, macro_atom_arrays):
+    """
+    Map the shared model arrays into the worker. This runs once when the worker process starts, the arrays are refilled
+    by the parent before every MonteCarlo run.
+    """
+    for name, (raw_array, shape, dtype) in shared_arrays.items():
+        _worker_arrays[name] = _view_shared_array(raw_array, shape, dtype)
+    _worker_arrays.update(macro_atom_arrays)
+
+
+class _ShardAtomData(object):
+    """
+    Minimal stand-in for `tardis.atomic.AtomData` with the macro atom arrays the MonteCarlo kernel reads.
+    """
+
+    def __init__(self, block_references, transition_type, destination_level_idx):
+        self.macro_atom_references = pd.DataFrame({'block_references': block_references})
+        self.macro_atom_data = pd.DataFrame({'transition_type': transition_type,
+                                             'destination_level_idx': destination_level_idx})
+
+
+class _ShardPacketSource(object):
+    def __init__(self, packet_nus, packet_mus, packet_energies, packet_tau_randoms):
+        self.packet_nus = packet_nus
+        self.packet_mus = packet_mus
+        self.packet_energies = packet_energies
+        self.packet_tau_randoms = packet_tau_randoms
+
+
+class _ShardModel(object):
+    """
+    The parts of `tardis.model_radial_oned.Radial1DModel` needed by `montecarlo_multizone.montecarlo_radial1d` for one
+    shard of packets. The large line arrays are views on the shared memory of the worker.
+    """
+
+    def __init__(self, shard):
+        self.packet_src = _ShardPacketSource(shard['packet_nus'], shard['packet_mus'], shard['packet_energies'],
+                                             shard['packet_tau_randoms'])
+
+        for key in ('no_of_shells', 'r_inner', 'r_outer', 'v_inner', 'time_explosion', 'electron_densities',
+                    'line_interaction_id', 'sigma_thomson', 'seed', 'iterations_executed',
+                    'virtual_packet_tau_cutoff', 'virtual_packet_survival_probability', 'diffusion_tau_threshold',
+                    'estimators'):
+            setattr(self, key, shard[key])
+
+        self.line_list_nu = pd.Series(_worker_arrays['line_list_nu'], copy=False)
+        self.tau_sobolevs = _worker_arrays['tau_sobolevs']
+        self.next_significant_line = _worker_arrays.get('next_significant_line', None)
+        self.tau_skipped_cumulative = _worker_arrays.get('tau_skipped_cumulative', None)
+        #the line estimators of the shard go to its own slice of the shared estimator arrays
+        if 'j_blues' in _worker_arrays:
+            self.j_blues = _worker_arrays['j_blues'][shard['shard_id']]
+        else:
+            self.j_blues = np.zeros((self.no_of_shells, 0), dtype=self.tau_sobolevs.dtype)
+        if 'line_interaction_counts' in _worker_arrays:
+            self.line_interaction_counts = _worker_arrays['line_interaction_counts'][shard['shard_id']]
+            self.line_interaction_energies = _worker_arrays['line_interaction_energies'][shard['shard_id']]
+        self.spectrum_grids = [spectrum_grid.SpectrumGrid(name, nu_bins, spacing)
+                               for name, nu_bins, spacing in shard['spectrum_grids']]
+
+        if self.line_interaction_id >= 1:
+            self.transition_cumulative_probabilities = _worker_arrays['transition_cumulative_probabilities']
+            self.line2macro_level_upper = _worker_arrays['line2macro_level_upper']
+            self.transition_line_id = _worker_arrays['transition_line_id']
+            self.atom_data = _ShardAtomData(_worker_arrays['block_references'],
+                                            _worker_arrays['transition_type'],
+                                            _worker_arrays['destination_level_idx'])
+
+
+def _run_shard(shard):
+    shard_model = _ShardModel(shard)
+    montecarlo_output = montecarlo_multizone.montecarlo_radial1d(shard_model,
+                                                                 virtual_packet_flag=shard['virtual_packet_flag'],
+                                                                 no_of_threads=shard['no_of_threads'],
+                                                                 packet_id_offset=shard['packet_id_offset'])
+    return shard['shard_id'], montecarlo_output, [grid.histograms for grid in shard_model.spectrum_grids]
+
+
+class MonteCarloPool(object):
+    """
+    Pool of worker processes that run the MonteCarlo packet loop on shards of the packets.
+
+    The line list, the Sobolev optical depths, the cumulative transition probabilities (and the line skipping index if
+    it is used) are placed in shared memory once and
+    only refilled before every run, so they are not pickled for every shard. Every shard writes its j_blues (and line
+    interaction tallies) into its own slice of shared estimator arrays, so these are not pickled back either. Because
+    the random numbers of a packet only depend on the seed, the iteration and its global packet id, the merged output is
+    the same as the output of a single process (the summed estimators up to floating point rounding).
+
+    Parameters
+    ----------
+
+    model : `tardis.model_radial_oned.Radial1DModel`
+        model with initialized plasmas (the shapes of the shared arrays are taken from it)
+
+    no_of_processes : `int`
+        number of worker processes
+
+    no_of_threads : `int`
+        number of OpenMP threads used by every worker
+    """
+
+    def __init__(self, model, no_of_processes, no_of_threads=1):
+        self.no_of_processes = no_of_processes
+        self.no_of_threads = no_of_threads
+
+        shared_arrays = {}
+        self.shared_views = {}
+        shared_arrays_shapes = [('line_list_nu', (len(model.line_list_nu),), np.float64),
+                                ('tau_sobolevs', model.tau_sobolevs.shape, model.tau_sobolevs.dtype)]
+        if model.line_interaction_id >= 1:
+            shared_arrays_shapes.append(('transition_cumulative_probabilities',
+                                         model.transition_cumulative_probabilities.shape,
+                                         model.transition_cumulative_probabilities.dtype))
+        if getattr(model, 'next_significant_line', None) is not None:
+            shared_arrays_shapes.append(('next_significant_line', model.next_significant_line.shape, np.int64))
+            shared_arrays_shapes.append(('tau_skipped_cumulative', model.tau_skipped_cumulative.shape, np.float64))
+
+        #one slice of the line estimators per shard (there is one shard per process)
+        estimators = getattr(model, 'estimators', None)
+        if estimators is None or 'j_blues' in estimators:
+            shared_arrays_shapes.append(('j_blues', (no_of_processes,) + model.tau_sobolevs.shape,
+                                         model.tau_sobolevs.dtype))
+        if estimators is not None and 'line_tallies' in estimators:
+            tally_shape = (no_of_processes, 2) + model.tau_sobolevs.shape
+            shared_arrays_shapes.append(('line_interaction_counts', tally_shape, np.int64))
+            shared_arrays_shapes.append(('line_interaction_energies', tally_shape, np.float64))
+
+        for name, shape, dtype in shared_arrays_shapes:
+            raw_array, self.shared_views[name] = _make_shared_array(shape, dtype)
+            shared_arrays[name] = (raw_array, shape, dtype)
+
+        macro_atom_arrays = {}
+        if model.line_interaction_id >= 1:
+            macro_atom_data = model.atom_data.macro_atom_data
+            macro_atom_arrays['line2macro_level_upper'] = model.line2macro_level_upper
+            macro_atom_arrays['block_references'] = model.atom_data.macro_atom_references['block_references'].values
+            macro_atom_arrays['transition_type'] = macro_atom_data['transition_type'].values
+            macro_atom_arrays['destination_level_idx'] = macro_atom_data['destination_level_idx'].values
+            macro_atom_arrays['transition_line_id'] = model.transition_line_id
+
+        logger.info('Starting %d MonteCarlo worker processes', no_of_processes)
+        self.pool = multiprocessing.Pool(no_of_processes, initializer=_initialize_worker,
+                                         initargs=(shared_arrays, macro_atom_arrays))
+
+    def run(self, model, virtual_packet_flag=0, packet_id_offset=0, reset_estimators=True, progress_callback=None):
+        """
+        Run the packets of `model.packet_src` on the workers and merge the results. `packet_id_offset` is the global id
+        of the first packet and with `reset_estimators` set to `False` the j_blues are added to `model.j_blues` (see
+        `montecarlo_multizone.montecarlo_radial1d`). `progress_callback` is called (with the same arguments as in
+        `montecarlo_multizone.montecarlo_radial1d`) whenever a shard is finished.
+
+        Returns the same tuple as `montecarlo_multizone.montecarlo_radial1d`: output_nus and output_energies (and the
+        last interaction arrays) are concatenated in packet order, js, nubars and the event counters are summed.
+        `model.j_blues` (and the line interaction tallies) and the histograms of `model.spectrum_grids` receive the
+        summed estimators of all shards.
+        """
+
+        self.shared_views['line_list_nu'][:] = model.line_list_nu.values
+        self.shared_views['tau_sobolevs'][:] = model.tau_sobolevs
+        if 'transition_cumulative_probabilities' in self.shared_views:
+            self.shared_views['transition_cumulative_probabilities'][:] = model.transition_cumulative_probabilities
+        if 'next_significant_line' in self.shared_views:
+            self.shared_views['next_significant_line'][:] = model.next_significant_line
+            self.shared_views['tau_skipped_cumulative'][:] = model.tau_skipped_cumulative
+
+        no_of_packets = len(model.packet_src.packet_nus)
+        packet_tau_randoms = getattr(model.packet_src, 'packet_tau_randoms', None)
+        shard_boundaries = np.linspace(0, no_of_packets, self.no_of_processes + 1).astype(np.int64)
+        spectrum_grids = getattr(model, 'spectrum_grids', None) or []
+
+        shards = []
+        for shard_id, (start, end) in enumerate(zip(shard_boundaries[:-1], shard_boundaries[1:])):
+            shards.append(dict(shard_id=shard_id,
+                               packet_nus=model.packet_src.packet_nus[start:end],
+                               packet_mus=model.packet_src.packet_mus[start:end],
+                               packet_energies=model.packet_src.packet_energies[start:end],
+                               packet_tau_randoms=None if packet_tau_randoms is None else
+                               packet_tau_randoms[start:end],
+                               packet_id_offset=packet_id_offset + start,
+                               no_of_shells=model.no_of_shells,
+                               r_inner=model.r_inner,
+                               r_outer=model.r_outer,
+                               v_inner=model.v_inner,
+                               time_explosion=model.time_explosion,
+                               electron_densities=model.electron_densities,
+                               line_interaction_id=model.line_interaction_id,
+                               spectrum_grids=[(grid.name, grid.nu_bins, grid.spacing) for grid in spectrum_grids],
+                               sigma_thomson=model.sigma_thomson,
+                               seed=model.seed,
+                               iterations_executed=model.iterations_executed,
+                               virtual_packet_tau_cutoff=model.virtual_packet_tau_cutoff,
+                               virtual_packet_survival_probability=model.virtual_packet_survival_probability,
+                               diffusion_tau_threshold=getattr(model, 'diffusion_tau_threshold', 0.0),
+                               estimators=getattr(model, 'estimators', None),
+                               virtual_packet_flag=virtual_packet_flag,
+                               no_of_threads=self.no_of_threads))
+
+        start_time = time.time()
+        packet_outputs = None
+        shard_summed_outputs = [None] * len(shards)
+        shard_spectrum_histograms = [None] * len(shards)
+        no_of_packets_done = 0
+        #the shards are merged as they arrive, only the small summed estimators are kept (and summed in shard order at
+        #the end, so the result does not depend on the order in which the shards finish)
+        for shard_id, montecarlo_output, spectrum_histograms in self.pool.imap_unordered(_run_shard, shards):
+            start, end = shard_boundaries[shard_id], shard_boundaries[shard_id + 1]
+            if packet_outputs is None:
+                packet_outputs = [np.empty(no_of_packets, dtype=montecarlo_output[i].dtype) for i in _packet_outputs]
+            for packet_output, i in zip(packet_outputs, _packet_outputs):
+                packet_output[start:end] = montecarlo_output[i]
+            shard_summed_outputs[shard_id] = [montecarlo_output[i] for i in _summed_outputs]
+            shard_spectrum_histograms[shard_id] = spectrum_histograms
+
+            no_of_packets_done += end - start
+            if progress_callback is not None:
+                elapsed_time = time.time() - start_time
+                progress_callback(no_of_packets_done, no_of_packets, elapsed_time,
+                                  no_of_packets_done / elapsed_time if elapsed_time > 0 else 0.0)
+
+        if 'j_blues' in self.shared_views:
+            if reset_estimators:
+                model.j_blues[:] = 0.0
+            #summed in double precision and only rounded once when stored in float32 j_blues
+            np.add(model.j_blues, self.shared_views['j_blues'].sum(axis=0, dtype=np.float64), out=model.j_blues,
+                   casting='unsafe')
+        if 'line_interaction_counts' in self.shared_views:
+            if reset_estimators:
+                model.line_interaction_counts[:] = 0
+                model.line_interaction_energies[:] = 0.0
+            model.line_interaction_counts += self.shared_views['line_interaction_counts'].sum(axis=0)
+            model.line_interaction_energies += self.shared_views['line_interaction_energies'].sum(axis=0)
+        for spectrum_histograms in shard_spectrum_histograms:
+            for grid, histograms in zip(spectrum_grids, spectrum_histograms):
+                grid.histograms += histograms
+
+        js, nubars, event_counters = [np.sum(summed_output, axis=0) for summed_output in zip(*shard_summed_outputs)]
+        output_nus, output_energies, last_line_interaction_in_id, last_line_interaction_out_id, \
+        last_interaction_type, last_line_interaction_shell_id = packet_outputs
+
+        return output_nus, output_energies, js, nubars, last_line_interaction_in_id, last_line_interaction_out_id, \
+               last_interaction_type, last_line_interaction_shell_id, event_counters
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,365 @@
+#event-based MonteCarlo transport with numpy array operations
+
+import logging
+import time
+
+import numpy as np
+from astropy import constants
+
+logger = logging.getLogger(__name__)
+
+c = constants.c.cgs.value
+sigma_thomson_default = 6.652486e-25 #cm^(-2)
+
+miss_distance = 1e99
+
+#event types (in the order of precedence used by `montecarlo_multizone` for equal distances)
+EVENT_OUTER = 0
+EVENT_INNER = 1
+EVENT_ELECTRON = 2
+EVENT_LINE = 3
+
+#rows of the event counters - need to match `montecarlo_multizone.event_counter_names`
+COUNTER_LINE_INTERACTIONS = 0
+COUNTER_ELECTRON_SCATTERINGS = 1
+COUNTER_BOUNDARY_CROSSINGS = 2
+COUNTER_MACRO_ATOM_JUMPS = 3
+COUNTER_REABSORPTIONS = 4
+COUNTER_STEPS = 5
+COUNTER_VIRTUAL_STEPS = 6
+COUNTER_DIFFUSION_STEPS = 7
+NO_OF_EVENT_COUNTERS = 8
+
+#rows of the line interaction tallies - need to match the TALLY_* constants in montecarlo_multizone.pyx
+TALLY_ABSORBED = 0
+TALLY_EMITTED = 1
+
+
+def montecarlo_radial1d(model, virtual_packet_flag=0, packet_id_offset=0, reset_estimators=True,
+                        progress_callback=None, progress_interval=0):
+    """
+    Event-based alternative to `montecarlo_multizone.montecarlo_radial1d`.
+
+    Instead of following one packet at a time, all live packets are advanced by one event per step: the distances to
+    the inner and outer shell boundary, the next line and the next electron scattering are computed for all packets at
+    once and each event type is then applied to the packets it selected with a masked update. The physics follows the
+    Cython kernel, but the random numbers are drawn from a numpy `RandomState` (seeded with the model seed and the
+    iteration and the packet id offset), so the results are statistically equivalent and not identical packet by
+    packet.
+
+    Parameters
+    ----------
+
+    model : `tardis.model_radial_oned.Radial1DModel`
+        complete model
+
+    virtual_packet_flag : `int`
+        virtual packets are not supported by this backend and this has to be 0
+
+    packet_id_offset : `int`
+        global id of the first packet in `model.packet_src` (a chunk of the packets of an iteration gets its own random
+        stream)
+
+    reset_estimators : `bool`
+        if `False` the j_blue estimators (and line interaction tallies) are added to the model arrays instead of
+        replacing them (the packets are always added to the histograms of the grids in `model.spectrum_grids`)
+
+    progress_callback : `None` or callable
+        called as `progress_callback(no_of_packets_done, no_of_packets, elapsed_time, packets_per_second)` whenever
+        another `progress_interval` packets (a fifth of the packets if 0) have escaped or were reabsorbed
+
+    Returns
+    -------
+
+    The same tuple as `montecarlo_multizone.montecarlo_radial1d`: output_nus, output_energies, js, nubars,
+    last_line_interaction_in_id, last_line_interaction_out_id, last_interaction_type, last_line_interaction_shell_id,
+    event_counters (a step is one event of a packet here, the virtual steps are always 0)
+    """
+
+    if virtual_packet_flag > 0:
+        raise ValueError('Virtual packets are not supported by the vectorized MonteCarlo backend')
+
+    seed = int(model.seed)
+    random_state_key = [seed & 0xffffffff, seed >> 32, model.iterations_executed]
+    if packet_id_offset > 0:
+        random_state_key.append(packet_id_offset)
+    random_state = np.random.RandomState(random_state_key)
+
+    time_explosion = model.time_explosion
+    inverse_ct = 1 / (c * time_explosion)
+    r_inner = model.r_inner
+    r_outer = model.r_outer
+    no_of_shells = model.no_of_shells
+
+    sigma_thomson = sigma_thomson_default if model.sigma_thomson is None else model.sigma_thomson
+    electron_opacities = model.electron_densities * sigma_thomson
+
+    line_list_nu = model.line_list_nu.values
+    no_of_lines = len(line_list_nu)
+    tau_sobolevs = model.tau_sobolevs
+    estimators = getattr(model, 'estimators', None)
+    track_j_blues = estimators is None or 'j_blues' in estimators
+    track_last_interaction = estimators is None or 'last_interaction' in estimators
+    track_line_tallies = estimators is not None and 'line_tallies' in estimators
+    if track_j_blues and reset_estimators:
+        model.j_blues[:] = 0.0
+    #single precision j_blues are accumulated in a float64 array and only rounded once when added to the model
+    if track_j_blues and model.j_blues.dtype != np.float64:
+        j_blues = np.zeros(model.j_blues.shape)
+    else:
+        j_blues = model.j_blues
+    if track_line_tallies and reset_estimators:
+        model.line_interaction_counts[:] = 0
+        model.line_interaction_energies[:] = 0.0
+
+    if model.line_interaction_id >= 1:
+        macro_atom = _MacroAtom(model)
+
+    no_of_packets = len(model.packet_src.packet_nus)
+    js = np.zeros(no_of_shells)
+    nubars = np.zeros(no_of_shells)
+    output_nus = np.zeros(no_of_packets)
+    output_energies = np.zeros(no_of_packets)
+    no_of_last_interactions = no_of_packets if track_last_interaction else 0
+    last_line_interaction_in_id = -np.ones(no_of_last_interactions, dtype=np.int64)
+    last_line_interaction_out_id = -np.ones(no_of_last_interactions, dtype=np.int64)
+    last_line_interaction_shell_id = -np.ones(no_of_last_interactions, dtype=np.int64)
+    last_interaction_type = -np.ones(no_of_last_interactions, dtype=np.int64)
+    event_counters = np.zeros((NO_OF_EVENT_COUNTERS, no_of_shells), dtype=np.int64)
+
+    #packet states - the packets start at the inner boundary with comoving frame nu and energy
+    packet_id = np.arange(no_of_packets)
+    mu = model.packet_src.packet_mus.copy()
+    r = np.ones(no_of_packets) * r_inner[0]
+    inverse_doppler_factor = 1 / (1 - mu * r * inverse_ct)
+    nu = model.packet_src.packet_nus * inverse_doppler_factor
+    energy = model.packet_src.packet_energies * inverse_doppler_factor
+    shell_id = np.zeros(no_of_packets, dtype=np.int64)
+    #index of the next line - the line list is sorted by decreasing frequency
+    line_id = np.searchsorted(-line_list_nu, -model.packet_src.packet_nus, side='right')
+    recently_crossed_boundary = np.ones(no_of_packets, dtype=np.int64)
+
+    packet_tau_randoms = getattr(model.packet_src, 'packet_tau_randoms', None)
+    if packet_tau_randoms is not None:
+        tau_event = -np.log(1 - packet_tau_randoms)
+    else:
+        tau_event = -np.log(1 - random_state.random_sample(no_of_packets))
+
+    if progress_interval <= 0:
+        progress_interval = max(1, no_of_packets // 5)
+    start_time = time.time()
+
+    no_of_steps = 0
+    while packet_id.size > 0:
+        no_of_steps += 1
+        event_counters[COUNTER_STEPS] += np.bincount(shell_id, minlength=no_of_shells)
+        doppler_factor = 1 - mu * r * inverse_ct
+
+        # ------------------ DISTANCES ---------------------
+        check = r_inner[shell_id] ** 2 + r ** 2 * (mu ** 2 - 1)
+        d_inner = np.ones_like(r) * miss_distance
+        hits_inner = (check >= 0) & (mu < 0) & (recently_crossed_boundary != 1)
+        d_inner[hits_inner] = -r[hits_inner] * mu[hits_inner] - np.sqrt(check[hits_inner])
+
+        d_outer = np.sqrt(r_outer[shell_id] ** 2 + (mu ** 2 - 1) * r ** 2) - r * mu
+
+        last_line = line_id >= no_of_lines
+        nu_line = line_list_nu[np.minimum(line_id, no_of_lines - 1)]
+        d_line = np.where(last_line, miss_distance,
+                          np.maximum((nu * doppler_factor - nu_line) / nu * c * time_explosion, 0.0))
+
+        d_electron = tau_event / electron_opacities[shell_id]
+
+        event = np.empty(packet_id.size, dtype=np.int64)
+        event.fill(EVENT_LINE)
+        event[(d_electron <= d_outer) & (d_electron <= d_inner) & (d_electron < d_line)] = EVENT_ELECTRON
+        event[(d_inner <= d_outer) & (d_inner <= d_electron) & (d_inner < d_line)] = EVENT_INNER
+        event[(d_outer <= d_inner) & (d_outer <= d_electron) & (d_outer < d_line)] = EVENT_OUTER
+
+        distance = np.choose(event, (d_outer, d_inner, d_electron, d_line))
+
+        # ------------------ LINE EVENTS ---------------------
+        #lines are first checked at the position where the packet would meet them
+        line_mask = event == EVENT_LINE
+        interacting = np.zeros(packet_id.size, dtype=bool)
+        if line_mask.any():
+            line_shell_id = shell_id[line_mask]
+            current_line_id = line_id[line_mask]
+            current_distance = distance[line_mask]
+            r_interaction = np.sqrt(r[line_mask] ** 2 + current_distance ** 2 +
+                                    2 * r[line_mask] * current_distance * mu[line_mask])
+            mu_interaction = (mu[line_mask] * r[line_mask] + current_distance) / r_interaction
+            if track_j_blues:
+                np.add.at(j_blues, (line_shell_id, current_line_id),
+                          energy[line_mask] * (1 - mu_interaction * r_interaction * inverse_ct) / nu[line_mask])
+
+            tau_line = tau_sobolevs[line_shell_id, current_line_id]
+            tau_combined = tau_line + electron_opacities[line_shell_id] * current_distance
+            line_id[line_mask] += 1
+
+            line_interacting = tau_event[line_mask] < tau_combined
+            interacting[line_mask] = line_interacting
+            passed_tau_event = tau_event[line_mask]
+            passed_tau_event[~line_interacting] -= tau_line[~line_interacting]
+            tau_event[line_mask] = passed_tau_event
+
+        # ------------------ MOVING PACKETS ---------------------
+        #packets passing a line without interaction stay where they are
+        moving = ~line_mask | interacting
+        moving_distance = np.where(moving, distance, 0.0)
+        comov_energy = energy * doppler_factor
+        np.add.at(js, shell_id, comov_energy * moving_distance)
+        np.add.at(nubars, shell_id, comov_energy * moving_distance * nu * doppler_factor)
+
+        new_r = np.sqrt(r ** 2 + moving_distance ** 2 + 2 * r * moving_distance * mu)
+        mu = np.where(moving_distance > 0, (mu * r + moving_distance) / new_r, mu)
+        r = new_r
+
+        # ------------------ BOUNDARY CROSSINGS ---------------------
+        escaped = np.zeros(packet_id.size, dtype=bool)
+        reabsorbed = np.zeros(packet_id.size, dtype=bool)
+
+        outer_mask = event == EVENT_OUTER
+        inner_mask = event == EVENT_INNER
+        event_counters[COUNTER_BOUNDARY_CROSSINGS] += np.bincount(shell_id[outer_mask | inner_mask],
+                                                                  minlength=no_of_shells)
+
+        escaped[outer_mask] = shell_id[outer_mask] == no_of_shells - 1
+        outwards = outer_mask & ~escaped
+        shell_id[outwards] += 1
+        recently_crossed_boundary[outwards] = 1
+
+        reabsorbed[inner_mask] = shell_id[inner_mask] == 0
+        event_counters[COUNTER_REABSORPTIONS, 0] += reabsorbed.sum()
+        inwards = inner_mask & ~reabsorbed
+        shell_id[inwards] -= 1
+        recently_crossed_boundary[inwards] = -1
+
+        # ------------------ SCATTERINGS ---------------------
+        electron_mask = event == EVENT_ELECTRON
+        scattered = electron_mask | interacting
+        event_counters[COUNTER_ELECTRON_SCATTERINGS] += np.bincount(shell_id[electron_mask], minlength=no_of_shells)
+        event_counters[COUNTER_LINE_INTERACTIONS] += np.bincount(shell_id[interacting], minlength=no_of_shells)
+        new_mu = 2 * random_state.random_sample(scattered.sum()) - 1
+        #comoving frame at the interaction point
+        interaction_doppler_factor = 1 - mu[scattered] * r[scattered] * inverse_ct
+        comov_nu = nu[scattered] * interaction_doppler_factor
+        comov_energy = energy[scattered] * interaction_doppler_factor
+        mu[scattered] = new_mu
+        new_inverse_doppler_factor = 1 / (1 - new_mu * r[scattered] * inverse_ct)
+        absorbed_energy = energy[interacting]
+        energy[scattered] = comov_energy * new_inverse_doppler_factor
+        nu[scattered] = comov_nu * new_inverse_doppler_factor
+        recently_crossed_boundary[scattered] = 0
+        if track_last_interaction:
+            last_interaction_type[packet_id[electron_mask]] = 1
+
+        if interacting.any():
+            absorbed_line_id = line_id[interacting] - 1
+            if model.line_interaction_id == 0:
+                emission_line_id = absorbed_line_id
+            else:
+                if track_last_interaction:
+                    interacting_packet_id = packet_id[interacting]
+                    last_line_interaction_in_id[interacting_packet_id] = absorbed_line_id
+                    last_line_interaction_shell_id[interacting_packet_id] = shell_id[interacting]
+                    last_interaction_type[interacting_packet_id] = 2
+                emission_line_id = macro_atom.emit(absorbed_line_id, shell_id[interacting], random_state,
+                                                   event_counters[COUNTER_MACRO_ATOM_JUMPS])
+            if track_last_interaction:
+                last_line_interaction_out_id[packet_id[interacting]] = emission_line_id
+            nu[interacting] = line_list_nu[emission_line_id] * new_inverse_doppler_factor[interacting[scattered]]
+            if track_line_tallies:
+                interacting_shell_id = shell_id[interacting]
+                np.add.at(model.line_interaction_counts, (TALLY_ABSORBED, interacting_shell_id, absorbed_line_id), 1)
+                np.add.at(model.line_interaction_energies, (TALLY_ABSORBED, interacting_shell_id, absorbed_line_id),
+                          absorbed_energy)
+                np.add.at(model.line_interaction_counts, (TALLY_EMITTED, interacting_shell_id, emission_line_id), 1)
+                np.add.at(model.line_interaction_energies, (TALLY_EMITTED, interacting_shell_id, emission_line_id),
+                          energy[interacting])
+            line_id[interacting] = emission_line_id + 1
+
+        #every boundary crossing and scattering draws a new optical depth
+        new_tau_event = outer_mask | inner_mask | scattered
+        tau_event[new_tau_event] = -np.log(1 - random_state.random_sample(new_tau_event.sum()))
+
+        # ------------------ FINISHED PACKETS ---------------------
+        output_nus[packet_id[escaped]] = nu[escaped]
+        output_energies[packet_id[escaped]] = energy[escaped]
+        output_nus[packet_id[reabsorbed]] = -nu[reabsorbed]
+        output_energies[packet_id[reabsorbed]] = -energy[reabsorbed]
+
+        alive = ~(escaped | reabsorbed)
+        if not alive.all():
+            no_of_packets_done = no_of_packets - packet_id.size
+            packet_id, mu, r, nu, energy, shell_id, line_id, recently_crossed_boundary, tau_event = \
+                [state[alive] for state in (packet_id, mu, r, nu, energy, shell_id, line_id,
+                                            recently_crossed_boundary, tau_event)]
+            if progress_callback is not None and \
+                    (no_of_packets - packet_id.size) // progress_interval > no_of_packets_done // progress_interval:
+                no_of_packets_done = no_of_packets - packet_id.size
+                elapsed_time = time.time() - start_time
+                progress_callback(no_of_packets_done, no_of_packets, elapsed_time,
+                                  no_of_packets_done / elapsed_time if elapsed_time > 0 else 0.0)
+
+    logger.debug('Vectorized MonteCarlo finished %d packets in %d event steps', no_of_packets, no_of_steps)
+
+    if j_blues is not model.j_blues:
+        np.add(model.j_blues, j_blues, out=model.j_blues, casting='unsafe')
+
+    for grid in getattr(model, 'spectrum_grids', None) or []:
+        grid.add_packets(output_nus, output_energies)
+
+    return output_nus, output_energies, js, nubars, last_line_interaction_in_id, last_line_interaction_out_id, \
+           last_interaction_type, last_line_interaction_shell_id, event_counters
+
+
+class _MacroAtom(object):
+    """
+    Vectorized macro atom (or downbranch) sampling by binary search in the cumulative transition probabilities of the
+    model.
+    """
+
+    def __init__(self, model):
+        self.transition_cumulative_probabilities = model.transition_cumulative_probabilities
+        self.line2macro_level_upper = model.line2macro_level_upper
+        self.block_references = np.hstack((model.atom_data.macro_atom_references['block_references'].values,
+                                           self.transition_cumulative_probabilities.shape[1]))
+        self.transition_type = model.atom_data.macro_atom_data['transition_type'].values
+        self.destination_level_id = model.atom_data.macro_atom_data['destination_level_idx'].values
+        self.transition_line_id = model.transition_line_id
+
+    def emit(self, absorbed_line_id, shell_id, random_state, no_of_jumps=None):
+        """
+        Activate the upper levels of the absorbed lines and follow the internal transitions until all macro atoms have
+        de-activated. Returns the ids of the emission lines. The internal transitions are counted per shell in
+        `no_of_jumps` if it is given.
+        """
+        emission_line_id = np.empty_like(absorbed_line_id)
+        active = np.arange(len(absorbed_line_id))
+        level = self.line2macro_level_upper[absorbed_line_id]
+        shell_id = shell_id.copy()
+
+        while active.size > 0:
+            event_random = random_state.random_sample(active.size)
+            imin = self.block_references[level]
+            imax = self.block_references[level + 1] - 1
+            searching = imin < imax
+            while searching.any():
+                imid = (imin + imax) // 2
+                above = self.transition_cumulative_probabilities[shell_id, imid] > event_random
+                imax = np.where(searching & above, imid, imax)
+                imin = np.where(searching & ~above, imid + 1, imin)
+                searching = imin < imax
+            transition_id = imin
+
+            emitting = self.transition_type[transition_id] == -1
+            emission_line_id[active[emitting]] = self.transition_line_id[transition_id[emitting]]
+
+            active = active[~emitting]
+            level = self.destination_level_id[transition_id[~emitting]]
+            shell_id = shell_id[~emitting]
+            if no_of_jumps is not None:
+                no_of_jumps += np.bincount(shell_id, minlength=len(no_of_jumps))
+
+        return emission_line_id
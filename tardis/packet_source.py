@@ -5,6 +5,7 @@ import numpy as np
 from astropy import units
 
 import plasma
+import montecarlo_multizone
 
 
 class SimplePacketSource:
@@ -17,11 +18,15 @@ class SimplePacketSource:
 
         nu_end : float
             highest_frequency
+
+        packet_sampling : str
+            'random' draws the packet properties from pseudo-random numbers, 'sobol' from a scrambled Sobol
+            low-discrepancy sequence (including the uniform number for the first optical depth of every packet)
     """
 
     @classmethod
     def from_wavelength(cls, wavelength_start, wavelength_end, wavelength_unit='angstrom', seed=250819801106,
-                        blackbody_sampling=int(1e6)):
+                        blackbody_sampling=int(1e6), packet_sampling='random'):
         """Initializing from wavelength
 
         Parameters
@@ -36,16 +41,20 @@ class SimplePacketSource:
         nu_start = wavelength_end.to('Hz', units.spectral()).value
         nu_end = wavelength_start.to('Hz', units.spectral()).value
 
-        return cls(nu_start, nu_end, seed=seed)
+        return cls(nu_start, nu_end, seed=seed, blackbody_sampling=blackbody_sampling, packet_sampling=packet_sampling)
 
-    def __init__(self, nu_start, nu_end, seed=250819801106, blackbody_sampling=int(1e6)):
+    def __init__(self, nu_start, nu_end, seed=250819801106, blackbody_sampling=int(1e6), packet_sampling='random'):
         self.nu_start = nu_start
         self.nu_end = nu_end
         self.blackbody_sampling = blackbody_sampling
+        if packet_sampling not in ('random', 'sobol'):
+            raise ValueError('packet_sampling must be either "random" or "sobol"')
+        self.packet_sampling = packet_sampling
+        self.packet_tau_randoms = None
         np.random.seed(seed)
 
 
-    def create_packets(self, number_of_packets, t_rad, seed=None):
+    def create_packets(self, number_of_packets, t_rad, seed=None, total_number_of_packets=None):
         """
         Creating a new random number of packets, with a certain temperature
 
@@ -58,17 +67,34 @@ class SimplePacketSource:
         t_rad : `float`
             radiation temperature
 
+        total_number_of_packets : `None` or any number
+            number of packets the (unit) energy is shared among, if the packets are one chunk of a larger set. `None`
+            means `number_of_packets`.
+
         """
         if seed is not None:
             np.random.seed(seed)
 
         number_of_packets = int(number_of_packets)
-        self.packet_nus = self.random_blackbody_nu(t_rad, number_of_packets)
-        self.packet_mus = np.sqrt(np.random.random(size=number_of_packets))
-        self.packet_energies = np.ones(number_of_packets) / number_of_packets
 
+        if self.packet_sampling == 'sobol':
+            #a new random shift for every call keeps the iterations independent
+            uniform_numbers = montecarlo_multizone.sobol_sequence(number_of_packets, 4,
+                                                                   np.random.randint(0, 2 ** 31 - 1))
+            self.packet_nus = self.random_blackbody_nu(t_rad, number_of_packets,
+                                                       uniform_numbers=uniform_numbers[:, :2])
+            self.packet_mus = np.sqrt(uniform_numbers[:, 2])
+            self.packet_tau_randoms = uniform_numbers[:, 3].copy()
+        else:
+            self.packet_nus = self.random_blackbody_nu(t_rad, number_of_packets)
+            self.packet_mus = np.sqrt(np.random.random(size=number_of_packets))
+
+        if total_number_of_packets is None:
+            total_number_of_packets = number_of_packets
+        self.packet_energies = np.ones(number_of_packets) / int(total_number_of_packets)
 
-    def random_blackbody_nu(self, T, number_of_packets):
+
+    def random_blackbody_nu(self, T, number_of_packets, uniform_numbers=None):
         """
         Creating the random nus for the energy packets
 
@@ -80,12 +106,20 @@ class SimplePacketSource:
 
         number_of_packets : `int`
             the number of packets
+
+        uniform_numbers : `None` or `np.ndarray`
+            array of shape (number_of_packets, 2) with the uniform numbers used for the sampling. If `None` they are
+            drawn from `np.random`
         """
         nu = np.linspace(self.nu_start, self.nu_end, num=self.blackbody_sampling)
         intensity = plasma.intensity_black_body(nu, T)
         cum_blackbody = np.cumsum(intensity)
         norm_cum_blackbody = cum_blackbody / cum_blackbody.max()
-        return nu[norm_cum_blackbody.searchsorted(np.random.random(number_of_packets))] + \
-               np.random.random(size=number_of_packets) * (nu[1] - nu[0])
+        if uniform_numbers is None:
+            return nu[norm_cum_blackbody.searchsorted(np.random.random(number_of_packets))] + \
+                   np.random.random(size=number_of_packets) * (nu[1] - nu[0])
+        else:
+            return nu[norm_cum_blackbody.searchsorted(uniform_numbers[:, 0])] + \
+                   uniform_numbers[:, 1] * (nu[1] - nu[0])
 
 
@@ -0,0 +1,124 @@
+#tracing the events of MonteCarlo packets
+
+import numpy as np
+
+#layout of one record - needs to match packet_event_t in montecarlo_multizone.pyx
+packet_event_dtype = np.dtype([('packet_id', np.int64),
+                               ('event_type', np.int64),
+                               ('shell_id', np.int64),
+                               ('line_id', np.int64),
+                               ('r', np.float64),
+                               ('mu', np.float64),
+                               ('nu', np.float64),
+                               ('energy', np.float64)])
+
+#event types
+EVENT_START = 0
+EVENT_OUTER_BOUNDARY = 1
+EVENT_INNER_BOUNDARY = 2
+EVENT_ELECTRON_SCATTERING = 3
+EVENT_LINE_INTERACTION = 4
+EVENT_ESCAPED = 5
+EVENT_REABSORBED = 6
+EVENT_DIFFUSION = 7
+
+event_names = {EVENT_START: 'start',
+               EVENT_OUTER_BOUNDARY: 'outer_boundary',
+               EVENT_INNER_BOUNDARY: 'inner_boundary',
+               EVENT_ELECTRON_SCATTERING: 'electron_scattering',
+               EVENT_LINE_INTERACTION: 'line_interaction',
+               EVENT_ESCAPED: 'escaped',
+               EVENT_REABSORBED: 'reabsorbed',
+               EVENT_DIFFUSION: 'diffusion'}
+
+
+class PacketTracer(object):
+    """
+    Ring buffer for the events of (a sample of) the real packets in a MonteCarlo run.
+
+    The MonteCarlo kernel writes one fixed-size record (`packet_event_dtype`) per event: packet start, crossing of a
+    shell boundary, electron scattering, line interaction (`line_id` is the emission line) and the end of the packet.
+    The buffer is split into one segment per thread, so threads write without locking. When a segment is full the
+    oldest records of that segment are overwritten. The buffer is reset at the start of every run, so it holds the
+    events of the last run.
+
+    Parameters
+    ----------
+
+    capacity : `int`
+        total number of records in the buffer
+
+    sampling : `int`
+        only packets with a (global) packet id divisible by `sampling` are traced
+
+    fname : `None` or `str`
+        if given the buffer is a memory-mapped file of that name instead of an in-memory array
+    """
+
+    def __init__(self, capacity=1000000, sampling=1, fname=None):
+        if sampling < 1:
+            raise ValueError('sampling must be at least 1')
+        self.capacity = int(capacity)
+        self.sampling = int(sampling)
+        self.fname = fname
+
+        if fname is None:
+            self.buffer = np.zeros(self.capacity, dtype=packet_event_dtype)
+        else:
+            self.buffer = np.memmap(fname, dtype=packet_event_dtype, mode='w+', shape=(self.capacity,))
+
+        self.no_of_segments = 1
+        self.segment_size = self.capacity
+        self.positions = np.zeros(1, dtype=np.int64)
+
+    def reset(self, no_of_segments=1):
+        """
+        Prepare the buffer for a new run with `no_of_segments` (one per thread) segments.
+        """
+        self.no_of_segments = no_of_segments
+        self.segment_size = self.capacity // no_of_segments
+        if self.segment_size == 0:
+            raise ValueError('The packet tracer capacity (%d) is smaller than the number of threads (%d)' %
+                             (self.capacity, no_of_segments))
+        #number of records written into every segment (including the overwritten ones)
+        self.positions = np.zeros(no_of_segments, dtype=np.int64)
+
+    def events(self, packet_id=None):
+        """
+        Records of the last run, oldest first within every segment.
+
+        Parameters
+        ----------
+
+        packet_id : `None` or `int`
+            only return the events of this packet
+
+        Returns
+        -------
+
+        events : `numpy.ndarray` with dtype `packet_event_dtype`
+        """
+        segments = []
+        for i, position in enumerate(self.positions):
+            segment = self.buffer[i * self.segment_size:(i + 1) * self.segment_size]
+            if position <= self.segment_size:
+                segments.append(segment[:position])
+            else:
+                start = position % self.segment_size
+                segments.append(np.concatenate((segment[start:], segment[:start])))
+
+        events = np.concatenate(segments) if segments else np.zeros(0, dtype=packet_event_dtype)
+        if packet_id is not None:
+            events = events[events['packet_id'] == packet_id]
+        return np.array(events)
+
+    @property
+    def no_of_dropped_events(self):
+        """
+        Number of records that were overwritten because a segment was full
+        """
+        return int(np.maximum(self.positions - self.segment_size, 0).sum())
+
+    def flush(self):
+        if self.fname is not None:
+            self.buffer.flush()
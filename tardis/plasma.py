@@ -659,7 +659,8 @@ class BasePlasma(object):
             Updating the Macro Atom computations
         """
 
-        macro_tau_sobolevs = self.tau_sobolevs[self.atom_data.macro_atom_data['lines_idx'].values.astype(int)]
+        macro_tau_sobolevs = np.asarray(self.tau_sobolevs[self.atom_data.macro_atom_data['lines_idx'].values.astype(int)],
+                                        dtype=np.float64)
 
 
         beta_sobolevs = np.zeros_like(macro_tau_sobolevs)
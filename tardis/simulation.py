@@ -1,22 +1,93 @@
 import logging
 
+import numpy as np
 
 # Adding logging support
 logger = logging.getLogger(__name__)
 
 
+class AdaptivePacketSchedule(object):
+    """
+    Number of packets for the iterations of `run_radial1d` from the convergence state of the model.
+
+    The first iteration runs `min_no_of_packets`. Afterwards the number of packets follows the relative change of the
+    radiation field in the last update (the largest of the median change of t_rad, the median change of w and the
+    change of t_inner, see `Radial1DModel.convergence_ratios`). The MonteCarlo noise only needs to be small compared to
+    that change, and it falls with the square root of the number of packets, so the schedule asks for
+    `max_no_of_packets * (threshold / change) ** 2` packets. All `max_no_of_packets` are used once the change is below
+    `threshold` or the model is converged. The number never decreases and grows by at most `max_growth` per iteration.
+
+    Parameters
+    ----------
+
+    max_no_of_packets : `int`
+        number of packets of the converged iterations (`no_of_packets` of the configuration)
+
+    min_no_of_packets : `int`
+        number of packets of the first iteration
+
+    threshold : `float`
+        relative change of the radiation field below which all packets are used
+
+    max_growth : `float`
+        largest factor between the number of packets of two consecutive iterations
+    """
+
+    def __init__(self, max_no_of_packets, min_no_of_packets, threshold=0.05, max_growth=2.0):
+        self.max_no_of_packets = int(max_no_of_packets)
+        self.min_no_of_packets = int(min_no_of_packets)
+        self.threshold = threshold
+        self.max_growth = max_growth
+        self.no_of_packets = self.min_no_of_packets
+
+    @classmethod
+    def from_tardis_config(cls, tardis_config):
+        return cls(tardis_config.no_of_packets, **tardis_config.packet_schedule)
+
+    def update(self, convergence_ratios, converged=False):
+        """
+        Number of packets for the next iteration after an update of the radiation field with the relative changes
+        `convergence_ratios` (dictionary with the keys 't_rad', 'w' and 't_inner').
+        """
+        if converged:
+            requested_no_of_packets = self.max_no_of_packets
+        else:
+            change = max(np.median(convergence_ratios['t_rad']), np.median(convergence_ratios['w']),
+                         convergence_ratios['t_inner'])
+            if change <= self.threshold:
+                requested_no_of_packets = self.max_no_of_packets
+            else:
+                requested_no_of_packets = int(self.max_no_of_packets * (self.threshold / change) ** 2)
+
+        self.no_of_packets = int(np.clip(requested_no_of_packets, self.no_of_packets,
+                                         min(self.max_no_of_packets, self.no_of_packets * self.max_growth)))
+        return self.no_of_packets
+
+
 def run_radial1d(radial1d_model, save_history=None):
+    packet_schedule = None
+    if radial1d_model.tardis_config.packet_schedule is not None:
+        packet_schedule = AdaptivePacketSchedule.from_tardis_config(radial1d_model.tardis_config)
+        radial1d_model.current_no_of_packets = packet_schedule.no_of_packets
+
     while radial1d_model.iterations_remaining > 0:
         logger.info('Remaining run %d', radial1d_model.iterations_remaining)
         radial1d_model.simulate()
         if save_history is not None:
             save_history.store(radial1d_model)
 
+        if packet_schedule is not None:
+            radial1d_model.current_no_of_packets = packet_schedule.update(radial1d_model.convergence_ratios,
+                                                                          radial1d_model.converged)
+            logger.info('Running %d packets in the next iteration', radial1d_model.current_no_of_packets)
+
 
     #Finished second to last loop running one more time
     logger.info('Doing last run')
     if radial1d_model.tardis_config.last_no_of_packets is not None:
         radial1d_model.current_no_of_packets = radial1d_model.tardis_config.last_no_of_packets
+    elif packet_schedule is not None:
+        radial1d_model.current_no_of_packets = packet_schedule.max_no_of_packets
 
     radial1d_model.simulate(enable_virtual=True, update_radiation_field=False)
 
@@ -24,6 +95,10 @@ def run_radial1d(radial1d_model, save_history=None):
         save_history.store(radial1d_model)
         save_history.finalize()
 
+    if radial1d_model.montecarlo_pool is not None:
+        radial1d_model.montecarlo_pool.close()
+        radial1d_model.montecarlo_pool = None
+
     logger.info("Finished in %d iterations", radial1d_model.iterations_executed)
 
 
@@ -35,3 +110,47 @@ def run_radial1d(radial1d_model, save_history=None):
 
 
 
+
+
+def run_radial1d_batch(radial1d_models):
+    """
+    Run the iterations of several models with the same line list side by side (see
+    `Radial1DModel.simulate_batch`). Every iteration transports the packets of all models that still have iterations
+    left in one kernel call, and the last run (with virtual packets) runs all models together.
+    """
+    radial1d_models = list(radial1d_models)
+    packet_schedules = []
+    for radial1d_model in radial1d_models:
+        packet_schedule = None
+        if radial1d_model.tardis_config.packet_schedule is not None:
+            packet_schedule = AdaptivePacketSchedule.from_tardis_config(radial1d_model.tardis_config)
+            radial1d_model.current_no_of_packets = packet_schedule.no_of_packets
+        packet_schedules.append(packet_schedule)
+
+    while True:
+        running = [(radial1d_model, packet_schedule)
+                   for radial1d_model, packet_schedule in zip(radial1d_models, packet_schedules)
+                   if radial1d_model.iterations_remaining > 0]
+        if not running:
+            break
+        logger.info('Remaining run %d of %d models', max([radial1d_model.iterations_remaining
+                                                          for radial1d_model, packet_schedule in running]),
+                    len(running))
+        running[0][0].simulate_batch([radial1d_model for radial1d_model, packet_schedule in running[1:]])
+
+        for radial1d_model, packet_schedule in running:
+            if packet_schedule is not None:
+                radial1d_model.current_no_of_packets = packet_schedule.update(radial1d_model.convergence_ratios,
+                                                                              radial1d_model.converged)
+
+    logger.info('Doing last run of %d models', len(radial1d_models))
+    for radial1d_model, packet_schedule in zip(radial1d_models, packet_schedules):
+        if radial1d_model.tardis_config.last_no_of_packets is not None:
+            radial1d_model.current_no_of_packets = radial1d_model.tardis_config.last_no_of_packets
+        elif packet_schedule is not None:
+            radial1d_model.current_no_of_packets = packet_schedule.max_no_of_packets
+
+    radial1d_models[0].simulate_batch(radial1d_models[1:], enable_virtual=True, update_radiation_field=False)
+
+    logger.info("Finished %d models in %d iterations", len(radial1d_models),
+                max([radial1d_model.iterations_executed for radial1d_model in radial1d_models]))
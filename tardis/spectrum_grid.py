@@ -0,0 +1,132 @@
+#frequency grids the MonteCarlo kernel bins the packets into
+
+import numpy as np
+from astropy import units
+
+#spacing of the bins - needs to match the GRID_SPACING_* constants in montecarlo_multizone.pyx
+SPACING_LINEAR = 0
+SPACING_LOG = 1
+SPACING_IRREGULAR = 2
+
+#rows of `SpectrumGrid.histograms`
+SPECTRUM_EMITTED = 0
+SPECTRUM_REABSORBED = 1
+SPECTRUM_VIRTUAL = 2
+
+spectrum_names = {'emitted': SPECTRUM_EMITTED, 'reabsorbed': SPECTRUM_REABSORBED, 'virtual': SPECTRUM_VIRTUAL}
+
+
+class SpectrumGrid(object):
+    """
+    Frequency grid with histograms of the energies of the emitted, reabsorbed and virtual packets. The MonteCarlo
+    kernel adds every packet to the histograms of all grids in `model.spectrum_grids` when it finishes, so no pass over
+    the output arrays is needed. The histograms are only reset by `reset`.
+
+    Parameters
+    ----------
+
+    name : `str`
+        name of the grid
+
+    nu_bins : `numpy.ndarray`
+        bin edges in Hz (sorted to increasing frequency)
+
+    spacing : `int`
+        `SPACING_LINEAR` (equal width in frequency), `SPACING_LOG` (equal width in log frequency, i.e. in log
+        wavelength) or `SPACING_IRREGULAR` (found by bisection). With the first two the kernel calculates the bin
+        directly.
+    """
+
+    def __init__(self, name, nu_bins, spacing=SPACING_IRREGULAR):
+        nu_bins = np.sort(np.asarray(nu_bins, dtype=np.float64))
+        if nu_bins.ndim != 1 or len(nu_bins) < 2:
+            raise ValueError('A spectrum grid needs at least two bin edges')
+        if nu_bins[0] <= 0 or np.any(np.diff(nu_bins) <= 0):
+            raise ValueError('The bin edges of a spectrum grid need to be positive and distinct')
+        if spacing not in (SPACING_LINEAR, SPACING_LOG, SPACING_IRREGULAR):
+            raise ValueError('Unknown spacing %s of spectrum grid %s' % (spacing, name))
+
+        self.name = name
+        self.nu_bins = nu_bins
+        self.spacing = spacing
+        self.histograms = np.zeros((3, len(nu_bins) - 1))
+
+    @classmethod
+    def from_config_dict(cls, grid_dict):
+        """
+        Create a grid from one (parsed) entry of the `grids` list of the spectrum configuration: type `linear`
+        (equal width in frequency) or `log_wavelength` between `start` and `end` (in angstrom) with `bins` bins, or type
+        `edges` with the bin edges (in angstrom) read from the file `fname`.
+        """
+        if grid_dict['type'] == 'edges':
+            return cls(grid_dict['name'], wavelength_to_nu(np.loadtxt(grid_dict['fname'], ndmin=1)))
+
+        nu_start, nu_end = wavelength_to_nu(np.array([grid_dict['end'], grid_dict['start']]))
+        if grid_dict['type'] == 'linear':
+            return cls(grid_dict['name'], np.linspace(nu_start, nu_end, grid_dict['bins'] + 1), SPACING_LINEAR)
+        elif grid_dict['type'] == 'log_wavelength':
+            return cls(grid_dict['name'], np.logspace(np.log10(nu_start), np.log10(nu_end), grid_dict['bins'] + 1),
+                       SPACING_LOG)
+        else:
+            raise ValueError('Unknown type %s of spectrum grid %s' % (grid_dict['type'], grid_dict['name']))
+
+    @property
+    def no_of_bins(self):
+        return len(self.nu_bins) - 1
+
+    @property
+    def nu(self):
+        """
+        Bin centers in Hz
+        """
+        return 0.5 * (self.nu_bins[1:] + self.nu_bins[:-1])
+
+    @property
+    def wavelength(self):
+        """
+        Bin centers in angstrom (decreasing, like the frequencies increase)
+        """
+        return nu_to_wavelength(self.nu)
+
+    def reset(self):
+        self.histograms[:] = 0.0
+
+    def add_packets(self, output_nus, output_energies):
+        """
+        Add the output of a MonteCarlo run (negative frequencies for reabsorbed packets) to the emitted and reabsorbed
+        histograms. This is for backends that do not bin the packets themselves.
+        """
+        emitted_mask = output_nus > 0
+        self.histograms[SPECTRUM_EMITTED] += np.histogram(output_nus[emitted_mask], bins=self.nu_bins,
+                                                          weights=output_energies[emitted_mask])[0]
+        self.histograms[SPECTRUM_REABSORBED] += np.histogram(-output_nus[~emitted_mask], bins=self.nu_bins,
+                                                             weights=-output_energies[~emitted_mask])[0]
+
+    def luminosity_density_nu(self, time_of_simulation, spectrum='emitted'):
+        """
+        Luminosity density (erg / s / Hz, in units of the packet energies per `time_of_simulation`) of the `spectrum`
+        ('emitted', 'reabsorbed' or 'virtual') in every bin.
+        """
+        return self.histograms[spectrum_names[spectrum]] / (time_of_simulation * np.diff(self.nu_bins))
+
+    def luminosity_density_wavelength(self, time_of_simulation, spectrum='emitted'):
+        """
+        Luminosity density per angstrom of the `spectrum` in every bin (divided by the wavelength width of the bin, so
+        it is exact for every grid).
+        """
+        wavelength_bins = nu_to_wavelength(self.nu_bins)
+        return self.histograms[spectrum_names[spectrum]] / (time_of_simulation * -np.diff(wavelength_bins))
+
+
+def wavelength_to_nu(wavelength):
+    """
+    Convert wavelengths in angstrom to frequencies in Hz
+    """
+    return units.Unit('angstrom').to('Hz', wavelength, units.spectral())
+
+
+def nu_to_wavelength(nu):
+    """
+    Convert frequencies in Hz to wavelengths in angstrom
+    """
+    return units.Unit('Hz').to('angstrom', nu, units.spectral())
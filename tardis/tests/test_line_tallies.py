@@ -0,0 +1,68 @@
+#testing the analysis of the line interaction tallies
+
+import numpy as np
+import pandas as pd
+import pytest
+from astropy import units as u
+
+from tardis import analysis
+
+
+class FakeAtomData(object):
+    def __init__(self):
+        self.lines = pd.DataFrame(dict(atomic_number=[14, 14, 20, 20], ion_number=[1, 1, 1, 2],
+                                       wavelength=[3000., 4000., 5000., 6000.]), index=[101, 102, 103, 104])
+        self.lines_index = pd.Series(np.arange(len(self.lines)), index=self.lines.index)
+
+
+class FakeModel(object):
+    def __init__(self):
+        self.atom_data = FakeAtomData()
+        #the kernel only saw the lines 102, 103 and 104
+        self.line_window = slice(1, 4)
+        self.line_interaction_counts = np.zeros((2, 2, 3), dtype=np.int64)
+        self.line_interaction_energies = np.zeros((2, 2, 3))
+        #line 102 absorbs twice in shell 0 and emits through line 103 and 104
+        self.line_interaction_counts[0, 0, 0] = 2
+        self.line_interaction_energies[0, 0, 0] = 4.
+        self.line_interaction_counts[1, 0, 1:] = 1
+        self.line_interaction_energies[1, 0, 1:] = [1., 3.]
+        #line 104 scatters once in shell 1
+        self.line_interaction_counts[:, 1, 2] = 1
+        self.line_interaction_energies[:, 1, 2] = 2.
+
+
+def test_line_tallies_sparse():
+    sparse_tallies = analysis.LineInteractionTallies(FakeModel()).to_sparse()
+    assert list(sparse_tallies.index) == [(102, 0), (103, 0), (104, 0), (104, 1)]
+    assert list(sparse_tallies.absorbed_count) == [2, 0, 0, 1]
+    assert list(sparse_tallies.emitted_energy) == [0., 1., 3., 2.]
+
+
+def test_line_tallies_line_table():
+    line_interaction_tallies = analysis.LineInteractionTallies(FakeModel())
+    line_table = line_interaction_tallies.line_table()
+    assert list(line_table.index) == [102, 103, 104]
+    assert list(line_table.atomic_number) == [14, 20, 20]
+    assert list(line_table.absorbed_energy) == [4., 0., 2.]
+    assert list(line_table.emitted_count) == [0, 1, 2]
+
+    line_table = line_interaction_tallies.line_table(shell=1)
+    assert list(line_table.index) == [104]
+
+
+def test_line_tallies_species_contributions():
+    line_interaction_tallies = analysis.LineInteractionTallies(FakeModel())
+    emitted = line_interaction_tallies.species_contributions()
+    assert np.allclose(emitted[20, 1], 1 / 6.)
+    assert np.allclose(emitted[20, 2], 5 / 6.)
+
+    absorbed = line_interaction_tallies.species_contributions('absorbed', wavelength_end=5500 * u.angstrom)
+    assert np.allclose(absorbed.values, [1.0, 0.0])
+
+
+def test_line_tallies_need_estimator():
+    model = FakeModel()
+    model.line_interaction_counts = None
+    with pytest.raises(ValueError):
+        analysis.LineInteractionTallies(model)
@@ -0,0 +1,67 @@
+#testing the trimming of the line list to the lines the packets can reach
+
+import numpy as np
+
+from tardis import model_radial_oned
+
+#six lines sorted by decreasing frequency, the upper level of line i is level i
+line_nus = np.array([60., 50., 40., 30., 20., 10.])
+line2macro_level_upper = np.arange(6)
+
+
+def macro_atom_arrays(transitions):
+    """
+    Macro atom arrays for a list of (source level, transition type, destination level, line id) transitions
+    """
+    transitions = sorted(transitions)
+    source_levels = np.array([transition[0] for transition in transitions])
+    return dict(line2macro_level_upper=line2macro_level_upper,
+                block_references=np.searchsorted(source_levels, np.arange(6)),
+                transition_type=np.array([transition[1] for transition in transitions]),
+                destination_level_id=np.array([transition[2] for transition in transitions]),
+                transition_line_id=np.array([transition[3] for transition in transitions]))
+
+
+def test_line_window_scatter():
+    line_window = model_radial_oned.calculate_line_window(line_nus, 15., 45.)
+    assert (line_window.start, line_window.stop) == (2, 5)
+    assert np.all(line_nus[line_window] == [40., 30., 20.])
+
+
+def test_line_window_downbranch_keeps_emission_lines():
+    #every level emits through its own line, level 3 also through line 0 (far outside the window)
+    transitions = [(level, -1, -1, level) for level in range(6)] + [(3, -1, -1, 0)]
+    line_window = model_radial_oned.calculate_line_window(line_nus, 25., 35., **macro_atom_arrays(transitions))
+    assert (line_window.start, line_window.stop) == (0, 4)
+
+
+def test_line_window_macroatom_follows_internal_jumps():
+    #level 2 can jump to level 4, which emits through line 4
+    transitions = [(level, -1, -1, level) for level in range(6)] + [(2, 1, 4, 2)]
+    line_window = model_radial_oned.calculate_line_window(line_nus, 35., 45., **macro_atom_arrays(transitions))
+    assert (line_window.start, line_window.stop) == (2, 5)
+
+    #without the internal jump only the lines in the frequency range are needed
+    transitions = [(level, -1, -1, level) for level in range(6)]
+    line_window = model_radial_oned.calculate_line_window(line_nus, 35., 45., **macro_atom_arrays(transitions))
+    assert (line_window.start, line_window.stop) == (2, 3)
+
+
+def test_line_window_keeps_doppler_margin_below_emission_lines():
+    #level 2 emits through line 3, the margin below it (30 * 0.5) reaches line 4 and the one below line 4 line 5
+    transitions = [(level, -1, -1, level) for level in range(6)] + [(2, -1, -1, 3)]
+    line_window = model_radial_oned.calculate_line_window(line_nus, 35., 45., beta_outer=0.25,
+                                                          **macro_atom_arrays(transitions))
+    assert (line_window.start, line_window.stop) == (2, 6)
+
+    line_window = model_radial_oned.calculate_line_window(line_nus, 35., 45., **macro_atom_arrays(transitions))
+    assert (line_window.start, line_window.stop) == (2, 4)
+
+
+def test_emission_line_ids_follow_internal_jumps():
+    #level 1 can jump to level 4, which emits through a line outside of the window (-1)
+    transitions = [(level, -1, -1, level) for level in range(6)] + [(1, 1, 4, 1), (4, -1, -1, -1)]
+    activating_lines = np.array([False, True, False, False, False, False])
+    emission_line_ids = model_radial_oned.calculate_emission_line_ids(activating_lines,
+                                                                      **macro_atom_arrays(transitions))
+    assert sorted(emission_line_ids) == [-1, 1, 4]
@@ -0,0 +1,337 @@
+#testing the MonteCarlo kernel and its backends on a small synthetic model
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tardis import montecarlo_multizone, montecarlo_vectorized, montecarlo_pool, model_radial_oned, spectrum_grid
+
+c = 2.99792458e10
+
+
+class SyntheticPacketSource(object):
+    def __init__(self, packet_nus, packet_mus, packet_energies):
+        self.packet_nus = packet_nus
+        self.packet_mus = packet_mus
+        self.packet_energies = packet_energies
+
+
+class SyntheticAtomData(object):
+    def __init__(self, block_references, transition_type, destination_level_idx):
+        self.macro_atom_references = pd.DataFrame({'block_references': block_references})
+        self.macro_atom_data = pd.DataFrame({'transition_type': transition_type,
+                                             'destination_level_idx': destination_level_idx})
+
+
+class SyntheticModel(object):
+    """
+    Stand-in for `Radial1DModel` with the arrays the MonteCarlo kernel reads: power law electron densities, random
+    Sobolev optical depths and (for downbranch) a macro atom in which every level emits through its own line or
+    through a line a few places further down the line list.
+    """
+
+    def __init__(self, no_of_packets=2000, no_of_shells=10, no_of_lines=300, line_interaction_id=0, seed=1):
+        random_state = np.random.RandomState(seed)
+        nu_start, nu_end = c / 10000e-8, c / 2000e-8
+        self.packet_src = SyntheticPacketSource(random_state.uniform(nu_start, nu_end, no_of_packets),
+                                                np.sqrt(random_state.random_sample(no_of_packets)),
+                                                np.ones(no_of_packets) / no_of_packets)
+        self.no_of_shells = no_of_shells
+        self.time_explosion = 13 * 86400.
+        velocities = np.linspace(1.1e9, 2e9, no_of_shells + 1)
+        self.v_inner = velocities[:-1].copy()
+        self.r_inner = self.v_inner * self.time_explosion
+        self.r_outer = velocities[1:] * self.time_explosion
+        self.electron_densities = 2e9 * (self.v_inner / 1.1e9) ** -7
+        self.line_list_nu = pd.Series(np.sort(random_state.uniform(0.8 * nu_start, 1.05 * nu_end, no_of_lines))[::-1])
+        self.tau_sobolevs = 10 ** random_state.uniform(-4, 1, (no_of_shells, no_of_lines))
+        self.j_blues = np.zeros_like(self.tau_sobolevs)
+        self.sigma_thomson = None
+        self.spectrum_grids = [spectrum_grid.SpectrumGrid('synthetic', np.linspace(0.7 * nu_start, 1.2 * nu_end, 41),
+                                                          spectrum_grid.SPACING_LINEAR)]
+        self.seed = 23111963
+        self.iterations_executed = 0
+        self.virtual_packet_tau_cutoff = 10.0
+        self.virtual_packet_survival_probability = 0.0
+        self.estimators = ['j_blues', 'last_interaction']
+
+        self.line_interaction_id = line_interaction_id
+        #two emission transitions per level (level i is the upper level of line i)
+        self.line2macro_level_upper = np.arange(no_of_lines, dtype=np.int64)
+        self.transition_line_id = np.empty(2 * no_of_lines, dtype=np.int64)
+        self.transition_line_id[0::2] = np.arange(no_of_lines)
+        self.transition_line_id[1::2] = np.minimum(np.arange(no_of_lines) + 5, no_of_lines - 1)
+        self.atom_data = SyntheticAtomData(np.arange(no_of_lines, dtype=np.int64) * 2,
+                                           -np.ones(2 * no_of_lines, dtype=np.int64),
+                                           -np.ones(2 * no_of_lines, dtype=np.int64))
+        self.transition_cumulative_probabilities = np.ones((no_of_shells, 2 * no_of_lines))
+        self.transition_cumulative_probabilities[:, 0::2] = random_state.uniform(0.5, 0.9, (no_of_shells, no_of_lines))
+
+    def packet_shard(self, start, end):
+        """
+        Copy of the model with the packets `start` to `end` only.
+        """
+        shard = SyntheticModel.__new__(SyntheticModel)
+        shard.__dict__.update(self.__dict__)
+        shard.packet_src = SyntheticPacketSource(self.packet_src.packet_nus[start:end],
+                                                 self.packet_src.packet_mus[start:end],
+                                                 self.packet_src.packet_energies[start:end])
+        shard.j_blues = np.zeros_like(self.j_blues)
+        return shard
+
+
+def run_kernel(model, **kwargs):
+    return [np.array(output, copy=True) for output in montecarlo_multizone.montecarlo_radial1d(model, **kwargs)]
+
+
+@pytest.mark.parametrize('line_interaction_id', [0, 1])
+def test_threads_give_identical_packets(line_interaction_id):
+    model = SyntheticModel(line_interaction_id=line_interaction_id)
+    serial_output = run_kernel(model, no_of_threads=1)
+    serial_j_blues = model.j_blues.copy()
+    parallel_output = run_kernel(model, no_of_threads=3)
+
+    #output_nus, output_energies, the last interaction arrays and the event counters
+    for i in (0, 1, 4, 5, 6, 7, 8):
+        assert np.array_equal(serial_output[i], parallel_output[i])
+    #js and nubars (summed in a different order)
+    for i in (2, 3):
+        assert np.allclose(serial_output[i], parallel_output[i], rtol=1e-12, atol=0)
+    assert np.allclose(serial_j_blues, model.j_blues, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('line_interaction_id', [0, 1])
+def test_packet_shards_give_identical_packets(line_interaction_id):
+    model = SyntheticModel(line_interaction_id=line_interaction_id)
+    output = run_kernel(model)
+
+    shard_outputs = [run_kernel(model.packet_shard(start, end), packet_id_offset=start)
+                     for start, end in ((0, 700), (700, 2000))]
+    for i in (0, 1, 4, 5, 6, 7):
+        assert np.array_equal(output[i], np.concatenate([shard_output[i] for shard_output in shard_outputs]))
+    assert np.array_equal(output[8], shard_outputs[0][8] + shard_outputs[1][8])
+    assert np.allclose(output[2], shard_outputs[0][2] + shard_outputs[1][2], rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('line_interaction_id', [0, 1])
+def test_pool_matches_serial_run(line_interaction_id):
+    model = SyntheticModel(line_interaction_id=line_interaction_id)
+    model.estimators = ['j_blues', 'last_interaction', 'line_tallies']
+    tally_shape = (2,) + model.tau_sobolevs.shape
+    model.line_interaction_counts = np.zeros(tally_shape, dtype=np.int64)
+    model.line_interaction_energies = np.zeros(tally_shape)
+    serial_output = run_kernel(model)
+    serial_j_blues = model.j_blues.copy()
+    serial_line_interaction_counts = model.line_interaction_counts.copy()
+    serial_line_interaction_energies = model.line_interaction_energies.copy()
+
+    pool = montecarlo_pool.MonteCarloPool(model, 2)
+    try:
+        #the shared estimators of the shards are reset for every run
+        for run in range(2):
+            pool_output = pool.run(model)
+    finally:
+        pool.close()
+
+    for i in (0, 1, 4, 5, 6, 7, 8):
+        assert np.array_equal(serial_output[i], pool_output[i])
+    for i in (2, 3):
+        assert np.allclose(serial_output[i], pool_output[i], rtol=1e-12, atol=0)
+    assert np.allclose(serial_j_blues, model.j_blues, rtol=1e-12, atol=0)
+    assert np.array_equal(serial_line_interaction_counts, model.line_interaction_counts)
+    assert np.allclose(serial_line_interaction_energies, model.line_interaction_energies, rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('line_interaction_id', [0, 1])
+def test_vectorized_backend_matches_kernel(line_interaction_id):
+    #the backends draw different random numbers, so they only agree statistically (the tolerances are about four
+    #standard deviations of the difference for 20000 packets)
+    model = SyntheticModel(no_of_packets=20000, line_interaction_id=line_interaction_id)
+    kernel_output = run_kernel(model)
+    kernel_j_blues = model.j_blues.copy()
+    vectorized_output = montecarlo_vectorized.montecarlo_radial1d(model)
+
+    escaped_energy = [output[1][output[1] > 0].sum() for output in (kernel_output, vectorized_output)]
+    assert np.allclose(escaped_energy[0], escaped_energy[1], rtol=0.03)
+    for i in (2, 3):
+        assert np.allclose(kernel_output[i], vectorized_output[i], rtol=0.05)
+    assert np.allclose(kernel_j_blues.sum(axis=1), model.j_blues.sum(axis=1), rtol=0.06, atol=0)
+    #line interactions and electron scatterings
+    for counter in (0, 1):
+        assert np.allclose(kernel_output[8][counter].sum(), vectorized_output[8][counter].sum(), rtol=0.03)
+
+
+def add_line_skipping_index(model, tau_threshold):
+    #same index as `Radial1DModel.calculate_line_skipping_index`
+    no_of_lines = model.tau_sobolevs.shape[1]
+    significant_lines = model.tau_sobolevs >= tau_threshold
+    significant_line_ids = np.where(significant_lines, np.arange(no_of_lines), no_of_lines)
+    model.next_significant_line = np.empty((model.no_of_shells, no_of_lines + 1), dtype=np.int64)
+    model.next_significant_line[:, :-1] = np.minimum.accumulate(significant_line_ids[:, ::-1], axis=1)[:, ::-1]
+    model.next_significant_line[:, -1] = no_of_lines
+    model.tau_skipped_cumulative = np.zeros((model.no_of_shells, no_of_lines + 1))
+    np.cumsum(np.where(significant_lines, 0.0, model.tau_sobolevs), axis=1, out=model.tau_skipped_cumulative[:, 1:])
+
+
+@pytest.mark.parametrize('line_interaction_id', [0, 1])
+def test_line_skipping_keeps_event_statistics(line_interaction_id):
+    #jumping over the thin lines must neither lose electron scatterings nor change the escaping energy (the tolerances
+    #are about four standard deviations for 20000 packets)
+    model = SyntheticModel(no_of_packets=20000, line_interaction_id=line_interaction_id)
+    output = run_kernel(model)
+    j_blues = model.j_blues.copy()
+    add_line_skipping_index(model, 1.0)
+    skipping_output = run_kernel(model)
+
+    escaped_energy = [run_output[1][run_output[1] > 0].sum() for run_output in (output, skipping_output)]
+    assert np.allclose(escaped_energy[0], escaped_energy[1], rtol=0.02)
+    for i in (2, 3):
+        assert np.allclose(output[i], skipping_output[i], rtol=0.05)
+    for counter in (0, 1):
+        assert np.allclose(output[8][counter].sum(), skipping_output[8][counter].sum(), rtol=0.03)
+    #the skipped lines still receive their j_blues
+    thin_lines = model.tau_sobolevs < 1.0
+    for lines in (thin_lines, ~thin_lines):
+        assert np.allclose(np.where(lines, j_blues, 0).sum(axis=1), np.where(lines, model.j_blues, 0).sum(axis=1),
+                           rtol=0.05, atol=0)
+
+
+def test_virtual_packet_roulette_keeps_virtual_spectrum():
+    #the roulette draws from the random number streams of the real packets, so the spectra with and without it only
+    #agree statistically (the tolerance is about four standard deviations for 20000 packets)
+    virtual_energies = {}
+    for tau_cutoff, survival_probability in ((1e99, 0.0), (10.0, 0.0), (1.0, 0.0), (1.0, 0.25)):
+        model = SyntheticModel(no_of_packets=20000, line_interaction_id=1)
+        model.virtual_packet_tau_cutoff = tau_cutoff
+        model.virtual_packet_survival_probability = survival_probability
+        run_kernel(model, virtual_packet_flag=3)
+        virtual_energies[tau_cutoff, survival_probability] = \
+            model.spectrum_grids[0].histograms[spectrum_grid.SPECTRUM_VIRTUAL].sum()
+    virtual_energy = virtual_energies[1e99, 0.0]
+
+    #the packets dropped beyond an optical depth of 10 carry almost nothing, those beyond 1 a lot
+    assert np.allclose(virtual_energies[10.0, 0.0], virtual_energy, rtol=1e-4)
+    assert virtual_energies[1.0, 0.0] < 0.9 * virtual_energy
+    #the survivors of the roulette (energy divided by the survival probability) make up for the dropped packets
+    assert np.allclose(virtual_energies[1.0, 0.25], virtual_energy, rtol=0.05)
+
+
+def test_diffusion_keeps_estimators_and_spectrum():
+    #the random walk draws from the random number streams of the packets, so the runs with and without it only agree
+    #statistically (the tolerances are about three standard deviations for 200000 packets)
+    results = {}
+    for diffusion_tau_threshold in (0.0, 5.0):
+        model = SyntheticModel(no_of_packets=200000, line_interaction_id=1)
+        #optically thick to electron scattering in the inner shells
+        model.electron_densities = model.electron_densities * 100
+        model.diffusion_tau_threshold = diffusion_tau_threshold
+        output = run_kernel(model)
+        escaped = output[1] > 0
+        escaped_energy = output[1][escaped].sum()
+        spectrum = model.spectrum_grids[0].histograms[spectrum_grid.SPECTRUM_EMITTED].reshape(4, 10).sum(axis=1)
+        results[diffusion_tau_threshold] = dict(
+            escaped_energy=escaped_energy, mean_nu=(output[0] * output[1])[escaped].sum() / escaped_energy,
+            j=output[2].sum(), nubar=output[3].sum() / output[2].sum(), j_blues=model.j_blues.sum(),
+            spectrum=spectrum[:3] / escaped_energy, diffusion_steps=output[8][7].sum())
+
+    reference, diffusion = results[0.0], results[5.0]
+    assert reference['diffusion_steps'] == 0
+    assert diffusion['diffusion_steps'] > 0
+    for name, rtol in (('escaped_energy', 0.03), ('mean_nu', 0.015), ('j', 0.05), ('nubar', 0.015),
+                       ('j_blues', 0.05), ('spectrum', 0.08)):
+        assert np.allclose(diffusion[name], reference[name], rtol=rtol, atol=0), name
+
+
+@pytest.mark.parametrize('no_of_threads', [1, 3])
+def test_batch_matches_separate_runs(no_of_threads):
+    #three models with the same line list but different densities, optical depths and seeds
+    models = []
+    for i in range(3):
+        model = SyntheticModel(line_interaction_id=1)
+        model.electron_densities = model.electron_densities * (1 + 0.5 * i)
+        model.tau_sobolevs = model.tau_sobolevs * (1 + i)
+        model.seed += i
+        models.append(model)
+
+    separate_outputs = [run_kernel(model) for model in models]
+    separate_j_blues = [model.j_blues.copy() for model in models]
+    batch_outputs = montecarlo_multizone.montecarlo_radial1d_batch(models, no_of_threads=no_of_threads)
+
+    for model, output, j_blues, batch_output in zip(models, separate_outputs, separate_j_blues, batch_outputs):
+        for i in (0, 1, 4, 5, 6, 7, 8):
+            assert np.array_equal(output[i], batch_output[i])
+        for i in (2, 3):
+            assert np.allclose(output[i], batch_output[i], rtol=1e-12, atol=0)
+        assert np.allclose(j_blues, model.j_blues, rtol=1e-12, atol=0)
+
+
+def run_backend(model, backend):
+    if backend == 'vectorized':
+        return montecarlo_vectorized.montecarlo_radial1d(model)
+    elif backend == 'pool':
+        pool = montecarlo_pool.MonteCarloPool(model, 2)
+        try:
+            return pool.run(model)
+        finally:
+            pool.close()
+    else:
+        return run_kernel(model, no_of_threads=3 if backend == 'threads' else 1)
+
+
+@pytest.mark.parametrize('backend', ['serial', 'threads', 'vectorized', 'pool'])
+def test_single_precision_j_blues_are_summed_in_double_precision(backend):
+    model = SyntheticModel(line_interaction_id=1)
+    single_model = model.packet_shard(0, 2000)
+    single_model.tau_sobolevs = model.tau_sobolevs.astype(np.float32)
+    single_model.transition_cumulative_probabilities = model.transition_cumulative_probabilities.astype(np.float32)
+    single_model.j_blues = np.zeros_like(single_model.tau_sobolevs)
+    #the same (rounded) line data in double precision gives the same packet histories
+    model.tau_sobolevs = single_model.tau_sobolevs.astype(np.float64)
+    model.transition_cumulative_probabilities = single_model.transition_cumulative_probabilities.astype(np.float64)
+
+    output = run_backend(model, backend)
+    single_output = run_backend(single_model, backend)
+
+    assert np.array_equal(output[1], single_output[1])
+    assert single_model.j_blues.dtype == np.float32
+    #rounded once (the j_blues of every shard of the pool once more)
+    assert np.allclose(single_model.j_blues, model.j_blues, rtol=2e-7 if backend == 'pool' else 1e-7, atol=0)
+
+
+def test_noise_target_rescales_line_tallies():
+    synthetic_model = SyntheticModel(no_of_packets=4000, line_interaction_id=1)
+    synthetic_model.estimators = ['j_blues', 'line_tallies']
+    tally_shape = (2,) + synthetic_model.tau_sobolevs.shape
+    synthetic_model.line_interaction_counts = np.zeros(tally_shape, dtype=np.int64)
+    synthetic_model.line_interaction_energies = np.zeros(tally_shape)
+
+    #the first batch alone, with the energy of 4000 packets
+    batch_model = synthetic_model.packet_shard(0, 1000)
+    batch_model.line_interaction_counts = np.zeros(tally_shape, dtype=np.int64)
+    batch_model.line_interaction_energies = np.zeros(tally_shape)
+    run_kernel(batch_model)
+
+    model = model_radial_oned.Radial1DModel.__new__(model_radial_oned.Radial1DModel)
+    model.__dict__.update(synthetic_model.__dict__)
+    model.spectrum_grids = []
+    model.packet_output_fname = None
+    model.montecarlo_progress_callback = None
+    model.montecarlo_progress_interval = 0
+    model.no_of_processes = 1
+    model.no_of_threads = 1
+    model.montecarlo_storage = None
+    model.packet_tracer = None
+    model.reset_packet_tallies()
+
+    def create_packets(no_of_packets, total_no_of_packets):
+        model.packet_src = synthetic_model.packet_shard(0, no_of_packets).packet_src
+
+    model.create_packets = create_packets
+    #a time limit of 0 stops the run after the first batch
+    noise_target = dict(batch_size=1000, min_batches=1, relative_error=0.0, max_time=0.0)
+    model.run_montecarlo_chunks(4000, 0, 'cython', noise_target=noise_target)
+
+    assert model.no_of_packets_executed == 1000
+    assert np.array_equal(model.line_interaction_counts, batch_model.line_interaction_counts)
+    assert np.allclose(model.line_interaction_energies, 4 * batch_model.line_interaction_energies, rtol=1e-12, atol=0)
+    assert np.allclose(model.j_blues, 4 * batch_model.j_blues, rtol=1e-12, atol=0)
@@ -0,0 +1,48 @@
+#testing the packet schedule of the simulation
+
+import numpy as np
+
+from tardis import simulation
+
+
+def convergence_ratios(change):
+    return {'t_rad': np.ones(20) * change, 'w': np.ones(20) * change, 't_inner': change}
+
+
+def test_schedule_starts_with_min_no_of_packets():
+    schedule = simulation.AdaptivePacketSchedule(100000, 10000)
+    assert schedule.no_of_packets == 10000
+
+
+def test_schedule_growth_is_limited():
+    schedule = simulation.AdaptivePacketSchedule(100000, 10000, threshold=0.05, max_growth=2.0)
+    assert schedule.update(convergence_ratios(0.01)) == 20000
+    assert schedule.update(convergence_ratios(0.01)) == 40000
+    assert schedule.update(convergence_ratios(0.01)) == 80000
+    assert schedule.update(convergence_ratios(0.01)) == 100000
+
+
+def test_schedule_follows_change():
+    schedule = simulation.AdaptivePacketSchedule(100000, 10000, threshold=0.05, max_growth=10.0)
+    #far from convergence the number of packets does not grow
+    assert schedule.update(convergence_ratios(0.5)) == 10000
+    assert schedule.update(convergence_ratios(0.1)) == 25000
+
+
+def test_schedule_never_decreases():
+    schedule = simulation.AdaptivePacketSchedule(100000, 10000, threshold=0.05, max_growth=10.0)
+    assert schedule.update(convergence_ratios(0.1)) == 25000
+    assert schedule.update(convergence_ratios(0.5)) == 25000
+
+
+def test_schedule_uses_median_of_shells():
+    schedule = simulation.AdaptivePacketSchedule(100000, 10000, threshold=0.05, max_growth=10.0)
+    ratios = convergence_ratios(0.01)
+    #a single noisy shell does not hold back the schedule
+    ratios['t_rad'][-1] = 1.0
+    assert schedule.update(ratios) == 100000
+
+
+def test_schedule_converged():
+    schedule = simulation.AdaptivePacketSchedule(100000, 10000, max_growth=100.0)
+    assert schedule.update(convergence_ratios(0.5), converged=True) == 100000
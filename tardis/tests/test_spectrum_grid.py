@@ -0,0 +1,48 @@
+#testing the spectrum grids
+
+import numpy as np
+import pytest
+
+from tardis import spectrum_grid
+
+
+def test_log_wavelength_grid():
+    grid = spectrum_grid.SpectrumGrid.from_config_dict(dict(name='optical', type='log_wavelength', start=3000.,
+                                                            end=9000., bins=100))
+    assert grid.spacing == spectrum_grid.SPACING_LOG
+    assert grid.no_of_bins == 100
+    np.testing.assert_allclose(np.diff(np.log(grid.nu_bins)), np.log(3.) / 100)
+    np.testing.assert_allclose(spectrum_grid.nu_to_wavelength(grid.nu_bins[[0, -1]]), [9000., 3000.])
+
+
+def test_edges_are_sorted():
+    grid = spectrum_grid.SpectrumGrid('test', [3e15, 1e15, 2e15])
+    np.testing.assert_array_equal(grid.nu_bins, [1e15, 2e15, 3e15])
+    assert grid.histograms.shape == (3, 2)
+
+
+def test_invalid_edges():
+    with pytest.raises(ValueError):
+        spectrum_grid.SpectrumGrid('test', [1e15])
+    with pytest.raises(ValueError):
+        spectrum_grid.SpectrumGrid('test', [1e15, 1e15, 2e15])
+
+
+def test_add_packets():
+    grid = spectrum_grid.SpectrumGrid('test', [1e15, 2e15, 3e15], spectrum_grid.SPACING_LINEAR)
+    output_nus = np.array([1.5e15, 2.5e15, -2.5e15, 5e15])
+    output_energies = np.array([1., 2., -3., 4.])
+    grid.add_packets(output_nus, output_energies)
+    np.testing.assert_array_equal(grid.histograms, [[1., 2.], [0., 3.], [0., 0.]])
+    grid.reset()
+    assert not grid.histograms.any()
+
+
+def test_luminosity_density_integrates_to_energy():
+    grid = spectrum_grid.SpectrumGrid.from_config_dict(dict(name='optical', type='log_wavelength', start=3000.,
+                                                            end=9000., bins=10))
+    grid.histograms[spectrum_grid.SPECTRUM_VIRTUAL] = np.arange(10.)
+    wavelength_bins = spectrum_grid.nu_to_wavelength(grid.nu_bins)
+    luminosity_density = grid.luminosity_density_wavelength(2., 'virtual')
+    np.testing.assert_allclose(np.sum(luminosity_density * -np.diff(wavelength_bins)), 45. / 2.)
+    np.testing.assert_allclose(np.sum(grid.luminosity_density_nu(2., 'virtual') * np.diff(grid.nu_bins)), 45. / 2.)